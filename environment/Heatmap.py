@@ -1,21 +1,33 @@
-import folium
-from folium.plugins import HeatMap  # Import HeatMap from plugins
 import numpy as np
 import time
 import threading
 import http.server
 import socketserver
 import os
+import json
 import requests
+from environment.geo import tile_bounds, tile_xy
+from environment.tiles import DEFAULT_DETAIL, MAX_TILE_ZOOM
+
+# Heat of the lowest mean in view, so every cell with readings still shows
+MIN_WEIGHT = 0.1
 
 class LiveHeatmapServer:
-    def __init__(self, map_center=(0, 0), zoom_start=2, update_interval=5, map_file="live_map.html"):
+    def __init__(self, map_center=(0, 0), zoom_start=2, update_interval=5, map_file="live_map.html", bbox=None, use_tiles=True, measurement="chloride"):
         self.map_center = map_center
         self.zoom_start = zoom_start
+        self.bbox = bbox  # (min_lon, min_lat, max_lon, max_lat) of the viewport, None for the whole world
+        self.use_tiles = use_tiles  # read the pre-aggregated tile pyramid rather than raw readings
+        self.measurement = measurement
         self.update_interval = update_interval
         self.map_file = map_file
         self.running = False
         self.port = 8080
+        # What the map shows, keyed by tile cell (or reading), as [lat, lon, sum, count].
+        # Filled in by update_map, drawn by render_loop at most once per update_interval
+        self.points = {}
+        self.dirty = False
+        self.lock = threading.Lock()
 
     def generate_random_data(self):
         """
@@ -29,36 +41,157 @@ class LiveHeatmapServer:
         fetch data from mongodb sever.
             
         """
-        r = requests.get('http://127.0.0.1:8000/getreading')
-        #print(r.json())
-        data_as_tuples = [tuple(item) for item in r.json()]
+        # Only ask for what the map shows, clustered to the map's zoom
+        params = {'stream': 'true', 'zoom': self.zoom_start}
+        if self.bbox is not None:
+            params['bbox'] = ','.join(str(v) for v in self.bbox)
+
+        # Stream the rows as NDJSON so parsing starts before the server finishes the scan
+        r = requests.get('http://127.0.0.1:8000/getreading', params=params, stream=True)
+        r.raise_for_status()
+        data_as_tuples = [tuple(json.loads(line)) for line in r.iter_lines() if line]
         print("requesting data")
         #print(data_as_tuples)
         return data_as_tuples
     
-    def update_map(self):
+    def get_cells_from_tiles(self):
         """
-        Updates the heatmap and saves it to an HTML file.
+        fetch pre-aggregated cells for the tiles in view.
+        Returns {(z, x, y): [lat, lon, sum, count], ...}, one per non-empty cell.
         """
-        while self.running:
-            try:
-                # Generate new data
-                data = self.get_data_from_mongodb()
-                locations = [[lat, lon] for lat, lon, _ in data]
-                weights = [value for _, _, value in data]
+        min_lon, min_lat, max_lon, max_lat = self.bbox or (-180, -85, 180, 85)
+        zoom = self.zoom_start
+        x_min, y_min = tile_xy(max_lat, min_lon, zoom)  # tile rows grow southwards
+        x_max, y_max = tile_xy(min_lat, max_lon, zoom)
+
+        cells = {}
+        for x in range(x_min, x_max + 1):
+            for y in range(y_min, y_max + 1):
+                r = requests.get(f'http://127.0.0.1:8000/tiles/{zoom}/{x}/{y}', params={'measurement': self.measurement, 'detail': DEFAULT_DETAIL})
+                r.raise_for_status()
+                for cell in r.json()['cells']:
+                    aggregate = cell['measurements'].get(self.measurement)
+                    if aggregate:
+                        cells[(cell['z'], cell['x'], cell['y'])] = [cell['latitude'], cell['longitude'], aggregate['sum'], aggregate['count']]
+        return cells
+
+    def get_data_from_tiles(self):
+        """
+        fetch pre-aggregated cells for the tiles in view.
+        Returns a list of tuples [(lat, lon, mean), ...], one per non-empty cell.
+        """
+        return [(lat, lon, total / count) for lat, lon, total, count in self.get_cells_from_tiles().values()]
 
-                # Create a new folium map
-                m = folium.Map(location=self.map_center, zoom_start=self.zoom_start)
-                HeatMap(locations, radius=15, blur=10, max_zoom=1).add_to(m)
+    def load_points(self):
+        """
+        Everything the map shows, keyed so new readings can be merged in.
+        """
+        if self.use_tiles:
+            return self.get_cells_from_tiles()
+        return {('row', i): [lat, lon, value, 1] for i, (lat, lon, value) in enumerate(self.get_data_from_mongodb()) if value is not None}
 
-                # Save the updated map
-                m.save(self.map_file)
-                print("Map updated!")
+    def merge_reading(self, reading):
+        """
+        Add a pushed reading to self.points, into its tile cell if the map shows cells.
+        Returns False if the map is not changed by it.
+        """
+        mean = reading['measurements'].get(self.measurement)
+        if mean is None:
+            return False
+        lat, lon = reading['latitude'], reading['longitude']
+        if self.bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = self.bbox
+            if not (min_lon <= lon <= max_lon and min_lat <= lat <= max_lat):
+                return False
+
+        if not self.use_tiles:
+            self.points[('reading', reading['id'])] = [lat, lon, mean, 1]
+            return True
+
+        # The same cell the server folds the reading into, weighted by its number of values
+        count = reading.get('counts', {}).get(self.measurement, 1)
+        cell_zoom = min(self.zoom_start + DEFAULT_DETAIL, MAX_TILE_ZOOM)
+        key = (cell_zoom, *tile_xy(lat, lon, cell_zoom))
+        if key not in self.points:
+            min_lon, min_lat, max_lon, max_lat = tile_bounds(*key)
+            self.points[key] = [(min_lat + max_lat) / 2, (min_lon + max_lon) / 2, 0.0, 0]
+        cell = self.points[key]
+        cell[2] += mean * count
+        cell[3] += count
+        return True
+
+    def read_events(self, response):
+        """
+        Parse the Server-Sent Events pushed by /readings/events.
+        Yields one dict per new reading.
+        """
+        for line in response.iter_lines(decode_unicode=True):
+            if line and line.startswith('data: '):
+                yield json.loads(line[len('data: '):])
 
-                # Wait before the next update
-                time.sleep(self.update_interval)
+    def render_map(self, data):
+        """
+        Renders the heatmap and saves it to an HTML file.
+        """
+        # folium is slow to import, only load it once there is a map to draw
+        import folium
+        from folium.plugins import HeatMap  # Import HeatMap from plugins
+
+        # Weighted by the measurement's mean, scaled from MIN_WEIGHT for the lowest
+        # in view to 1 for the highest, as the heat layer saturates above 1
+        values = [value for _, _, value in data]
+        low, high = (min(values), max(values)) if values else (0.0, 0.0)
+        span = high - low
+        locations = [[lat, lon, MIN_WEIGHT + (1 - MIN_WEIGHT) * (value - low) / span if span else 1.0] for lat, lon, value in data]
+
+        # Create a new folium map
+        m = folium.Map(location=self.map_center, zoom_start=self.zoom_start)
+        HeatMap(locations, radius=15, blur=10, max_zoom=1).add_to(m)
+
+        # Save the updated map
+        m.save(self.map_file)
+        print("Map updated!")
+
+    def update_map(self):
+        """
+        Loads the data once, then merges in new readings as they are pushed.
+        Drawing is left to render_loop, so a burst of readings costs one render.
+        """
+        while self.running:
+            try:
+                # Subscribe before loading so no reading falls between the two
+                with requests.get('http://127.0.0.1:8000/readings/events', stream=True, timeout=(5, None)) as events:
+                    events.raise_for_status()
+                    points = self.load_points()
+                    with self.lock:
+                        self.points = points
+                        self.dirty = True
+
+                    for reading in self.read_events(events):
+                        if not self.running:
+                            break
+                        with self.lock:
+                            if self.merge_reading(reading):
+                                self.dirty = True
             except Exception as e:
                 print(f"Error updating map: {e}")
+                # Wait before reconnecting
+                time.sleep(self.update_interval)
+
+    def render_loop(self):
+        """
+        Redraws the map at most once per update_interval, and only if it has changed.
+        """
+        while self.running:
+            with self.lock:
+                data = [(lat, lon, total / count) for lat, lon, total, count in self.points.values()] if self.dirty else None
+                self.dirty = False
+            if data is not None:
+                try:
+                    self.render_map(data)
+                except Exception as e:
+                    print(f"Error rendering map: {e}")
+            time.sleep(self.update_interval)
 
     def start_server(self):
         """
@@ -76,6 +209,7 @@ class LiveHeatmapServer:
         """
         self.running = True
         threading.Thread(target=self.update_map, daemon=True).start()
+        threading.Thread(target=self.render_loop, daemon=True).start()
         self.start_server()
 
     def stop(self):
@@ -100,13 +234,16 @@ if __name__ == "__main__":
 #attempt to add 3d aspect
 #-------------------------
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.interpolate import griddata
-from mpl_toolkits.mplot3d import Axes3D
 import threading
 
+# matplotlib and scipy are imported inside the methods that use them, so
+# importing this module (e.g. for LiveHeatmapServer) stays fast
+
 class Heatmap3D:
     def __init__(self):
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.mplot3d import Axes3D  # registers the '3d' projection
+
         # Initialize a figure for live updates
         self.fig = plt.figure()
         self.ax = self.fig.add_subplot(111, projection='3d')
@@ -160,6 +297,9 @@ class Heatmap3D:
         """
         Generates and updates the 3D heatmap based on the input locations, values, and elevations.
         """
+        import matplotlib.pyplot as plt
+        from scipy.interpolate import griddata
+
         if not locations or not values or not elevations or len(locations) != len(values) or len(values) != len(elevations):
             raise ValueError("Locations, values, and elevations must be of the same length and not empty.")
         
@@ -206,6 +346,8 @@ class Heatmap3D:
         elevation_func: Function that returns the latest elevation data [elev1, elev2, ...]
         update_interval: Time interval between updates in seconds
         """
+        import matplotlib.pyplot as plt
+
         def update():
             self.is_running = True
             while self.is_running:
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from environment.geo import MAX_LATITUDE, BBox
+
+# How long a cached response may be served before it is recomputed
+DEFAULT_TTL = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+
+# Most responses the in-process cache holds before evicting the least recently used
+DEFAULT_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1000"))
+
+# Set to e.g. redis://localhost:6379/0 to share the cache between workers
+REDIS_URL = os.getenv("REDIS_URL")
+
+REDIS_PREFIX = "readings-cache:"
+
+# Slack on scope edges, tile_bounds' edge latitudes differ from MAX_LATITUDE in the last digits
+EDGE_TOLERANCE = 1e-9
+
+
+class CacheEntry(NamedTuple):
+    body: bytes
+    etag: str
+    # Area the response covers, None for the whole world. A new reading inside it invalidates the entry.
+    scope: Optional[BBox]
+
+
+def make_key(endpoint: str, **params) -> str:
+    """Cache key for an endpoint and its query parameters."""
+    return endpoint + "?" + json.dumps(params, sort_keys=True, default=str)
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+class PointSet:
+    """
+    The distinct points of a batch of readings, sorted by longitude so each
+    cached scope only looks at the points in its longitude range.
+
+    A latitude past MAX_LATITUDE spans down to it, since tile_xy puts such a
+    reading in the edge tile, whose bounds stop at MAX_LATITUDE.
+    """
+    def __init__(self, readings: Iterable[Dict]):
+        points = set()
+        for reading in readings:
+            latitude = reading["location"]["latitude"]
+            clamped = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+            points.add((reading["location"]["longitude"], min(latitude, clamped), max(latitude, clamped)))
+        self.points: List[Tuple[float, float, float]] = sorted(points)
+        self.longitudes = [point[0] for point in self.points]
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def touches(self, scope: Optional[BBox]) -> bool:
+        """Whether any of the points falls inside scope (None is the whole world)."""
+        if scope is None:
+            return bool(self.points)
+        min_lon, min_lat, max_lon, max_lat = scope
+        start = bisect_left(self.longitudes, min_lon - EDGE_TOLERANCE)
+        end = bisect_right(self.longitudes, max_lon + EDGE_TOLERANCE)
+        return any(
+            low <= max_lat + EDGE_TOLERANCE and high >= min_lat - EDGE_TOLERANCE
+            for _, low, high in self.points[start:end]
+        )
+
+
+class TTLCache:
+    """
+    In-process LRU cache of serialised responses with a time-to-live.
+
+    Safe to use from the threadpool that runs the sync routes.
+    """
+    def __init__(self, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, CacheEntry]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, entry = item
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, body: bytes, scope: Optional[BBox] = None) -> CacheEntry:
+        entry = CacheEntry(body, make_etag(body), scope)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate_points(self, points: PointSet) -> None:
+        """Drop every response whose scope contains one of a batch of newly written readings."""
+        with self._lock:
+            stale = [key for key, (_, entry) in self._entries.items() if points.touches(entry.scope)]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """
+    The same interface backed by Redis, so every API worker shares one cache
+    and sees the same invalidations. Needs the redis package.
+    """
+    def __init__(self, url: str, ttl: float = DEFAULT_TTL):
+        import redis
+        self.ttl = ttl
+        self._redis = redis.Redis.from_url(url)
+        self._index = REDIS_PREFIX + "keys"
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        stored = self._redis.hgetall(REDIS_PREFIX + key)
+        if not stored:
+            return None
+        scope = json.loads(stored[b"scope"])
+        return CacheEntry(stored[b"body"], stored[b"etag"].decode(), tuple(scope) if scope else None)
+
+    def set(self, key: str, body: bytes, scope: Optional[BBox] = None) -> CacheEntry:
+        entry = CacheEntry(body, make_etag(body), scope)
+        pipe = self._redis.pipeline()
+        pipe.hset(REDIS_PREFIX + key, mapping={"body": body, "etag": entry.etag, "scope": json.dumps(scope)})
+        pipe.expire(REDIS_PREFIX + key, int(max(1, self.ttl)))
+        pipe.sadd(self._index, key)
+        pipe.execute()
+        return entry
+
+    def invalidate_points(self, points: PointSet) -> None:
+        # Three round-trips per batch: the keys, all their scopes, the deletes
+        keys = [raw_key.decode() for raw_key in self._redis.smembers(self._index)]
+        if not keys:
+            return
+        pipe = self._redis.pipeline()
+        for key in keys:
+            pipe.hget(REDIS_PREFIX + key, "scope")
+        scopes = pipe.execute()
+
+        pipe = self._redis.pipeline()
+        for key, scope in zip(keys, scopes):
+            # No scope means it expired on its own
+            if scope is None or points.touches(json.loads(scope)):
+                pipe.delete(REDIS_PREFIX + key)
+                pipe.srem(self._index, key)
+        pipe.execute()
+
+    def clear(self) -> None:
+        for raw_key in self._redis.smembers(self._index):
+            self._redis.delete(REDIS_PREFIX + raw_key.decode())
+        self._redis.delete(self._index)
+
+
+def make_cache():
+    """The Redis cache if REDIS_URL is set, otherwise the in-process one."""
+    if REDIS_URL:
+        return RedisCache(REDIS_URL)
+    return TTLCache()
+
+
+# Shared by the read endpoints and invalidated by the ingestion code
+response_cache = make_cache()
+
+
+def invalidate_readings(readings) -> None:
+    """Invalidate the cached responses that newly written readings fall inside, in one pass per batch."""
+    points = PointSet(readings)
+    if points:
+        response_cache.invalidate_points(points)
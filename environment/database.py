@@ -0,0 +1,142 @@
+import os
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from pydantic import ValidationError
+from pymongo import AsyncMongoClient
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from environment import config, pagination, queries
+
+# Connection pool and timeouts for the async client, tunable per deployment
+MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "5000"))
+SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "20000"))
+
+# The single pooled client, opened and closed by the app lifespan
+_client: Optional[AsyncMongoClient] = None
+
+
+async def connect(uri: str = config.MONGODB_URI) -> None:
+    """
+    Open the shared async client.
+
+    The in-process mongomock stand-in has no async driver, so with a
+    "mongomock://" URI nothing is opened and every function below runs the
+    blocking version in the threadpool instead.
+    """
+    global _client
+    if _client is not None or uri.startswith("mongomock://"):
+        return
+    _client = AsyncMongoClient(
+        uri,
+        maxPoolSize=MAX_POOL_SIZE,
+        minPoolSize=MIN_POOL_SIZE,
+        serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS,
+        connectTimeoutMS=CONNECT_TIMEOUT_MS,
+        socketTimeoutMS=SOCKET_TIMEOUT_MS,
+    )
+
+
+async def close() -> None:
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+def _collection(name: str):
+    return _client[config.DATABASE_NAME][name]
+
+
+async def get_measurement_points(name: str = "chloride", match: Optional[Dict] = None, cluster_precision: Optional[int] = None) -> List[Tuple]:
+    """Async version of queries.get_measurement_points."""
+    if _client is None:
+        return await run_in_threadpool(queries.get_measurement_points, name, None, match, cluster_precision)
+    pipeline = queries.measurement_pipeline(name, match, cluster_precision)
+    cursor = await _collection(config.DATA_COLLECTION).aggregate(pipeline)
+    return [queries.to_point(doc) for doc in await cursor.to_list(None)]
+
+
+def iter_measurement_points(name: str = "chloride", batch_size: int = queries.DEFAULT_BATCH_SIZE, match: Optional[Dict] = None, cluster_precision: Optional[int] = None) -> AsyncIterator[Tuple]:
+    """Async version of queries.iter_measurement_points, raises ValueError before streaming starts."""
+    pipeline = queries.measurement_pipeline(name, match, cluster_precision)
+    if _client is None:
+        rows = queries.iter_measurement_points(name, batch_size, None, match, cluster_precision)
+        return iterate_in_threadpool(rows)
+
+    async def rows():
+        cursor = await _collection(config.DATA_COLLECTION).aggregate(pipeline, batchSize=batch_size)
+        async for doc in cursor:
+            yield queries.to_point(doc)
+    return rows()
+
+
+async def get_page(collection_name: str, query: Optional[Dict] = None, cursor: Optional[str] = None, limit: int = pagination.DEFAULT_PAGE_SIZE, fields: Optional[List[str]] = None) -> Dict:
+    """Async version of pagination.get_page."""
+    if _client is None:
+        collection = config.get_collection(collection_name)
+        return await run_in_threadpool(pagination.get_page, collection, query, cursor, limit, fields)
+    limit = pagination.clamp_page_size(limit)
+    documents = await _collection(collection_name).find(
+        pagination.page_query(query, cursor), pagination.projection(fields)
+    ).sort(pagination.PAGE_SORT).limit(limit + 1).to_list(None)
+    return pagination.make_page(documents, limit)
+
+
+async def get_reading(cursor: Optional[str] = None, limit: int = pagination.DEFAULT_PAGE_SIZE, fields: Optional[List[str]] = None) -> Dict:
+    """Fetch one page of readings, see config.get_reading."""
+    return await get_page(config.DATA_COLLECTION, None, cursor, limit, fields)
+
+
+async def get_reading_by_uid(uid: str, cursor: Optional[str] = None, limit: int = pagination.DEFAULT_PAGE_SIZE, fields: Optional[List[str]] = None) -> Dict:
+    """
+    Fetch one page of a device's readings.
+
+    Args:
+        uid (str): The user ID to fetch readings for.
+        cursor (str, optional): The "next" token of the previous page.
+        limit (int): Page size, capped at pagination.MAX_PAGE_SIZE.
+        fields (list, optional): Only return these fields.
+
+    Returns:
+        Dict: {"readings": [...], "next": str or None}, readings is empty if there are none.
+    """
+    return await get_page(config.DATA_COLLECTION, {"uid": uid}, cursor, limit, fields)
+
+
+async def add_user(details) -> str:
+    """Async version of config.add_user."""
+    if _client is None:
+        return await run_in_threadpool(config.add_user, details)
+    account = {
+        "username": details[0],
+        "email": details[1],
+        "password": details[2],
+        "verified": False
+    }
+    result = await _collection(config.ACCOUNTS_COLLECTION).insert_one(account)
+    return str(result.inserted_id)
+
+
+async def add_reading(details: Dict) -> str:
+    """Async version of config.add_reading."""
+    if _client is None:
+        return await run_in_threadpool(config.add_reading, details)
+    try:
+        reading = config.data_reading(**details)
+        reading_dict = config.prepare_reading(reading)
+        result = await _collection(config.DATA_COLLECTION).insert_one(reading_dict)
+    except ValidationError as e:
+        return f"Validation error: {e}"
+    except Exception as e:
+        return f"An error occurred: {e}"
+
+    try:
+        # Same follow-up as config.after_insert, on the async client
+        for name, method, argument in config.after_insert_writes([reading_dict]):
+            await getattr(_collection(name), method)(argument, ordered=False)
+        await run_in_threadpool(config.notify_inserted, [reading_dict])
+    except Exception as e:
+        # Stored all the same, so the device must not send it again
+        return f"Reading added with ID: {result.inserted_id}, but updating the map data failed: {e}"
+    return f"Reading added successfully with ID: {result.inserted_id}"
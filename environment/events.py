@@ -0,0 +1,154 @@
+import asyncio
+import json
+import threading
+import time
+from typing import AsyncIterator, Dict, Optional
+
+# Events a slow subscriber may fall behind by before the oldest are dropped
+MAX_PENDING_EVENTS = 1000
+
+# Seconds between keep-alive comments on an idle event stream
+KEEPALIVE_INTERVAL = 15
+
+# Server error codes meaning a change stream cannot carry on from its resume token:
+# InvalidResumeToken, ChangeStreamFatalError and ChangeStreamHistoryLost
+NO_RESUME_CODES = (260, 280, 286)
+
+
+def reading_delta(reading: Dict) -> Dict:
+    """
+    The part of a new reading the live map needs.
+
+    Returns:
+        dict: id, uid, latitude, longitude, the mean of each measurement and
+        the number of values each mean is of (to merge it into an aggregate)
+    """
+    measurements = {}
+    counts = {}
+    for measurement in reading.get("measurements", []):
+        values = measurement.get("values") or []
+        if values:
+            measurements[measurement["name"]] = sum(values) / len(values)
+            counts[measurement["name"]] = len(values)
+    return {
+        "id": str(reading.get("_id", reading.get("id"))),
+        "uid": reading.get("uid"),
+        "latitude": reading["location"]["latitude"],
+        "longitude": reading["location"]["longitude"],
+        "measurements": measurements,
+        "counts": counts,
+    }
+
+
+class EventBus:
+    """
+    In-process fan-out of new readings to every connected event stream.
+
+    Each subscriber gets its own asyncio.Queue. publish() may be called from any
+    thread (sync routes run in the threadpool, the change stream in its own thread).
+    """
+    def __init__(self, max_pending: int = MAX_PENDING_EVENTS):
+        self.max_pending = max_pending
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self) -> asyncio.Queue:
+        """Register a queue on the running event loop that will receive every event."""
+        queue = asyncio.Queue(maxsize=self.max_pending)
+        with self._lock:
+            self._subscribers[queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        with self._lock:
+            self._subscribers.pop(queue, None)
+
+    def publish(self, event: Dict) -> None:
+        """Hand an event to every subscriber without blocking the caller."""
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for queue, loop in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._deliver, queue, event)
+            except RuntimeError:
+                # The subscriber's loop has closed
+                self.unsubscribe(queue)
+
+    @staticmethod
+    def _deliver(queue: asyncio.Queue, event: Dict) -> None:
+        if queue.full():
+            queue.get_nowait()  # drop the oldest rather than stall the publisher
+        queue.put_nowait(event)
+
+    async def stream(self, is_disconnected=None) -> AsyncIterator[str]:
+        """
+        Yield events as Server-Sent Events until the client goes away.
+
+        Args:
+            is_disconnected: Optional coroutine function, e.g. Request.is_disconnected
+        """
+        queue = self.subscribe()
+        try:
+            while True:
+                if is_disconnected is not None and await is_disconnected():
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            self.unsubscribe(queue)
+
+
+class ChangeStreamWatcher:
+    """
+    Forward inserts on a MongoDB collection to an EventBus.
+
+    Runs a change stream in a background thread, so readings written by any API
+    worker (or straight into the database) reach every connected map. The
+    resume token of the last change is kept, so after an error the stream
+    carries on from it and inserts made while reconnecting are not missed.
+    """
+    def __init__(self, collection, bus: EventBus):
+        self.collection = collection
+        self.bus = bus
+        self._stream = None
+        self._thread: Optional[threading.Thread] = None
+        self.resume_token = None
+        self.running = False
+
+    def start(self) -> None:
+        self.running = True
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+        if self._stream is not None:
+            self._stream.close()
+
+    def _watch(self) -> None:
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        while self.running:
+            try:
+                with self.collection.watch(pipeline, resume_after=self.resume_token) as stream:
+                    self._stream = stream
+                    # Set before any change, so even an error on an idle stream resumes from here
+                    self.resume_token = stream.resume_token
+                    for change in stream:
+                        self.bus.publish(reading_delta(change["fullDocument"]))
+                        self.resume_token = stream.resume_token
+            except Exception as e:
+                if self.running:
+                    print(f"Change stream error: {e}")
+                    if getattr(e, "code", None) in NO_RESUME_CODES:
+                        # The token has fallen off the oplog, what happened since
+                        # cannot be replayed, so start again from now
+                        self.resume_token = None
+                    time.sleep(1)  # back off before reconnecting
+
+
+# Shared by the API routes and the ingestion code
+bus = EventBus()
@@ -0,0 +1,242 @@
+import math
+from typing import Dict, Optional, Tuple
+from pymongo import UpdateOne
+
+# Field holding the GeoJSON point. The app's own "location" stays as
+# {latitude, longitude} so existing clients keep working.
+GEO_FIELD = "geoLocation"
+
+# Zoom level of the tile key stored on every reading. The key is a quadkey, so
+# the readings under any tile down to this zoom share a prefix of it
+TILE_KEY_ZOOM = 14
+
+# Precision of the geohash stored on every reading (~5m cells)
+GEOHASH_PRECISION = 9
+
+_GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Web Mercator cannot represent the poles
+MAX_LATITUDE = 85.05112878
+
+BBox = Tuple[float, float, float, float]  # (min_lon, min_lat, max_lon, max_lat)
+
+# The $geoWithin polygon drawn around a bbox has a vertex at least every
+# GEO_EDGE_STEP degrees along its north and south edges, and every side moved
+# out by GEO_EDGE_PADDING degrees. The geodesics between the vertices bow by
+# at most ~0.001 degrees, so the polygon always holds the whole bbox
+GEO_EDGE_STEP = 1.0
+GEO_EDGE_PADDING = 0.01
+
+# Bboxes wider than this in longitude, or reaching past this latitude, are too
+# big for one polygon and are matched on their coordinates alone
+GEO_MAX_LON_SPAN = 90.0
+GEO_MAX_LATITUDE = 89.0
+
+
+def geohash_encode(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    """
+    Encode a coordinate as a geohash string.
+
+    Args:
+        latitude (float): Latitude of the point
+        longitude (float): Longitude of the point
+        precision (int): Number of characters in the hash
+
+    Returns:
+        str: The geohash, points sharing a prefix lie in the same cell.
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # bits alternate between longitude and latitude, starting with longitude
+    while len(chars) < precision:
+        rng, value = (lon_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits = bits << 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def tile_xy(latitude: float, longitude: float, zoom: int) -> Tuple[int, int]:
+    """Return the x, y of the Web Mercator (slippy map) tile containing a point."""
+    latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    n = 2 ** zoom
+    x = int((longitude + 180.0) / 360.0 * n)
+    lat_rad = math.radians(latitude)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    # Points on the far edges belong to the last tile
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def quadkey(zoom: int, x: int, y: int) -> str:
+    """
+    Encode a tile as a quadkey, one digit per zoom level.
+
+    A tile's quadkey is the prefix of the quadkeys of every tile under it.
+    """
+    digits = []
+    for level in range(zoom, 0, -1):
+        mask = 1 << (level - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return "".join(digits)
+
+
+def tile_bounds(zoom: int, x: int, y: int) -> BBox:
+    """Return the (min_lon, min_lat, max_lon, max_lat) covered by a tile."""
+    n = 2 ** zoom
+    if not (0 <= x < n and 0 <= y < n):
+        raise ValueError(f"Tile {zoom}/{x}/{y} does not exist")
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return (x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y))
+
+
+def parse_bbox(bbox: str) -> BBox:
+    """Parse a "min_lon,min_lat,max_lon,max_lat" query parameter."""
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox.split(","))
+    except ValueError:
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    if min_lon > max_lon or min_lat > max_lat:
+        raise ValueError("bbox minimums must not exceed maximums")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def parse_tile(tile: str) -> Tuple[int, int, int]:
+    """Parse a "z/x/y" query parameter."""
+    try:
+        zoom, x, y = (int(v) for v in tile.split("/"))
+    except ValueError:
+        raise ValueError("tile must be z/x/y")
+    tile_bounds(zoom, x, y)  # validates the tile
+    return zoom, x, y
+
+
+def geohash_precision_for_zoom(zoom: int) -> int:
+    """Geohash length whose cells are roughly an eighth of a map tile at this zoom."""
+    # Each geohash character adds 2.5 bits of longitude, a tile at zoom z is 2^-z of the world
+    return max(1, min(GEOHASH_PRECISION, round((zoom + 3) * 2 / 5)))
+
+
+def geo_fields(location: Dict) -> Dict:
+    """
+    Compute the spatial fields stored on a reading at insert time.
+
+    Args:
+        location (dict): The reading's {"latitude", "longitude"} location
+
+    Returns:
+        dict: GeoJSON point, geohash and quadkey of the TILE_KEY_ZOOM tile for the reading
+    """
+    latitude = location["latitude"]
+    longitude = location["longitude"]
+    x, y = tile_xy(latitude, longitude, TILE_KEY_ZOOM)
+    return {
+        GEO_FIELD: {"type": "Point", "coordinates": [longitude, latitude]},
+        "geohash": geohash_encode(latitude, longitude),
+        "tile": quadkey(TILE_KEY_ZOOM, x, y),
+    }
+
+
+def bbox_polygon(bbox: BBox) -> Dict:
+    """GeoJSON polygon holding a bbox, whose edges are geodesics rather than lines of latitude."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    west, east = min_lon - GEO_EDGE_PADDING, max_lon + GEO_EDGE_PADDING
+    south, north = min_lat - GEO_EDGE_PADDING, max_lat + GEO_EDGE_PADDING
+    steps = max(1, math.ceil((east - west) / GEO_EDGE_STEP))
+    longitudes = [west + (east - west) * i / steps for i in range(steps + 1)]
+    ring = [[lon, south] for lon in longitudes] + [[lon, north] for lon in reversed(longitudes)]
+    ring.append(ring[0])
+    return {"type": "Polygon", "coordinates": [ring]}
+
+
+def bbox_filter(bbox: Optional[BBox], geo_index: bool = True) -> Dict:
+    """
+    Query filter matching readings inside a bounding box (empty if bbox is None).
+
+    The readings are always picked by their plain coordinates, so a real server
+    and the mongomock stand-in return the same ones. $geoWithin edges are
+    geodesics, which bow away from the box's latitudes, so it only narrows the
+    search: its polygon holds the whole box (see bbox_polygon) and the
+    coordinates decide.
+
+    Args:
+        bbox (tuple, optional): (min_lon, min_lat, max_lon, max_lat)
+        geo_index (bool): Add $geoWithin on GEO_FIELD, which a real server answers
+            from the 2dsphere index. The stand-in has no $geoWithin. Boxes too
+            big for one polygon are left to the coordinates anyway.
+    """
+    if bbox is None:
+        return {}
+    min_lon, min_lat, max_lon, max_lat = bbox
+    query = {
+        "location.longitude": {"$gte": min_lon, "$lte": max_lon},
+        "location.latitude": {"$gte": min_lat, "$lte": max_lat},
+    }
+    if geo_index and max_lon - min_lon <= GEO_MAX_LON_SPAN and -GEO_MAX_LATITUDE <= min_lat and max_lat <= GEO_MAX_LATITUDE:
+        query[GEO_FIELD] = {"$geoWithin": {"$geometry": bbox_polygon(bbox)}}
+    return query
+
+
+def tile_filter(zoom: int, x: int, y: int) -> Dict:
+    """
+    Query filter matching readings inside a map tile, from the indexed tile key.
+
+    Down to TILE_KEY_ZOOM this is a prefix match on the key, which a real server
+    answers from the tile index and the stand-in supports too. Deeper tiles
+    match their TILE_KEY_ZOOM ancestor's key and then the coordinates.
+    Readings past MAX_LATITUDE belong to the edge tiles, as tile_xy puts them.
+    """
+    min_lon, min_lat, max_lon, max_lat = tile_bounds(zoom, x, y)
+    if zoom <= TILE_KEY_ZOOM:
+        return {"tile": {"$regex": "^" + quadkey(zoom, x, y)}} if zoom else {}
+
+    shift = zoom - TILE_KEY_ZOOM
+    match = {
+        "tile": quadkey(TILE_KEY_ZOOM, x >> shift, y >> shift),
+        "location.longitude": {"$gte": min_lon, "$lt": max_lon},
+    }
+    latitude = {}
+    if y < 2 ** zoom - 1:
+        latitude["$gt"] = min_lat
+    if y > 0:
+        latitude["$lte"] = max_lat
+    if latitude:
+        match["location.latitude"] = latitude
+    return match
+
+
+def backfill_geo_fields(collection, batch_size: int = 1000) -> int:
+    """
+    Add the spatial fields to readings stored before they existed, or with a
+    tile key from before it was a quadkey.
+
+    Returns:
+        int: Number of readings updated
+    """
+    updated = 0
+    batch = []
+    query = {"$or": [{GEO_FIELD: {"$exists": False}}, {"tile": {"$regex": "/"}}]}
+    cursor = collection.find(query, {"location": 1})
+    for reading in cursor:
+        batch.append(UpdateOne({"_id": reading["_id"]}, {"$set": geo_fields(reading["location"])}))
+        if len(batch) >= batch_size:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += collection.bulk_write(batch, ordered=False).modified_count
+    return updated
@@ -0,0 +1,72 @@
+from typing import Dict, List
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+from pymongo.errors import OperationFailure
+from environment.config import (
+    ACCOUNTS_COLLECTION,
+    DATA_COLLECTION,
+    ROLLUPS_COLLECTION,
+    SERIES_COLLECTION,
+    TILES_COLLECTION,
+)
+from environment.geo import GEO_FIELD
+from environment.sync import UPDATED_FIELD
+
+# Every index the API relies on, per collection. Names are left to MongoDB so
+# an index created before this registry existed is recognised as the same one.
+INDEXES: Dict[str, List[IndexModel]] = {
+    DATA_COLLECTION: [
+        # GET /readings pages through this
+        IndexModel([("datetime", ASCENDING), ("_id", ASCENDING)]),
+        # /readings/uid/{uid}, a device's readings in time order
+        IndexModel([("uid", ASCENDING), ("datetime", ASCENDING), ("_id", ASCENDING)]),
+        # bbox restricted /getreading and /stats ($geoWithin)
+        IndexModel([(GEO_FIELD, GEOSPHERE)]),
+        # tile restricted /getreading and /stats (quadkey prefix, see geo.tile_filter)
+        IndexModel([("tile", ASCENDING)]),
+        # /readings/sync walks this in order
+        IndexModel([(UPDATED_FIELD, ASCENDING), ("_id", ASCENDING)]),
+    ],
+    ACCOUNTS_COLLECTION: [
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("username", ASCENDING)]),
+    ],
+    TILES_COLLECTION: [
+        # Cells under a tile
+        IndexModel([("z", ASCENDING), ("x", ASCENDING), ("y", ASCENDING)]),
+    ],
+    ROLLUPS_COLLECTION: [
+        IndexModel([("scope", ASCENDING), ("period", ASCENDING), ("key", ASCENDING), ("start", ASCENDING)]),
+    ],
+    SERIES_COLLECTION: [
+        IndexModel([("uid", ASCENDING), ("name", ASCENDING), ("start", ASCENDING)]),
+        IndexModel([("name", ASCENDING), ("start", ASCENDING)]),
+    ],
+}
+
+
+def apply_indexes(db, registry: Dict[str, List[IndexModel]] = INDEXES) -> List[str]:
+    """
+    Create every declared index that does not exist yet.
+
+    Creating an index that already exists with the same keys and options is
+    a no-op, so this is safe to run at every startup. An index that cannot be
+    built, e.g. the unique email index while duplicate accounts exist, is
+    reported and skipped rather than stopping the app.
+
+    Args:
+        db: The database holding the collections
+
+    Returns:
+        List[str]: A message for each index that could not be created
+    """
+    errors = []
+    for collection_name, models in registry.items():
+        collection = db[collection_name]
+        for model in models:
+            try:
+                collection.create_indexes([model])
+            except OperationFailure as e:
+                errors.append(f"{collection_name}.{model.document['name']}: {e}")
+    for error in errors:
+        print(f"Error creating index {error}")
+    return errors
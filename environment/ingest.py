@@ -0,0 +1,134 @@
+import json
+import time
+from typing import Dict, Iterable, List, Tuple
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+from environment import config
+from environment.models import Reading
+from environment.sync import UPDATED_FIELD, now
+
+# Readings written per insert_many call
+DEFAULT_CHUNK_SIZE = 500
+MAX_CHUNK_SIZE = 5000
+
+# MongoDB's error code for an insert whose _id is already stored
+DUPLICATE_KEY = 11000
+
+
+def parse_ndjson(body: bytes) -> List[Dict]:
+    """Parse newline-delimited JSON, one reading per non-empty line."""
+    items = []
+    for number, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError as e:
+            raise ValueError(f"Line {number} is not valid JSON: {e}")
+    return items
+
+
+def validate_batch(items: Iterable[Dict]) -> Tuple[List[Tuple[int, Dict]], List[Dict]]:
+    """
+    Validate a batch of readings in one pass.
+
+    Args:
+        items: Raw reading dictionaries
+
+    Returns:
+        tuple: ([(index, document), ...] ready to insert, [{"index", "error"}, ...])
+    """
+    documents = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            reading = Reading.model_validate(item)
+        except ValidationError as e:
+            errors.append({"index": index, "error": e.errors(include_url=False, include_input=False)})
+            continue
+        documents.append((index, config.prepare_reading(reading)))
+    return documents, errors
+
+
+def insert_chunk(chunk: List[Tuple[int, Dict]], retry: bool = False) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Write a chunk with one unordered insert_many.
+
+    An unordered insert keeps going past a failing document, so one bad
+    reading does not lose the rest of the chunk.
+
+    The documents are stamped with UPDATED_FIELD here rather than when they
+    were validated. A reading may wait in the ingest queue for longer than
+    sync.SETTLE_TIME, and /readings/sync clients would have moved their
+    watermark past a validation time by the time it is stored.
+
+    insert_many gives the documents their _id on the first attempt, so when
+    retry is set a duplicate key means an earlier attempt that raised had
+    already written the document, and it is counted as inserted.
+
+    Returns:
+        tuple: (inserted documents, [{"index", "error"}, ...])
+    """
+    documents = [document for _, document in chunk]
+    stamp = now()
+    for document in documents:
+        document[UPDATED_FIELD] = stamp
+    try:
+        config.get_collection(config.DATA_COLLECTION).insert_many(documents, ordered=False)
+        return documents, []
+    except BulkWriteError as e:
+        failed = {}
+        for write_error in e.details.get("writeErrors", []):
+            if retry and write_error.get("code") == DUPLICATE_KEY:
+                continue
+            failed[write_error["index"]] = write_error.get("errmsg", "write failed")
+        inserted = [document for position, (_, document) in enumerate(chunk) if position not in failed]
+        errors = [{"index": chunk[position][0], "error": message} for position, message in failed.items()]
+        return inserted, errors
+
+
+def ingest_readings(items: List[Dict], chunk_size: int = DEFAULT_CHUNK_SIZE) -> Dict:
+    """
+    Validate and store a batch of readings.
+
+    Args:
+        items: Raw reading dictionaries, e.g. a device's queued uploads
+        chunk_size (int): Readings written per insert_many call
+
+    Returns:
+        dict: Counts, per-item errors (by position in items) and throughput.
+        afterInsertFailed counts readings stored but not added to the tiles,
+        rollups or series, afterInsertErrors says why
+    """
+    chunk_size = max(1, min(chunk_size, MAX_CHUNK_SIZE))
+    start = time.perf_counter()
+
+    documents, errors = validate_batch(items)
+    inserted = 0
+    after_insert_failed = 0
+    after_insert_errors = []
+    for offset in range(0, len(documents), chunk_size):
+        chunk_inserted, chunk_errors = insert_chunk(documents[offset:offset + chunk_size])
+        inserted += len(chunk_inserted)
+        errors.extend(chunk_errors)
+        if chunk_inserted:
+            try:
+                config.after_insert(chunk_inserted)
+            except Exception as e:
+                # The readings are stored, so they are not reported as failed and
+                # the device does not send them again; rebuild_tiles etc. recover them
+                print(f"Error updating after ingest: {e}")
+                after_insert_failed += len(chunk_inserted)
+                after_insert_errors.append(str(e))
+
+    seconds = time.perf_counter() - start
+    return {
+        "received": len(items),
+        "inserted": inserted,
+        "failed": len(errors),
+        "errors": sorted(errors, key=lambda error: error["index"]),
+        "seconds": seconds,
+        "readingsPerSecond": inserted / seconds if seconds > 0 else None,
+        "afterInsertFailed": after_insert_failed,
+        "afterInsertErrors": after_insert_errors,
+    }
@@ -0,0 +1,211 @@
+import asyncio
+import time
+from collections import deque
+from typing import Dict, List, Optional
+from fastapi.concurrency import run_in_threadpool
+from environment import config
+from environment.ingest import insert_chunk
+
+# Readings waiting to be written before uploads are refused
+DEFAULT_MAX_QUEUE = 10000
+
+# A flush happens when this many readings are waiting...
+DEFAULT_FLUSH_SIZE = 500
+
+# ...or this many seconds after the first of them arrived
+DEFAULT_FLUSH_INTERVAL = 0.5
+
+# How long an upload waits for room in a full queue before being refused
+DEFAULT_ENQUEUE_TIMEOUT = 1.0
+
+# How often a waiting upload checks for room in a full queue
+ROOM_POLL_INTERVAL = 0.01
+
+# Flush latencies kept for the metrics
+LATENCY_WINDOW = 200
+
+# Backoff between attempts to write a batch, doubling up to the maximum.
+# A batch is retried for as long as the app runs, since its readings were
+# already acknowledged, and the full queue turns devices away meanwhile
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+
+# Attempts a batch gets once stop() has been called, before it is dropped
+STOP_ATTEMPTS = 3
+
+
+# Put on the queue by stop() to end the flusher
+_STOP = object()
+
+
+class QueueFull(Exception):
+    """Raised when the queue stays full for longer than the enqueue timeout."""
+
+
+class IngestQueue:
+    """
+    Write-behind buffer between the upload endpoints and MongoDB.
+
+    Uploads put validated documents on an asyncio.Queue and return straight away.
+    A background task takes them off in batches and writes each batch with one
+    insert_many, so a burst of devices costs a few large writes instead of one
+    round-trip per request.
+    """
+    def __init__(
+        self,
+        max_size: int = DEFAULT_MAX_QUEUE,
+        flush_size: int = DEFAULT_FLUSH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        enqueue_timeout: float = DEFAULT_ENQUEUE_TIMEOUT
+    ):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batch: List[Dict] = []  # taken off the queue, not yet written
+        self._stopping = False
+
+        # Counters exposed through metrics()
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0  # dropped: rejected by the database, or unwritten at shutdown
+        self.retries = 0
+        self.after_insert_failed = 0  # written, but not added to the tiles, rollups or series
+        self.flushes = 0
+        self.rejected = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+
+    async def start(self) -> None:
+        """Start the background flusher on the running event loop."""
+        # Unbounded: capacity is enforced by put_many against depth(), which
+        # also counts the batch the flusher is holding
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flusher once everything already queued has been written."""
+        if self._task is None:
+            return
+        # The sentinel goes behind every queued reading, so they are all flushed first
+        self._stopping = True
+        self._queue.put_nowait(_STOP)
+        await self._task
+        self._task = None
+
+    async def put_many(self, documents: List[Dict]) -> None:
+        """
+        Queue documents for writing, all or none of them.
+
+        Waits up to enqueue_timeout for room, then raises QueueFull so the
+        endpoint can tell the device to back off and resend the whole batch.
+        """
+        if self._queue is None:
+            raise RuntimeError("Ingest queue has not been started")
+        if len(documents) > self.max_size:
+            raise ValueError(f"Batch of {len(documents)} is larger than the queue ({self.max_size})")
+
+        deadline = time.monotonic() + self.enqueue_timeout
+        while self.max_size - self.depth() < len(documents):
+            if time.monotonic() >= deadline:
+                self.rejected += len(documents)
+                raise QueueFull("Ingest queue is full, retry later")
+            await asyncio.sleep(ROOM_POLL_INTERVAL)
+
+        # Nothing else runs between the check and here, so every put fits
+        for document in documents:
+            self._queue.put_nowait(document)
+        self.enqueued += len(documents)
+
+    async def _run(self) -> None:
+        while True:
+            # Block until something arrives, then collect until the batch is full or the window closes
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+            self._batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stopping = False
+            while len(self._batch) < self.flush_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                self._batch.append(item)
+            await self._flush(self._batch)
+            self._batch = []
+            if stopping:
+                return
+
+    async def _flush(self, batch: List[Dict]) -> None:
+        start = time.perf_counter()
+        inserted = await self._insert(batch)
+        if inserted:
+            try:
+                await run_in_threadpool(config.after_insert, inserted)
+            except Exception as e:
+                # The readings are stored, only what is derived from them missed
+                # them. Not retried, the tile and rollup updates are increments
+                # that may have partly landed; rebuild_tiles etc. recover them.
+                print(f"Error updating after ingest: {e}")
+                self.after_insert_failed += len(inserted)
+        self.flushes += 1
+        self._latencies.append(time.perf_counter() - start)
+
+    async def _insert(self, batch: List[Dict]) -> List[Dict]:
+        """Write a batch, retrying with backoff while the database is unavailable. Returns what was written."""
+        attempt = 0
+        while True:
+            try:
+                inserted, errors = await run_in_threadpool(insert_chunk, list(enumerate(batch)), attempt > 0)
+            except Exception as e:
+                attempt += 1
+                if self._stopping and attempt >= STOP_ATTEMPTS:
+                    print(f"Dropping {len(batch)} queued readings after {attempt} attempts: {e}")
+                    self.failed += len(batch)
+                    return []
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+                print(f"Error flushing ingest queue, retrying in {delay:.1f}s: {e}")
+                self.retries += 1
+                await asyncio.sleep(delay)
+                continue
+            # Documents the database rejected, e.g. a duplicate id, would fail again
+            self.written += len(inserted)
+            self.failed += len(errors)
+            return inserted
+
+    def depth(self) -> int:
+        """Readings accepted but not yet written."""
+        return (self._queue.qsize() if self._queue is not None else 0) + len(self._batch)
+
+    def metrics(self) -> Dict:
+        """Queue depth, counters and recent flush latencies (seconds)."""
+        latencies = sorted(self._latencies)
+        return {
+            "depth": self.depth(),
+            "maxSize": self.max_size,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "failed": self.failed,
+            "retries": self.retries,
+            "afterInsertFailed": self.after_insert_failed,
+            "rejected": self.rejected,
+            "flushes": self.flushes,
+            "flushLatency": {
+                "last": self._latencies[-1] if latencies else None,
+                "p50": latencies[len(latencies) // 2] if latencies else None,
+                "p99": latencies[int(len(latencies) * 0.99)] if latencies else None,
+                "max": latencies[-1] if latencies else None,
+            },
+        }
+
+
+# Shared by the upload endpoints, started and stopped by the app lifespan
+ingest_queue = IngestQueue()
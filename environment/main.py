@@ -1,16 +1,57 @@
-from fastapi import FastAPI, HTTPException,Depends, Body
-from fastapi.responses import FileResponse, HTMLResponse
-from environment.schemas import signup,login,input_data
+import json
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException,Depends, Body, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
+# environment.schemas is not in the repo, only the commented-out endpoints below used it
+# from environment.schemas import signup,login,input_data
 from dotenv import dotenv_values
 from pymongo import MongoClient
-from environment.config import add_user,add_reading,get_reading
-import numpy as np
+from bson import ObjectId
+from environment.config import add_user,add_reading,get_reading,get_db,get_collection,DATA_COLLECTION,TILES_COLLECTION,ROLLUPS_COLLECTION,USE_CHANGE_STREAM
+from environment.events import ChangeStreamWatcher, bus
+from environment import database
+from environment.cache import make_key, response_cache
+from environment.geo import tile_bounds
+from environment.ingest import DEFAULT_CHUNK_SIZE, ingest_readings, parse_ndjson, validate_batch
+from environment.ingest_queue import QueueFull, ingest_queue
+from environment.indexes import apply_indexes
+from environment.pagination import DEFAULT_PAGE_SIZE
+from environment.rollups import MAX_ROLLUPS, get_rollups
+from environment.sync import DEFAULT_SYNC_LIMIT, get_changes
+from environment.tiles import DEFAULT_DETAIL, get_tile_cells
+from environment.queries import DEFAULT_BATCH_SIZE, iter_ndjson, viewport_bbox, viewport_filter, viewport_options
+from datetime import datetime
+from typing import Optional
 
 
 #config
 config = dotenv_values(".env")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled async client for the whole app
+    await database.connect()
+
+    # Declared indexes, a no-op once they exist
+    apply_indexes(get_db())
+    collection_data = get_collection(DATA_COLLECTION)
+
+    # Push inserts to the live map as they happen
+    watcher = ChangeStreamWatcher(collection_data, bus)
+    if USE_CHANGE_STREAM:
+        watcher.start()
+
+    # Background writer for queued uploads, drained on shutdown
+    await ingest_queue.start()
+    yield
+    await ingest_queue.stop()
+    watcher.stop()
+    await database.close()
+
 #create app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 #endpoint for registering
 # @app.post("/register")
@@ -39,31 +80,171 @@ async def root():
     
 #     return {"message": "Data uploaded successfully"}
 
+async def read_upload(request: Request):
+    # Accepts a JSON reading or array of readings, or NDJSON with one reading per line
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            items = parse_ndjson(body)
+        else:
+            items = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Expected a reading or a JSON array of readings")
+    return items
+
+#endpoint for uploading a batch of readings, e.g. a device's queue after being offline
+@app.post("/readings/bulk")
+async def bulk_upload(request: Request, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    items = await read_upload(request)
+
+    # Validation and the Mongo writes are blocking, keep them off the event loop
+    return await run_in_threadpool(ingest_readings, items, chunk_size)
+
+#endpoint for uploading readings without waiting for the database
+@app.post("/readings", status_code=202)
+async def queue_upload(request: Request):
+    items = await read_upload(request)
+    documents, errors = await run_in_threadpool(validate_batch, items)
+    try:
+        await ingest_queue.put_many([document for _, document in documents])
+    except QueueFull as e:
+        return JSONResponse(status_code=503, content={"detail": str(e)}, headers={"Retry-After": "1"})
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return {"received": len(items), "queued": len(documents), "failed": len(errors), "errors": errors}
+
+@app.get("/metrics/ingest")
+async def ingest_metrics():
+    return ingest_queue.metrics()
+
+async def cached_json(request: Request, key: str, scope, compute):
+    # Serve the cached body if there is one, computing and caching it otherwise.
+    # Clients sending back the ETag they were given get a 304 while nothing in scope has changed.
+    entry = await run_in_threadpool(response_cache.get, key)
+    if entry is None:
+        body = json.dumps(jsonable_encoder(await compute())).encode()
+        entry = await run_in_threadpool(response_cache.set, key, body, scope)
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == entry.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
+
 @app.get("/getreading")
-def recieve_reading():
-    readings = get_reading()
-    # Extract latitude, longitude, and average chloride value
-    results = []
-    for reading in readings:
-        #print(reading)
-        latitude = reading['location']['latitude']
-        longitude = reading['location']['longitude']
-        
-        # Find the chloride measurement and calculate its average
-        chloride_measurement = next(
-            (m for m in reading['measurements'] if m['name'] == 'chloride'), None
+async def recieve_reading(
+    request: Request,
+    measurement: str = "chloride",
+    stream: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    bbox: Optional[str] = None,
+    zoom: Optional[int] = None,
+    tile: Optional[str] = None
+):
+    # Latitude, longitude and the average of the measurement, computed by MongoDB.
+    # bbox/tile restrict the query to the viewport, zoom clusters nearby readings.
+    try:
+        options = viewport_options(bbox, zoom, tile)
+        if stream:
+            # One [lat, lon, value] row per line, sent as the cursor is read
+            rows = database.iter_measurement_points(measurement, batch_size=max(1, batch_size), **options)
+            return StreamingResponse(iter_ndjson(rows), media_type="application/x-ndjson")
+        key = make_key("getreading", measurement=measurement, bbox=bbox, zoom=zoom, tile=tile)
+        return await cached_json(
+            request, key, viewport_bbox(bbox, tile),
+            lambda: database.get_measurement_points(measurement, **options)
         )
-        if chloride_measurement:
-            chloride_avg = sum(chloride_measurement['values']) / len(chloride_measurement['values'])
-        else:
-            chloride_avg = None
-        
-        results.append((latitude,  longitude,chloride_avg))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/tiles/{z}/{x}/{y}")
+async def get_tile(request: Request, z: int, x: int, y: int, detail: int = DEFAULT_DETAIL, measurement: Optional[str] = None):
+    # Pre-aggregated cells under the tile, kept up to date as readings are added
+    async def compute():
+        cells = await run_in_threadpool(get_tile_cells, get_collection(TILES_COLLECTION), z, x, y, detail, measurement)
+        return {"z": z, "x": x, "y": y, "cells": cells}
+
+    try:
+        key = make_key("tiles", z=z, x=x, y=y, detail=detail, measurement=measurement)
+        return await cached_json(request, key, tile_bounds(z, x, y), compute)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/stats")
+def reading_statistics(
+    group_by: Optional[str] = None,
+    bbox: Optional[str] = None,
+    tile: Optional[str] = None,
+    percentiles: Optional[str] = None
+):
+    # Mean, median, min, max, std and percentiles of every measurement, per uid, region or day
+    # Imported here so NumPy is only loaded once statistics are asked for
+    from environment.stats import DEFAULT_PERCENTILES, get_stats
+    try:
+        points = [float(p) for p in percentiles.split(",")] if percentiles else DEFAULT_PERCENTILES
+        match = viewport_filter(bbox, tile)
+        groups = get_stats(get_collection(DATA_COLLECTION), group_by, match, points)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"groupBy": group_by, "groups": groups}
+
+@app.get("/rollups")
+def rollups(
+    scope: str = "uid",
+    period: str = "day",
+    key: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    measurement: Optional[str] = None,
+    limit: int = MAX_ROLLUPS
+):
+    # Hourly or daily aggregates per device or geohash cell, kept up to date as readings are added
+    try:
+        results = get_rollups(get_collection(ROLLUPS_COLLECTION), scope, period, key, start, end, measurement, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"scope": scope, "period": period, "rollups": results}
+
+@app.get("/readings/events")
+async def reading_events(request: Request):
+    # Server-Sent Events, one "data:" line per new reading
+    return StreamingResponse(
+        bus.stream(request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+def split_fields(fields: Optional[str]):
+    # "uid,location" -> ["uid", "location"]
+    return [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+
+#endpoints for listing readings a page at a time, pass "next" back as cursor for the following page
+@app.get("/readings")
+async def list_readings(cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE, fields: Optional[str] = None):
+    try:
+        page = await database.get_reading(cursor, limit, split_fields(fields))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return jsonable_encoder(page, custom_encoder={ObjectId: str})
 
-    # Print the results
-    #print(results)
+@app.get("/readings/uid/{uid}")
+async def readings_by_uid(uid: str, cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE, fields: Optional[str] = None):
+    try:
+        page = await database.get_reading_by_uid(uid, cursor, limit, split_fields(fields))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return jsonable_encoder(page, custom_encoder={ObjectId: str})
 
-    return results
+@app.get("/readings/sync")
+def sync_readings(watermark: Optional[str] = None, limit: int = DEFAULT_SYNC_LIMIT):
+    # Readings added or changed since the watermark returned by the previous call
+    try:
+        changes = get_changes(get_collection(DATA_COLLECTION), watermark, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return jsonable_encoder(changes, custom_encoder={ObjectId: str})
 
 # Base and Map View Endpoints
 @app.get("/")
@@ -0,0 +1,30 @@
+from typing import Any, List, Literal, Optional, get_args
+from pydantic import BaseModel, Field
+
+# Measurement names recorded by the devices. The tiles and rollups use them as
+# field names, so anything else (an empty name, a "$" or a ".") is rejected
+MeasurementName = Literal["chloride", "ph", "temperature", "turbidity"]
+MEASUREMENT_NAMES = get_args(MeasurementName)
+
+
+class Location(BaseModel):
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+
+
+class Measurement(BaseModel):
+    name: MeasurementName
+    values: List[float]
+
+
+class Reading(BaseModel):
+    """A device reading as uploaded by the app."""
+    id: str
+    uid: str
+    # Format is set by the app, stored as given
+    datetime: Any = None
+    hasSynced: bool = False
+    isSafe: Optional[bool] = None
+    location: Location
+    measurements: List[Measurement]
+    timeIntervals: List[float] = []
@@ -0,0 +1,124 @@
+import base64
+from typing import Dict, Iterator, List, Optional, Sequence
+import bson
+from pymongo import ASCENDING
+
+# Readings are paged in (SORT_FIELD, _id) order
+SORT_FIELD = "datetime"
+PAGE_SORT = [(SORT_FIELD, ASCENDING), ("_id", ASCENDING)]
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# MongoDB sorts values of different types in this order. datetime is stored
+# as the app sent it, so a page can end on any JSON type and the next page must
+# also pick up every value of a later type, which $gt alone does not match.
+# Arrays sort by their elements and cannot be paged through this way.
+TYPE_ORDER = [
+    ["null"],
+    ["double", "int", "long", "decimal"],
+    ["string"],
+    ["object"],
+    ["bool"],
+    ["date"],
+]
+
+
+def type_rank(value) -> int:
+    """Position of a value's type in TYPE_ORDER."""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 4
+    if isinstance(value, (int, float, bson.Int64, bson.Decimal128)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    return 5
+
+
+def encode_cursor(last: Dict) -> str:
+    """Opaque token for the position after the last document of a page."""
+    raw = bson.encode({"v": last.get(SORT_FIELD), "i": last["_id"]})
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str) -> Dict:
+    """Filter matching the documents after an encode_cursor token, raises ValueError for anything else."""
+    try:
+        position = bson.decode(base64.urlsafe_b64decode(cursor.encode()))
+        value, last_id = position["v"], position["i"]
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+    after = [{SORT_FIELD: value, "_id": {"$gt": last_id}}]
+    if value is not None:
+        after.append({SORT_FIELD: {"$gt": value}})
+    for names in TYPE_ORDER[type_rank(value) + 1:]:
+        after.extend({SORT_FIELD: {"$type": name}} for name in names)
+    return {"$or": after}
+
+
+def projection(fields: Optional[Sequence[str]]) -> Optional[Dict]:
+    """Projection for the requested fields, keeping the ones the cursor is built from."""
+    if not fields:
+        return None
+    return dict.fromkeys(list(fields) + [SORT_FIELD, "_id"], 1)
+
+
+def page_query(query: Optional[Dict] = None, cursor: Optional[str] = None) -> Dict:
+    """Combine a filter with the position a cursor token continues from."""
+    if not cursor:
+        return query or {}
+    after = decode_cursor(cursor)
+    return {"$and": [query, after]} if query else after
+
+
+def clamp_page_size(limit: int) -> int:
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def make_page(documents: List[Dict], limit: int) -> Dict:
+    """Split the limit + 1 documents fetched for a page into the page and its next cursor."""
+    next_cursor = encode_cursor(documents[limit - 1]) if len(documents) > limit else None
+    return {"readings": documents[:limit], "next": next_cursor}
+
+
+def get_page(collection, query: Optional[Dict] = None, cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE, fields: Optional[Sequence[str]] = None) -> Dict:
+    """
+    Fetch one page of documents in (datetime, _id) order.
+
+    Args:
+        collection: Collection to query
+        query (dict, optional): Filter on the documents
+        cursor (str, optional): The "next" token of the previous page, None for the first page
+        limit (int): Page size, capped at MAX_PAGE_SIZE
+        fields (list, optional): Only return these fields (plus datetime and _id)
+
+    Returns:
+        dict: {"readings": [...], "next": str or None}, next is None on the last page
+    """
+    limit = clamp_page_size(limit)
+    documents = list(
+        collection.find(page_query(query, cursor), projection(fields)).sort(PAGE_SORT).limit(limit + 1)
+    )
+    return make_page(documents, limit)
+
+
+def iter_documents(collection, query: Optional[Dict] = None, fields: Optional[Sequence[str]] = None, page_size: int = MAX_PAGE_SIZE) -> Iterator[Dict]:
+    """
+    Walk every matching document one page at a time.
+
+    Each page is its own short query continuing from the last, so memory
+    stays at one page and no server cursor is held open between pages, however
+    long the caller takes over each document.
+    """
+    cursor = None
+    while True:
+        page = get_page(collection, query, cursor, page_size, fields)
+        yield from page["readings"]
+        cursor = page["next"]
+        if cursor is None:
+            return
@@ -0,0 +1,157 @@
+import json
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from environment import config
+from environment.geo import BBox, bbox_filter, geohash_precision_for_zoom, parse_bbox, parse_tile, tile_bounds, tile_filter
+from environment.models import MEASUREMENT_NAMES
+
+# Documents fetched per round-trip when streaming
+DEFAULT_BATCH_SIZE = 500
+
+
+def measurement_pipeline(name: str, match: Optional[Dict] = None, cluster_precision: Optional[int] = None) -> List[Dict]:
+    """
+    Build the aggregation pipeline that averages one measurement per reading.
+
+    The projection, the filter on the measurement name and the average all run
+    inside MongoDB, so only (latitude, longitude, value) leaves the database.
+
+    Args:
+        name (str): Measurement to average (chloride, ph, temperature, turbidity).
+        match (dict, optional): Extra filter applied before the projection.
+        cluster_precision (int, optional): If given, readings sharing a geohash
+            prefix of this length are merged into one averaged row.
+
+    Returns:
+        List[Dict]: The pipeline stages.
+    """
+    if name not in MEASUREMENT_NAMES:
+        raise ValueError(f"Unknown measurement: {name}")
+
+    pipeline = []
+    if match:
+        pipeline.append({"$match": match})
+
+    pipeline.append({
+        "$project": {
+            "_id": 0,
+            "latitude": "$location.latitude",
+            "longitude": "$location.longitude",
+            "geohash": 1,
+            # Pick the {name, values} entry for this measurement out of the array
+            "measurement": {
+                "$arrayElemAt": [
+                    {
+                        "$filter": {
+                            "input": "$measurements",
+                            "as": "m",
+                            "cond": {"$eq": ["$$m.name", name]},
+                        }
+                    },
+                    0,
+                ]
+            },
+        }
+    })
+    pipeline.append({
+        "$project": {
+            "latitude": 1,
+            "longitude": 1,
+            "geohash": 1,
+            "value": {"$avg": "$measurement.values"},
+        }
+    })
+    if cluster_precision:
+        pipeline.append({
+            "$group": {
+                # Geohashes are ASCII, so $substr (which mongomock also supports) is safe
+                "_id": {"$substr": ["$geohash", 0, cluster_precision]},
+                "latitude": {"$avg": "$latitude"},
+                "longitude": {"$avg": "$longitude"},
+                "value": {"$avg": "$value"},
+            }
+        })
+    return pipeline
+
+
+def viewport_bbox(bbox: Optional[str] = None, tile: Optional[str] = None) -> Optional[BBox]:
+    """The area the bbox or tile query parameter covers, None for the whole world."""
+    if tile:
+        return tile_bounds(*parse_tile(tile))
+    return parse_bbox(bbox) if bbox else None
+
+
+def viewport_filter(bbox: Optional[str] = None, tile: Optional[str] = None) -> Dict:
+    """
+    Query filter for the bbox or tile query parameter, empty for the whole world.
+
+    Tiles are matched on the indexed tile key, which works against any server.
+    A bbox compares the coordinates, narrowed by $geoWithin where config.GEO_QUERIES allows it.
+    """
+    if tile:
+        return tile_filter(*parse_tile(tile))
+    return bbox_filter(parse_bbox(bbox), config.GEO_QUERIES) if bbox else {}
+
+
+def viewport_options(bbox: Optional[str] = None, zoom: Optional[int] = None, tile: Optional[str] = None) -> Dict:
+    """
+    Turn the bbox, zoom and tile query parameters into pipeline options.
+
+    Args:
+        bbox (str, optional): "min_lon,min_lat,max_lon,max_lat" to restrict to
+        zoom (int, optional): Map zoom, readings are clustered to cells of that size
+        tile (str, optional): "z/x/y" tile to restrict to, implies zoom z if none given
+
+    Returns:
+        dict: match and cluster_precision keyword arguments for the query functions
+    """
+    if tile and zoom is None:
+        zoom = parse_tile(tile)[0]
+    return {
+        "match": viewport_filter(bbox, tile),
+        "cluster_precision": geohash_precision_for_zoom(zoom) if zoom is not None else None,
+    }
+
+
+def to_point(doc: Dict) -> Tuple[float, float, Optional[float]]:
+    """Convert a pipeline result document into a (latitude, longitude, value) row."""
+    return (doc.get("latitude"), doc.get("longitude"), doc.get("value"))
+
+
+def get_measurement_points(name: str = "chloride", collection=None, match: Optional[Dict] = None, cluster_precision: Optional[int] = None) -> List[Tuple[float, float, Optional[float]]]:
+    """
+    Fetch the average of a measurement for every reading.
+
+    Args:
+        name (str): Measurement to average.
+        collection (optional): Collection to query, defaults to the readings collection.
+        match, cluster_precision: See measurement_pipeline.
+
+    Returns:
+        List[Tuple]: (latitude, longitude, value) rows, value is None if the
+        reading has no such measurement.
+    """
+    if collection is None:
+        collection = config.get_collection(config.DATA_COLLECTION)
+    pipeline = measurement_pipeline(name, match, cluster_precision)
+    return [to_point(doc) for doc in collection.aggregate(pipeline)]
+
+
+def iter_measurement_points(name: str = "chloride", batch_size: int = DEFAULT_BATCH_SIZE, collection=None, match: Optional[Dict] = None, cluster_precision: Optional[int] = None) -> Iterator[Tuple[float, float, Optional[float]]]:
+    """
+    Lazily yield the same rows as get_measurement_points.
+
+    The cursor is consumed batch_size documents at a time, so memory use stays
+    the same however many readings there are.
+    """
+    if collection is None:
+        collection = config.get_collection(config.DATA_COLLECTION)
+    # Build the pipeline now so an unknown measurement raises before streaming starts
+    pipeline = measurement_pipeline(name, match, cluster_precision)
+    cursor = collection.aggregate(pipeline, batchSize=batch_size)
+    return (to_point(doc) for doc in cursor)
+
+
+async def iter_ndjson(rows) -> AsyncIterator[str]:
+    """Encode rows from an async iterator as newline-delimited JSON, one row per line."""
+    async for row in rows:
+        yield json.dumps(row) + "\n"
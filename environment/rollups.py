@@ -0,0 +1,150 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from pymongo import ASCENDING, UpdateOne
+from environment.geo import geohash_encode
+from environment.sync import UPDATED_FIELD, reading_time
+from environment.tiles import aggregate_update, measurement_summaries, merge_summaries, rebuild_collection
+
+# Length of each rollup period in milliseconds
+PERIODS = {
+    "hour": 60 * 60 * 1000,
+    "day": 24 * 60 * 60 * 1000,
+}
+
+# What a rollup is kept per: a device, or a geohash cell of CELL_PRECISION characters (~5 x 5 km)
+SCOPES = ("uid", "cell")
+CELL_PRECISION = 5
+
+# Rollups returned by one query at most
+MAX_ROLLUPS = 5000
+
+
+def cell_key(reading: Dict) -> str:
+    geohash = reading.get("geohash")
+    if not geohash:
+        geohash = geohash_encode(reading["location"]["latitude"], reading["location"]["longitude"])
+    return geohash[:CELL_PRECISION]
+
+
+def period_start(millis: float, period: str) -> datetime:
+    """Start of the period containing a time, as the naive UTC datetime MongoDB stores."""
+    span = PERIODS[period]
+    start = millis // span * span
+    return datetime.fromtimestamp(start / 1000, timezone.utc).replace(tzinfo=None)
+
+
+def rollup_updates(readings: List[Dict]) -> List[UpdateOne]:
+    """
+    Upserts adding readings to their hourly and daily rollups, per device and per cell.
+
+    Readings sharing a rollup are merged first, so a batch costs one write per
+    distinct rollup document.
+    """
+    rollups = {}
+    for reading in readings:
+        millis = reading_time(reading)
+        keys = {"uid": reading["uid"], "cell": cell_key(reading)}
+        summaries = measurement_summaries(reading.get("measurements", []))
+        for period in PERIODS:
+            start = period_start(millis, period)
+            for scope in SCOPES:
+                count, total = rollups.setdefault((scope, keys[scope], period, start), [0, {}])
+                rollups[(scope, keys[scope], period, start)][0] = count + 1
+                merge_summaries(total, summaries)
+
+    requests = []
+    for (scope, key, period, start), (count, total) in rollups.items():
+        update = aggregate_update(total, readings=count)
+        update["$setOnInsert"] = {"scope": scope, "key": key, "period": period, "start": start}
+        rollup_id = f"{scope}:{key}:{period}:{start.isoformat()}"
+        requests.append(UpdateOne({"_id": rollup_id}, update, upsert=True))
+    return requests
+
+
+def update_rollups(collection, readings: List[Dict]) -> None:
+    """Add newly inserted readings to the rollups."""
+    requests = rollup_updates(readings)
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+
+
+def rollup_summary(rollup: Dict, measurement: Optional[str] = None) -> Dict:
+    """Shape a stored rollup for the API, adding its measurement means."""
+    measurements = {}
+    for name, aggregate in rollup.get("measurements", {}).items():
+        if measurement is not None and name != measurement:
+            continue
+        measurements[name] = dict(aggregate, mean=aggregate["sum"] / aggregate["count"])
+    return {
+        "scope": rollup["scope"],
+        "key": rollup["key"],
+        "period": rollup["period"],
+        "start": rollup["start"],
+        "readings": rollup.get("readings", 0),
+        "measurements": measurements,
+    }
+
+
+def get_rollups(
+    collection,
+    scope: str = "uid",
+    period: str = "day",
+    key: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    measurement: Optional[str] = None,
+    limit: int = MAX_ROLLUPS
+) -> List[Dict]:
+    """
+    Fetch rollups in time order.
+
+    Args:
+        collection: The rollups collection
+        scope (str): "uid" or "cell"
+        period (str): "hour" or "day"
+        key (str, optional): Device uid or geohash cell, None for all of them
+        start, end (datetime, optional): Only periods starting in [start, end)
+        measurement (str, optional): Only return this measurement's aggregates
+        limit (int): Most rollups returned, capped at MAX_ROLLUPS
+
+    Returns:
+        List[Dict]: One summary per rollup
+    """
+    if scope not in SCOPES:
+        raise ValueError(f"Unknown scope: {scope}")
+    if period not in PERIODS:
+        raise ValueError(f"Unknown period: {period}")
+
+    query = {"scope": scope, "period": period}
+    if key is not None:
+        query["key"] = key
+    if start is not None or end is not None:
+        query["start"] = {}
+        if start is not None:
+            query["start"]["$gte"] = start
+        if end is not None:
+            query["start"]["$lt"] = end
+
+    cursor = collection.find(query).sort([("key", ASCENDING), ("start", ASCENDING)])
+    cursor = cursor.limit(max(1, min(limit, MAX_ROLLUPS)))
+    return [rollup_summary(rollup, measurement) for rollup in cursor]
+
+
+def rebuild_rollups(readings_collection, rollups_collection, batch_size: int = 500) -> int:
+    """
+    Rebuild the rollups from the stored readings, for data inserted before they existed.
+
+    The rebuild is swapped in once complete, stop ingestion first, see tiles.rebuild_collection.
+
+    Returns:
+        int: Number of readings added to the rollups
+    """
+    fields = {"uid": 1, "datetime": 1, UPDATED_FIELD: 1, "location": 1, "geohash": 1, "measurements": 1}
+    return rebuild_collection(readings_collection, rollups_collection, fields, update_rollups, batch_size)
+
+
+if __name__ == "__main__":
+    # Backfill job: python -m environment.rollups
+    from environment import config
+    added = rebuild_rollups(config.get_collection(config.DATA_COLLECTION), config.get_collection(config.ROLLUPS_COLLECTION))
+    print(f"Rolled up {added} readings")
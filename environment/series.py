@@ -0,0 +1,266 @@
+import hashlib
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from bson import Binary
+from pymongo.errors import DuplicateKeyError
+
+from environment.sync import UPDATED_FIELD, reading_time
+from environment.tiles import rebuild_collection
+
+# Values of one sensor of one device are grouped into buckets covering this many milliseconds
+BUCKET_SPAN_MS = 60 * 60 * 1000
+
+# timeIntervals are offsets in seconds from the reading's datetime
+TIME_INTERVAL_MS = 1000
+
+# Packed arrays are little-endian float64 whatever the server's byte order
+DTYPE = np.dtype("<f8")
+
+# Set by compact_series on the buckets it is merging, to the _id of the merged bucket
+COMPACTED_INTO = "compactedInto"
+
+
+def pack(values) -> Binary:
+    return Binary(np.asarray(values, dtype=DTYPE).tobytes())
+
+
+def unpack(data: bytes) -> np.ndarray:
+    # A read-only view onto the stored bytes, nothing is decoded value by value
+    return np.frombuffer(data, dtype=DTYPE)
+
+
+def make_bucket(uid: str, name: str, times: np.ndarray, values: np.ndarray) -> Dict:
+    """Bucket document for samples already sorted by time and within one hour."""
+    return {
+        "uid": uid,
+        "name": name,
+        "start": int(times[0] // BUCKET_SPAN_MS * BUCKET_SPAN_MS),
+        "first": float(times[0]),
+        "last": float(times[-1]),
+        "count": len(values),
+        "sum": float(values.sum()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "times": pack(times),
+        "values": pack(values),
+    }
+
+
+def series_buckets(readings: List[Dict]) -> List[Dict]:
+    """
+    Convert readings into columnar bucket documents, one per device, sensor and hour.
+
+    Each bucket holds the sample times and values as packed float64 arrays
+    plus their count, sum, min and max, so a sensor can be scanned without
+    reading the others and whole buckets can be summarised without decoding.
+
+    Args:
+        readings (List[Dict]): Reading documents as stored in the readings collection
+
+    Returns:
+        List[Dict]: Bucket documents ready for insert_many
+    """
+    series = defaultdict(lambda: ([], []))
+    for reading in readings:
+        start = reading_time(reading)
+        intervals = reading.get("timeIntervals") or []
+        for measurement in reading["measurements"]:
+            values = measurement["values"]
+            if not values:
+                continue
+            # Missing intervals are taken as one second apart
+            offsets = intervals if len(intervals) == len(values) else range(len(values))
+            times, samples = series[(reading["uid"], measurement["name"])]
+            times.extend(start + offset * TIME_INTERVAL_MS for offset in offsets)
+            samples.extend(values)
+
+    buckets = []
+    for (uid, name), (times, samples) in series.items():
+        times = np.asarray(times, dtype=DTYPE)
+        samples = np.asarray(samples, dtype=DTYPE)
+        order = np.argsort(times, kind="stable")
+        times, samples = times[order], samples[order]
+
+        # Split wherever the hour changes
+        keys = (times // BUCKET_SPAN_MS).astype(np.int64)
+        edges = np.flatnonzero(np.diff(keys)) + 1
+        for bucket_times, bucket_values in zip(np.split(times, edges), np.split(samples, edges)):
+            buckets.append(make_bucket(uid, name, bucket_times, bucket_values))
+    return buckets
+
+
+def write_series(collection, readings: List[Dict]) -> None:
+    """
+    Append newly inserted readings to the series collection.
+
+    Buckets are inserted rather than merged into existing ones, so a device
+    uploading several times in an hour has several buckets for it. The loader
+    concatenates them and compact_series can merge them later.
+    """
+    buckets = series_buckets(readings)
+    if buckets:
+        collection.insert_many(buckets, ordered=False)
+
+
+def series_filter(uid: Optional[str], name: str, start: Optional[float] = None, end: Optional[float] = None) -> Dict:
+    query = {"name": name}
+    if uid is not None:
+        query["uid"] = uid
+    if start is not None:
+        query["last"] = {"$gte": start}
+    if end is not None:
+        query["first"] = {"$lt": end}
+    return query
+
+
+def current_buckets(buckets: List[Dict]) -> List[Dict]:
+    """
+    Drop the buckets already merged into another one that is also in the list.
+
+    A merged bucket spans all of its sources, so any query that finds a
+    source finds the merged bucket too, and a compaction interrupted or still
+    running never counts samples twice.
+    """
+    ids = {bucket["_id"] for bucket in buckets}
+    return [bucket for bucket in buckets if bucket.get(COMPACTED_INTO) not in ids]
+
+
+def in_range(times: np.ndarray, start: Optional[float], end: Optional[float]) -> np.ndarray:
+    keep = np.ones(len(times), dtype=bool)
+    if start is not None:
+        keep &= times >= start
+    if end is not None:
+        keep &= times < end
+    return keep
+
+
+def load_series(collection, uid: Optional[str], name: str, start: Optional[float] = None, end: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load one sensor's samples as NumPy arrays.
+
+    Args:
+        collection: The series collection
+        uid (str, optional): Device to load, None for every device
+        name (str): Sensor to load (chloride, ph, temperature, turbidity)
+        start, end (float, optional): Time range in epoch milliseconds, end exclusive
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Sample times (epoch milliseconds) and values, ordered by time
+    """
+    buckets = current_buckets(list(collection.find(series_filter(uid, name, start, end), {"times": 1, "values": 1, COMPACTED_INTO: 1})))
+    if not buckets:
+        return np.empty(0, dtype=DTYPE), np.empty(0, dtype=DTYPE)
+
+    times = np.concatenate([unpack(bucket["times"]) for bucket in buckets])
+    values = np.concatenate([unpack(bucket["values"]) for bucket in buckets])
+    order = np.argsort(times, kind="stable")
+    times, values = times[order], values[order]
+    keep = in_range(times, start, end)
+    return times[keep], values[keep]
+
+
+def summarise_series(collection, uid: Optional[str], name: str, start: Optional[float] = None, end: Optional[float] = None) -> Dict:
+    """
+    Count, sum, min, max and mean of one sensor over a time range.
+
+    Buckets entirely inside the range are summarised from their stored
+    totals, only those straddling an edge of the range are decoded.
+    """
+    count, total, low, high = 0, 0.0, None, None
+    fields = {"first": 1, "last": 1, "count": 1, "sum": 1, "min": 1, "max": 1, COMPACTED_INTO: 1}
+    for bucket in current_buckets(list(collection.find(series_filter(uid, name, start, end), fields))):
+        if (start is None or bucket["first"] >= start) and (end is None or bucket["last"] < end):
+            summary = (bucket["count"], bucket["sum"], bucket["min"], bucket["max"])
+        else:
+            packed = collection.find_one({"_id": bucket["_id"]}, {"times": 1, "values": 1})
+            values = unpack(packed["values"])[in_range(unpack(packed["times"]), start, end)]
+            if not len(values):
+                continue
+            summary = (len(values), float(values.sum()), float(values.min()), float(values.max()))
+        count += summary[0]
+        total += summary[1]
+        low = summary[2] if low is None else min(low, summary[2])
+        high = summary[3] if high is None else max(high, summary[3])
+    return {"count": count, "sum": total, "min": low, "max": high, "mean": total / count if count else None}
+
+
+def merged_id(ids: List) -> str:
+    """_id of the bucket merging these buckets, the same whichever run computes it."""
+    return "compact:" + hashlib.sha1(",".join(sorted(str(i) for i in ids)).encode()).hexdigest()
+
+
+def merge_buckets(collection, uid: str, name: str, bucket_id: str) -> None:
+    """
+    Write the bucket claimed sources are merged into, then delete the sources.
+
+    Safe to repeat, or to run from two places at once: the merged bucket is
+    the same whoever writes it, and only the first insert lands.
+    """
+    if collection.find_one({"_id": bucket_id}, {"_id": 1}) is None:
+        buckets = list(collection.find({COMPACTED_INTO: bucket_id}, {"times": 1, "values": 1}))
+        if not buckets:
+            return
+        times = np.concatenate([unpack(bucket["times"]) for bucket in buckets])
+        values = np.concatenate([unpack(bucket["values"]) for bucket in buckets])
+        order = np.argsort(times, kind="stable")
+        merged = make_bucket(uid, name, times[order], values[order])
+        merged["_id"] = bucket_id
+        try:
+            collection.insert_one(merged)
+        except DuplicateKeyError:
+            pass
+    collection.delete_many({COMPACTED_INTO: bucket_id})
+
+
+def compact_series(collection, uid: str, name: str) -> int:
+    """
+    Merge the buckets of one device and sensor that share an hour.
+
+    Each merge first claims its source buckets by setting COMPACTED_INTO, then
+    inserts the merged bucket and deletes the sources. A run that stops part
+    way is finished by the next one, and readers skip sources whose merged
+    bucket exists (see current_buckets), so nothing is lost or counted twice.
+    Sources another run has claimed first are left to it.
+
+    Returns:
+        int: Number of buckets removed
+    """
+    removed = 0
+    pipeline = [
+        {"$match": {"uid": uid, "name": name}},
+        {"$group": {"_id": "$start", "ids": {"$push": "$_id"}, "claims": {"$addToSet": "$" + COMPACTED_INTO}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ]
+    for group in list(collection.aggregate(pipeline)):
+        # Finish merges an earlier run claimed but did not complete
+        for bucket_id in group["claims"]:
+            if bucket_id is not None:
+                merge_buckets(collection, uid, name, bucket_id)
+
+        ids = [bucket["_id"] for bucket in collection.find({"uid": uid, "name": name, "start": group["_id"], COMPACTED_INTO: {"$exists": False}}, {"_id": 1})]
+        if len(ids) < 2:
+            continue
+        bucket_id = merged_id(ids)
+        claimed = collection.update_many({"_id": {"$in": ids}, COMPACTED_INTO: {"$exists": False}}, {"$set": {COMPACTED_INTO: bucket_id}})
+        if claimed.modified_count < len(ids):
+            # Another run got to some of them, hand back the rest
+            collection.update_many({COMPACTED_INTO: bucket_id}, {"$unset": {COMPACTED_INTO: ""}})
+            continue
+        merge_buckets(collection, uid, name, bucket_id)
+        removed += len(ids) - 1
+    return removed
+
+
+def rebuild_series(readings_collection, series_collection, batch_size: int = 500) -> int:
+    """
+    Rebuild the series collection from the stored readings.
+
+    The rebuild is swapped in once complete, stop ingestion first, see tiles.rebuild_collection.
+
+    Returns:
+        int: Number of readings written as series
+    """
+    fields = {"uid": 1, "datetime": 1, UPDATED_FIELD: 1, "measurements": 1, "timeIntervals": 1}
+    return rebuild_collection(readings_collection, series_collection, fields, write_series, batch_size)
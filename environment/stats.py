@@ -0,0 +1,182 @@
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from environment import config
+from environment.geo import geohash_encode
+from environment.queries import DEFAULT_BATCH_SIZE, MEASUREMENT_NAMES
+from environment.sync import UPDATED_FIELD, reading_time
+
+# Percentiles reported alongside the median unless others are asked for
+DEFAULT_PERCENTILES = (5, 25, 75, 95)
+
+# Geohash length of the "region" grouping, cells of roughly 39 x 20 km
+REGION_PRECISION = 4
+
+# Ragged values are flattened into one array per measurement; reading i's
+# values are values[offsets[i]:offsets[i + 1]]
+RaggedArray = Tuple[np.ndarray, np.ndarray]
+
+
+def region_key(reading: Dict) -> str:
+    geohash = reading.get("geohash")
+    if not geohash:
+        geohash = geohash_encode(reading["location"]["latitude"], reading["location"]["longitude"])
+    return geohash[:REGION_PRECISION]
+
+
+def day_key(reading: Dict) -> str:
+    return datetime.fromtimestamp(reading_time(reading) / 1000, timezone.utc).date().isoformat()
+
+
+# How readings are grouped for each /stats group_by value
+GROUP_KEYS: Dict[str, Callable[[Dict], str]] = {
+    "uid": lambda reading: reading["uid"],
+    "region": region_key,
+    "day": day_key,
+}
+
+
+def to_arrays(readings: Iterable[Dict], group_by: Optional[str] = None) -> Tuple[np.ndarray, List[str], Dict[str, RaggedArray]]:
+    """
+    Flatten readings into contiguous NumPy arrays.
+
+    Args:
+        readings (Iterable[Dict]): Reading documents, read once
+        group_by (str, optional): One of GROUP_KEYS, None puts every reading in one group
+
+    Returns:
+        Tuple: The group index of each reading, the group keys in index order,
+        and a (values, offsets) pair per measurement name
+    """
+    if group_by is not None and group_by not in GROUP_KEYS:
+        raise ValueError(f"Cannot group by {group_by}, expected one of {', '.join(GROUP_KEYS)}")
+    key = GROUP_KEYS.get(group_by)
+
+    index: Dict[str, int] = {}
+    groups: List[int] = []
+    values = {name: [] for name in MEASUREMENT_NAMES}
+    lengths = {name: [] for name in MEASUREMENT_NAMES}
+    for reading in readings:
+        group = key(reading) if key else "all"
+        groups.append(index.setdefault(group, len(index)))
+
+        found = {m["name"]: m["values"] for m in reading.get("measurements", ())}
+        for name in MEASUREMENT_NAMES:
+            reading_values = found.get(name, ())
+            values[name].extend(reading_values)
+            lengths[name].append(len(reading_values))
+
+    arrays = {}
+    for name in MEASUREMENT_NAMES:
+        offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+        np.cumsum(lengths[name], out=offsets[1:])
+        arrays[name] = (np.asarray(values[name], dtype=np.float64), offsets)
+    return np.asarray(groups, dtype=np.int64), list(index), arrays
+
+
+def summarise(values: np.ndarray, offsets: np.ndarray, groups: np.ndarray, n_groups: int, percentiles: Sequence[float] = DEFAULT_PERCENTILES) -> Dict[str, np.ndarray]:
+    """
+    Statistics of one measurement for every group at once.
+
+    Each value is labelled with its reading's group, then one sort by
+    (group, value) gives every group's values as a contiguous sorted run, so
+    min, max, median and percentiles are index lookups and the sums are bincounts.
+
+    Returns:
+        Dict[str, np.ndarray]: count, mean, std, min, max, median and p<n>
+        arrays with one entry per group, NaN where a group has no values
+    """
+    labels = np.repeat(groups, np.diff(offsets))
+    counts = np.bincount(labels, minlength=n_groups)
+    present = counts > 0
+    safe_counts = np.maximum(counts, 1)
+
+    mean = np.bincount(labels, weights=values, minlength=n_groups) / safe_counts
+    deviation = values - mean[labels]
+    std = np.sqrt(np.bincount(labels, weights=deviation * deviation, minlength=n_groups) / safe_counts)
+
+    # Sort by value, then stably by group (a radix sort on the integer labels)
+    order = np.argsort(values)
+    order = order[np.argsort(labels[order], kind="stable")]
+    ordered = values[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    last = np.maximum(starts + counts - 1, 0)
+
+    def percentile(p: float) -> np.ndarray:
+        # Linear interpolation between the closest ranks, as np.percentile does
+        position = p / 100 * np.maximum(counts - 1, 0)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, np.maximum(counts - 1, 0))
+        fraction = position - lower
+        low_values = ordered[np.minimum(starts + lower, len(ordered) - 1)]
+        high_values = ordered[np.minimum(starts + upper, len(ordered) - 1)]
+        return low_values + fraction * (high_values - low_values)
+
+    empty = np.full(n_groups, np.nan)
+    if not len(values):
+        result = {"mean": empty, "std": empty, "min": empty, "max": empty, "median": empty}
+        result.update({f"p{p:g}": empty for p in percentiles})
+    else:
+        result = {
+            "mean": mean,
+            "std": std,
+            "min": ordered[np.minimum(starts, len(ordered) - 1)],
+            "max": ordered[last],
+            "median": percentile(50),
+        }
+        result.update({f"p{p:g}": percentile(p) for p in percentiles})
+    result = {stat: np.where(present, column, np.nan) for stat, column in result.items()}
+    result["count"] = counts
+    return result
+
+
+def reading_stats(readings: Iterable[Dict], group_by: Optional[str] = None, percentiles: Sequence[float] = DEFAULT_PERCENTILES) -> List[Dict]:
+    """
+    Statistics of every measurement type, per group of readings.
+
+    Returns:
+        List[Dict]: One {"key", "readings", "measurements"} entry per group,
+        where measurements maps each name to its count, mean, std, min, max,
+        median and percentiles (None when the group has no values for it)
+    """
+    for p in percentiles:
+        if not 0 <= p <= 100:
+            raise ValueError(f"Percentile {p} is outside 0-100")
+
+    groups, keys, arrays = to_arrays(readings, group_by)
+    readings_per_group = np.bincount(groups, minlength=len(keys))
+    columns = {name: summarise(values, offsets, groups, len(keys), percentiles) for name, (values, offsets) in arrays.items()}
+
+    result = []
+    for i, key in enumerate(keys):
+        measurements = {}
+        for name, stats in columns.items():
+            measurements[name] = {
+                stat: (int(column[i]) if stat == "count" else None if np.isnan(column[i]) else float(column[i]))
+                for stat, column in stats.items()
+            }
+        result.append({"key": key, "readings": int(readings_per_group[i]), "measurements": measurements})
+    return result
+
+
+def get_stats(collection=None, group_by: Optional[str] = None, match: Optional[Dict] = None, percentiles: Sequence[float] = DEFAULT_PERCENTILES, batch_size: int = DEFAULT_BATCH_SIZE) -> List[Dict]:
+    """
+    reading_stats over the stored readings, read in batches with only the fields it needs.
+
+    Args:
+        collection (optional): Collection to query, defaults to the readings collection.
+        group_by (str, optional): uid, region or day
+        match (dict, optional): Filter on the readings, e.g. queries.viewport_filter
+        percentiles: Percentiles to report besides the median
+    """
+    if collection is None:
+        collection = config.get_collection(config.DATA_COLLECTION)
+    fields = {"_id": 0, "uid": 1, "measurements": 1}
+    if group_by == "region":
+        fields.update({"geohash": 1, "location": 1})
+    elif group_by == "day":
+        fields.update({"datetime": 1, UPDATED_FIELD: 1})
+    cursor = collection.find(match or {}, fields, batch_size=batch_size)
+    return reading_stats(cursor, group_by, percentiles)
@@ -0,0 +1,108 @@
+import base64
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
+from bson import ObjectId
+from pymongo import ASCENDING
+
+# Server-side time of the last write to a reading
+UPDATED_FIELD = "updatedAt"
+
+DEFAULT_SYNC_LIMIT = 500
+MAX_SYNC_LIMIT = 5000
+
+# Writes newer than this are held back for the next call, so a write that
+# commits slightly out of timestamp order is never skipped by a watermark
+SETTLE_TIME = timedelta(seconds=2)
+
+
+def now() -> datetime:
+    """Timestamp for UPDATED_FIELD, truncated to the millisecond MongoDB stores."""
+    stamp = datetime.now(timezone.utc)
+    return stamp.replace(microsecond=stamp.microsecond // 1000 * 1000, tzinfo=None)
+
+
+def reading_time(reading: Dict) -> float:
+    """
+    Milliseconds since the epoch at which a reading was taken.
+
+    The app sends datetime as epoch milliseconds, a datetime or an ISO string;
+    anything else falls back to the time the server stored the reading.
+    """
+    value = reading.get("datetime")
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            value = None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if not isinstance(value, datetime):
+        value = reading.get(UPDATED_FIELD)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp() * 1000
+    return 0.0
+
+
+def encode_watermark(updated_at: datetime, last_id: ObjectId) -> str:
+    """Pack the position after the last returned reading into an opaque string."""
+    millis = int(updated_at.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    raw = f"{millis}:{last_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_watermark(watermark: str) -> Tuple[datetime, ObjectId]:
+    """Inverse of encode_watermark, raises ValueError for anything else."""
+    try:
+        millis, last_id = base64.urlsafe_b64decode(watermark.encode()).decode().split(":")
+        updated_at = datetime.fromtimestamp(int(millis) / 1000, tz=timezone.utc).replace(tzinfo=None)
+        return updated_at, ObjectId(last_id)
+    except Exception:
+        raise ValueError("Invalid watermark")
+
+
+def get_changes(collection, watermark: Optional[str] = None, limit: int = DEFAULT_SYNC_LIMIT) -> Dict:
+    """
+    Fetch readings added or changed since a watermark.
+
+    Args:
+        collection: The readings collection
+        watermark (str, optional): Returned by the previous call, None to start from the beginning
+        limit (int): Most readings to return in one call
+
+    Returns:
+        dict: {"readings": [...], "watermark": str, "hasMore": bool}. Pass the
+        watermark back to get the next changes; it is unchanged if there were none.
+    """
+    limit = max(1, min(limit, MAX_SYNC_LIMIT))
+    query = {UPDATED_FIELD: {"$lte": now() - SETTLE_TIME}}
+    if watermark:
+        updated_at, last_id = decode_watermark(watermark)
+        query["$or"] = [
+            {UPDATED_FIELD: {"$gt": updated_at}},
+            {UPDATED_FIELD: updated_at, "_id": {"$gt": last_id}},
+        ]
+
+    cursor = collection.find(query).sort([(UPDATED_FIELD, ASCENDING), ("_id", ASCENDING)]).limit(limit + 1)
+    readings = list(cursor)
+    has_more = len(readings) > limit
+    readings = readings[:limit]
+
+    if readings:
+        watermark = encode_watermark(readings[-1][UPDATED_FIELD], readings[-1]["_id"])
+    return {"readings": readings, "watermark": watermark, "hasMore": has_more}
+
+
+def backfill_updated_at(collection) -> int:
+    """
+    Stamp readings stored before UPDATED_FIELD existed with their insert time.
+
+    Returns:
+        int: Number of readings updated
+    """
+    result = collection.update_many(
+        {UPDATED_FIELD: {"$exists": False}},
+        [{"$set": {UPDATED_FIELD: {"$toDate": "$_id"}}}]
+    )
+    return result.modified_count
@@ -0,0 +1,202 @@
+from typing import Dict, List, Optional
+from pymongo import UpdateOne
+from environment.geo import tile_bounds, tile_xy
+
+# Deepest zoom level kept in the pyramid
+MAX_TILE_ZOOM = 18
+
+# A tile request returns its sub-cells this many levels down (8x8 cells)
+DEFAULT_DETAIL = 3
+MAX_DETAIL = 5
+
+# A rebuild is written to a collection with this suffix, then renamed over the live one
+REBUILD_SUFFIX = "_rebuild"
+
+
+def measurement_summaries(measurements: List[Dict]) -> Dict[str, Dict[str, float]]:
+    """
+    Summarise each measurement of a reading as count, sum, min and max of its values.
+
+    Args:
+        measurements (list): The reading's [{"name", "values"}, ...] array
+
+    Returns:
+        dict: {name: {"count", "sum", "min", "max"}}, measurements without values are left out
+    """
+    summaries = {}
+    for measurement in measurements:
+        values = measurement.get("values") or []
+        if not values:
+            continue
+        summaries[measurement["name"]] = {
+            "count": len(values),
+            "sum": float(sum(values)),
+            "min": float(min(values)),
+            "max": float(max(values)),
+        }
+    return summaries
+
+
+def aggregate_update(summaries: Dict[str, Dict[str, float]], readings: int = 1) -> Dict:
+    """
+    Build the update that folds measurement summaries into an aggregate document.
+
+    Counts and sums are added with $inc and the extremes merged with $min/$max,
+    so concurrent updates to the same document never lose a reading.
+    """
+    inc = {"readings": readings}
+    low = {}
+    high = {}
+    for name, summary in summaries.items():
+        inc[f"measurements.{name}.count"] = summary["count"]
+        inc[f"measurements.{name}.sum"] = summary["sum"]
+        low[f"measurements.{name}.min"] = summary["min"]
+        high[f"measurements.{name}.max"] = summary["max"]
+    update = {"$inc": inc}
+    if low:
+        update["$min"] = low
+        update["$max"] = high
+    return update
+
+
+def merge_summaries(total: Dict[str, Dict[str, float]], summaries: Dict[str, Dict[str, float]]) -> None:
+    """Fold one set of measurement summaries into another, in place."""
+    for name, summary in summaries.items():
+        if name not in total:
+            total[name] = dict(summary)
+            continue
+        current = total[name]
+        current["count"] += summary["count"]
+        current["sum"] += summary["sum"]
+        current["min"] = min(current["min"], summary["min"])
+        current["max"] = max(current["max"], summary["max"])
+
+
+def tile_updates(readings: List[Dict], max_zoom: int = MAX_TILE_ZOOM) -> List[UpdateOne]:
+    """
+    Upserts adding readings to the tile containing each of them at every zoom level.
+
+    Readings landing in the same tile are merged first, so a batch costs one
+    write per distinct tile rather than one per reading per zoom level.
+    """
+    tiles = {}
+    for reading in readings:
+        latitude = reading["location"]["latitude"]
+        longitude = reading["location"]["longitude"]
+        summaries = measurement_summaries(reading.get("measurements", []))
+        for zoom in range(max_zoom + 1):
+            x, y = tile_xy(latitude, longitude, zoom)
+            count, total = tiles.setdefault((zoom, x, y), [0, {}])
+            tiles[(zoom, x, y)][0] = count + 1
+            merge_summaries(total, summaries)
+
+    requests = []
+    for (zoom, x, y), (count, total) in tiles.items():
+        update = aggregate_update(total, readings=count)
+        update["$setOnInsert"] = {"z": zoom, "x": x, "y": y}
+        requests.append(UpdateOne({"_id": f"{zoom}/{x}/{y}"}, update, upsert=True))
+    return requests
+
+
+def update_tiles(collection, readings: List[Dict]) -> None:
+    """Add newly inserted readings to the tile pyramid."""
+    requests = tile_updates(readings)
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+
+
+def cell_summary(cell: Dict, measurement: Optional[str] = None) -> Dict:
+    """Shape a stored tile document for the API, adding its centre and measurement means."""
+    min_lon, min_lat, max_lon, max_lat = tile_bounds(cell["z"], cell["x"], cell["y"])
+    measurements = {}
+    for name, aggregate in cell.get("measurements", {}).items():
+        if measurement is not None and name != measurement:
+            continue
+        measurements[name] = dict(aggregate, mean=aggregate["sum"] / aggregate["count"])
+    return {
+        "z": cell["z"],
+        "x": cell["x"],
+        "y": cell["y"],
+        "latitude": (min_lat + max_lat) / 2,
+        "longitude": (min_lon + max_lon) / 2,
+        "readings": cell.get("readings", 0),
+        "measurements": measurements,
+    }
+
+
+def get_tile_cells(collection, zoom: int, x: int, y: int, detail: int = DEFAULT_DETAIL, measurement: Optional[str] = None) -> List[Dict]:
+    """
+    Fetch the non-empty cells under a tile.
+
+    Args:
+        collection: The tile pyramid collection
+        zoom, x, y (int): The tile requested
+        detail (int): How many zoom levels below the tile the cells are taken from
+        measurement (str, optional): Only return this measurement's aggregates
+
+    Returns:
+        List[Dict]: One summary per non-empty cell
+    """
+    tile_bounds(zoom, x, y)  # validates the tile
+    if zoom > MAX_TILE_ZOOM:
+        raise ValueError(f"Tiles are only kept up to zoom {MAX_TILE_ZOOM}")
+    cell_zoom = min(zoom + max(0, min(detail, MAX_DETAIL)), MAX_TILE_ZOOM)
+    scale = 2 ** (cell_zoom - zoom)
+    query = {
+        "z": cell_zoom,
+        "x": {"$gte": x * scale, "$lt": (x + 1) * scale},
+        "y": {"$gte": y * scale, "$lt": (y + 1) * scale},
+    }
+    return [cell_summary(cell, measurement) for cell in collection.find(query)]
+
+
+def rebuild_collection(readings_collection, target, fields: Dict, update, batch_size: int = 500) -> int:
+    """
+    Rebuild a collection derived from the readings without serving it half built.
+
+    The readings are folded in, batch_size at a time, by update(collection, batch)
+    into a scratch collection with the target's indexes, every option included
+    (e.g. expireAfterSeconds or partialFilterExpression), which is then renamed
+    over the target in one step. Stop ingestion while this runs:
+    readings folded into the target meanwhile are dropped with it.
+
+    Returns:
+        int: Number of readings folded in
+    """
+    db = target.database
+    scratch = db[target.name + REBUILD_SUFFIX]
+    scratch.drop()
+    db.create_collection(scratch.name)
+    for name, info in target.index_information().items():
+        if name != "_id_":
+            # Everything but the key itself and what the server fills in
+            options = {key: value for key, value in info.items() if key not in ("key", "v", "ns")}
+            scratch.create_index(info["key"], name=name, **options)
+
+    count = 0
+    batch = []
+    for reading in readings_collection.find({}, fields):
+        batch.append(reading)
+        if len(batch) >= batch_size:
+            update(scratch, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        update(scratch, batch)
+        count += len(batch)
+    scratch.rename(target.name, dropTarget=True)
+    return count
+
+
+def rebuild_tiles(readings_collection, tiles_collection, batch_size: int = 500) -> int:
+    """
+    Rebuild the pyramid from the stored readings, for data inserted before it existed.
+
+    Tile requests keep being answered from the old pyramid until the new one is
+    complete. Ingestion must be stopped first, see rebuild_collection.
+
+    Returns:
+        int: Number of readings added to the pyramid
+    """
+    fields = {"location": 1, "measurements": 1}
+    return rebuild_collection(readings_collection, tiles_collection, fields, update_tiles, batch_size)
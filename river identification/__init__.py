@@ -1,53 +1,60 @@
 # /c:/Users/Jamie/Documents/GitHub/Back-End/river identification/__init__.py
+import os
 import read_rivers as rr
-import get_satellite_images as gsi
-import identification as id
+import fetcher
+import segmentation as seg
+import coverage as cov
 
 
-def main(shapefile, river_name_column, river_name, n):
+def main(shapefile, river_name_column, river_name, n=None, zoom_level=21, output_dir="images"):
+    ''' fetches images along a river and segments them, n limits it to the first n images.
+    With output_dir None nothing is written to disk, images go from the download to
+    segmentation as arrays '''
     try:
         # Read river data from file
         riverpoints = rr.extract_river_coordinates(shapefile, river_name_column, river_name)
-        
+        # One image per grid cell the river crosses, not one per vertex
+        riverpoints = cov.plan_coverage(riverpoints, zoom_level=zoom_level)
     except Exception as e:
         print(f"Error: {e}")
-    
-    for i in range(riverpoints):
-        try:
-            # Save satellite image
-            gsi.save_satellite_image(
-                latitude=riverpoints["Latitude"][i],
-                longitude=riverpoints["Longitude"][i],
-                output_path=f"river_{i}.png",
-                zoom_level=21
-            )
-            print(f"\nSatellite image {i} saved successfully!")
-        except Exception as e:
-            print(f"Error: {e}")
-            
-        try:
-            #do the river identification
-            id.kclustering(f"river_{i}.png")
-        except Exception as e: 
-            print(f"Error: {e}")
-        
-        try:
-            #do the river identification using contours
-            id.contouring(f"river_{i}.png")
-        except Exception as e: 
-            print(f"Error: {e}")
-        
-            
-    # get_map_image(
-    # latitude: float,  # lat of centre 
-    # longitude: float,  # long of centre
-    # zoom_level: int = 21,  # default to maximum zoom
-    # api_key: Optional[str] = None,
-    # image_size: Tuple[int, int] = (640, 640)
-    # )
+        return
+
+    points = list(zip(riverpoints["Latitude"], riverpoints["Longitude"]))[:n]
+
+    # Segment each image with every method as it is fetched, across every core, rather
+    # than collecting them all first. Images are saved if there is an output_dir, and
+    # any saved by an earlier run are skipped by the fetcher and read back from disk
+    mask_dirs = {method: os.path.join(output_dir, f"masks_{method}") for method in seg.METHODS} if output_dir is not None else None
+    segmenter = seg.BatchSegmenter(seg.METHODS, mask_dirs, keep_masks=False)
+    fetched_keys = set()
+
+    def on_image(key, image):
+        fetched_keys.add(key)
+        segmenter.add(image, key)
+
+    try:
+        fetched = fetcher.fetch_map_images(points, output_dir, zoom_level, on_image=on_image)
+        print(f"\n{fetched['done']} satellite images fetched, {fetched['skipped']} already saved, {fetched['failed']} failed")
+        for key, error in fetched['errors'].items():
+            print(f"Error: {key}: {error}")
+
+        if output_dir is not None:
+            for lat, lon in points:
+                key = fetcher.point_key('google_maps', lat, lon, zoom_level)
+                path = os.path.join(output_dir, f"{key}.png")
+                if key not in fetched_keys and os.path.exists(path):
+                    segmenter.add(path, key)
+    finally:
+        summaries = segmenter.close()
+
+    for method, summary in summaries.items():
+        print(f"{method}: {len(summary['names'])} images at {summary['tiles_per_second']:.2f} tiles/s, {len(summary['errors'])} failed")
+        for name, error in summary['errors'].items():
+            print(f"Error: {name}: {error}")
 
 # Example usage
-shapefile = "c:/Users/Jamie/Documents/GitHub/Back-End/river identification/WatercourseLink.shp"  # File path
-river_name_column = "name1"  # Select the column containing the river names
-river_name = "Burn of Sulerdale"  # Specific river
-main(shapefile, river_name_column, river_name, 5)
\ No newline at end of file
+if __name__ == "__main__":
+    shapefile = "c:/Users/Jamie/Documents/GitHub/Back-End/river identification/WatercourseLink.shp"  # File path
+    river_name_column = "name1"  # Select the column containing the river names
+    river_name = "Burn of Sulerdale"  # Specific river
+    main(shapefile, river_name_column, river_name, 5)
\ No newline at end of file
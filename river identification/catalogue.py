@@ -0,0 +1,262 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Bumped whenever the files written by build() change, so old catalogues are rebuilt
+CATALOGUE_VERSION = 2
+
+# File in the catalogue directory naming the build subdirectory to read. Each
+# build writes a new subdirectory and then replaces this file, which is a single
+# atomic rename, so a reader opens either the old build or the new one
+CURRENT_FILE = 'current'
+BUILD_PREFIX = 'build-'
+
+# Metres per degree of latitude, near enough everywhere for ranking distances
+METERS_PER_DEGREE = 111320.0
+
+# First search radius of nearest(), doubled until a river is found
+NEAREST_START_DEGREES = 0.01
+
+
+def catalogue_dir(shapefile: str, river_name_column: str) -> str:
+    # Kept next to the shapefile, one per name column
+    return f"{os.path.splitext(shapefile)[0]}_catalogue_{river_name_column}"
+
+
+def current_build(directory: str) -> str:
+    ''' the directory of the build a catalogue directory currently points at '''
+    with open(os.path.join(directory, CURRENT_FILE)) as f:
+        return os.path.join(directory, f.read().strip())
+
+
+def source_stamp(shapefile: str) -> Dict[str, int]:
+    ''' what the catalogue was built from, a different stamp means the shapefile changed '''
+    stat = os.stat(shapefile)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class RiverCatalogue:
+    '''
+    A shapefile of rivers converted once into flat arrays that are memory mapped
+    rather than parsed, already reprojected to EPSG:4326.
+
+    The catalogue directory holds CURRENT_FILE, naming the build subdirectory
+    with these files:
+        coords.npy: (latitude, longitude) of every vertex, line after line
+        line_starts.npy: index of each line's first vertex in coords, plus the total
+        feature_lines.npy: index of each feature's first line, plus the total
+        bboxes.npy: (min_lon, min_lat, max_lon, max_lat) of each feature
+        names.json: river name of each feature and a name -> features index
+        meta.json: version, name column and the stamp of the shapefile it came from
+
+    Features are rows of the shapefile; a river made of several rows, as in
+    WatercourseLink, is every feature with its name.
+    '''
+    def __init__(self, directory: str):
+        self.directory = directory
+        try:
+            self._load(current_build(directory))
+        except FileNotFoundError:
+            # The build was replaced and removed between reading CURRENT_FILE and opening it
+            self._load(current_build(directory))
+
+    def _load(self, build: str) -> None:
+        with open(os.path.join(build, 'meta.json')) as f:
+            self.meta = json.load(f)
+        # mmap: opening is instant and only the pages a query touches are read
+        self.coords = np.load(os.path.join(build, 'coords.npy'), mmap_mode='r')
+        self.line_starts = np.load(os.path.join(build, 'line_starts.npy'))
+        self.feature_lines = np.load(os.path.join(build, 'feature_lines.npy'))
+        self.bboxes = np.load(os.path.join(build, 'bboxes.npy'))
+        with open(os.path.join(build, 'names.json')) as f:
+            names = json.load(f)
+        self.names = names['names']
+        self.name_index = names['index']
+
+    @classmethod
+    def build(cls, shapefile: str, river_name_column: str, directory: Optional[str] = None) -> 'RiverCatalogue':
+        ''' parse and reproject the shapefile, the one slow step, and write the catalogue '''
+        import geopandas as gpd  # slow to import, only needed here
+
+        directory = directory or catalogue_dir(shapefile, river_name_column)
+        gdf = gpd.read_file(shapefile, columns=[river_name_column]).to_crs(epsg=4326)
+
+        coords, line_starts, feature_lines = [], [0], [0]
+        for geom in gdf.geometry:
+            if geom is not None and geom.geom_type == "LineString":
+                lines = [geom]
+            elif geom is not None and geom.geom_type == "MultiLineString":
+                lines = list(geom.geoms)
+            else:
+                lines = []
+            for line in lines:
+                xy = np.asarray(line.coords)[:, :2]
+                coords.append(xy[:, ::-1])  # (lon, lat) to (lat, lon)
+                line_starts.append(line_starts[-1] + len(xy))
+            feature_lines.append(len(line_starts) - 1)
+        coords = np.concatenate(coords) if coords else np.empty((0, 2))
+
+        bounds = gdf.geometry.bounds.to_numpy()
+        names = [None if pd.isna(name) else str(name) for name in gdf[river_name_column]]
+        index: Dict[str, List[int]] = {}
+        for feature, name in enumerate(names):
+            if name is not None:
+                index.setdefault(name, []).append(feature)
+
+        # Written to a build subdirectory of its own, then CURRENT_FILE is pointed at
+        # it. Readers never see half a catalogue, and builds running at once each
+        # finish whole, the last to swap in wins
+        os.makedirs(directory, exist_ok=True)
+        build = tempfile.mkdtemp(dir=directory, prefix=BUILD_PREFIX)
+        np.save(os.path.join(build, 'coords.npy'), coords)
+        np.save(os.path.join(build, 'line_starts.npy'), np.asarray(line_starts, dtype=np.int64))
+        np.save(os.path.join(build, 'feature_lines.npy'), np.asarray(feature_lines, dtype=np.int64))
+        np.save(os.path.join(build, 'bboxes.npy'), bounds)
+        with open(os.path.join(build, 'names.json'), 'w') as f:
+            json.dump({'names': names, 'index': index}, f)
+        with open(os.path.join(build, 'meta.json'), 'w') as f:
+            json.dump({
+                'version': CATALOGUE_VERSION,
+                'river_name_column': river_name_column,
+                'source': source_stamp(shapefile)
+            }, f)
+
+        try:
+            previous = current_build(directory)
+        except FileNotFoundError:
+            previous = None
+        fd, pointer = tempfile.mkstemp(dir=directory, prefix='.current-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(os.path.basename(build))
+        os.replace(pointer, os.path.join(directory, CURRENT_FILE))
+
+        # Only the build this one replaced is removed, never one still being written.
+        # A process still reading it keeps its memory map (on Windows it stays until the next build)
+        if previous is not None:
+            shutil.rmtree(previous, ignore_errors=True)
+        else:
+            # Files of a version 1 catalogue, written straight into the directory
+            for name in os.listdir(directory):
+                if name.endswith(('.npy', '.json')):
+                    os.remove(os.path.join(directory, name))
+        return cls(directory)
+
+    @classmethod
+    def is_current(cls, shapefile: str, river_name_column: str, directory: str) -> bool:
+        try:
+            with open(os.path.join(current_build(directory), 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return (meta.get('version') == CATALOGUE_VERSION
+                and meta.get('river_name_column') == river_name_column
+                and meta.get('source') == source_stamp(shapefile))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def by_name(self, river_name: str) -> List[int]:
+        ''' features of the river with this name '''
+        return list(self.name_index.get(river_name, []))
+
+    def in_bbox(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> List[int]:
+        ''' features whose bounding box intersects this one '''
+        b = self.bboxes
+        hits = (b[:, 0] <= max_lon) & (b[:, 2] >= min_lon) & (b[:, 1] <= max_lat) & (b[:, 3] >= min_lat)
+        return np.flatnonzero(hits).tolist()
+
+    def nearest(self, latitude: float, longitude: float) -> Tuple[Optional[int], float]:
+        '''
+        The feature passing closest to a point.
+
+        Returns:
+            tuple: (feature, distance in metres), (None, inf) for an empty catalogue
+        '''
+        scale = np.cos(np.radians(latitude))
+        radius = NEAREST_START_DEGREES
+        best, best_distance = None, np.inf
+        while radius < 360:
+            candidates = self.in_bbox(longitude - radius / scale, latitude - radius, longitude + radius / scale, latitude + radius)
+            if candidates:
+                best, best_distance = self._closest(candidates, latitude, longitude)
+                # A closer feature would have had its bounding box inside this radius
+                if best_distance <= radius * METERS_PER_DEGREE:
+                    return best, best_distance
+                radius = best_distance / METERS_PER_DEGREE
+                candidates = self.in_bbox(longitude - radius / scale, latitude - radius, longitude + radius / scale, latitude + radius)
+                return self._closest(candidates, latitude, longitude)
+            radius *= 2
+        return best, best_distance
+
+    def _closest(self, features: List[int], latitude: float, longitude: float) -> Tuple[int, float]:
+        # Distance from the point to every segment of the features, on a flat
+        # local projection which is plenty accurate over the few km involved
+        best, best_distance = None, np.inf
+        scale = np.cos(np.radians(latitude)) * METERS_PER_DEGREE
+        for feature in features:
+            for line in self.feature_coords(feature):
+                y = (line[:, 0] - latitude) * METERS_PER_DEGREE
+                x = (line[:, 1] - longitude) * scale
+                if len(line) == 1:
+                    distance = np.hypot(x[0], y[0])
+                else:
+                    dx, dy = np.diff(x), np.diff(y)
+                    length = dx ** 2 + dy ** 2
+                    t = np.clip(-(x[:-1] * dx + y[:-1] * dy) / np.where(length > 0, length, 1), 0, 1)
+                    distance = np.hypot(x[:-1] + t * dx, y[:-1] + t * dy).min()
+                if distance < best_distance:
+                    best, best_distance = feature, float(distance)
+        return best, best_distance
+
+    def feature_coords(self, feature: int) -> List[np.ndarray]:
+        ''' (latitude, longitude) arrays of each line of a feature, views into the memory map '''
+        first, last = self.feature_lines[feature], self.feature_lines[feature + 1]
+        return [self.coords[self.line_starts[i]:self.line_starts[i + 1]] for i in range(first, last)]
+
+    def coordinates(self, features: List[int]) -> pd.DataFrame:
+        ''' Latitude, Longitude and Segment of every vertex of the features, as extract_river_coordinates returns '''
+        lines = [line for feature in features for line in self.feature_coords(feature)]
+        if not lines:
+            return pd.DataFrame(columns=['Latitude', 'Longitude', 'Segment'])
+        coords = np.concatenate(lines)
+        return pd.DataFrame({
+            'Latitude': coords[:, 0],
+            'Longitude': coords[:, 1],
+            'Segment': np.repeat(np.arange(len(lines)), [len(line) for line in lines])
+        })
+
+
+_catalogues: Dict[str, RiverCatalogue] = {}
+_catalogues_lock = threading.Lock()
+
+
+def open_catalogue(shapefile: str, river_name_column: str, directory: Optional[str] = None) -> RiverCatalogue:
+    ''' the catalogue of a shapefile, built the first time and rebuilt if the
+    shapefile changes, and kept open for the rest of the process '''
+    directory = directory or catalogue_dir(shapefile, river_name_column)
+    with _catalogues_lock:
+        catalogue = _catalogues.get(directory)
+        current = RiverCatalogue.is_current(shapefile, river_name_column, directory)
+        if catalogue is None or not current:
+            if current:
+                catalogue = RiverCatalogue(directory)
+            else:
+                catalogue = RiverCatalogue.build(shapefile, river_name_column, directory)
+            _catalogues[directory] = catalogue
+        return catalogue
+
+
+# Example usage
+if __name__ == "__main__":
+    shapefile = "c:/Users/Jamie/Documents/GitHub/Back-End/river identification/WatercourseLink.shp"  # File path
+    catalogue = open_catalogue(shapefile, "name1")
+    print(f"{len(catalogue)} features")
+    print(catalogue.coordinates(catalogue.by_name("Burn of Sulerdale")))
+    feature, distance = catalogue.nearest(51.38, -2.36)
+    print(f"Nearest river to Bath: {catalogue.names[feature]}, {distance:.0f} m away")
@@ -0,0 +1,113 @@
+from typing import Iterable, Tuple
+
+import numpy as np
+import pandas as pd
+
+from google_maps_image import calculate_image_metadata
+from mercator import to_lat_lon, to_pixels
+
+# Fraction of each image shared with its neighbours. The margin this leaves
+# around every grid cell is what guarantees the river never slips between images
+DEFAULT_OVERLAP = 0.1
+
+
+def river_lines(riverpoints: pd.DataFrame) -> Iterable[np.ndarray]:
+    ''' the (latitude, longitude) arrays of each LineString in an
+    extract_river_coordinates DataFrame, so separate segments aren't joined up '''
+    if 'Segment' not in riverpoints:
+        yield riverpoints[['Latitude', 'Longitude']].to_numpy()
+        return
+    for _, segment in riverpoints.groupby('Segment', sort=False):
+        yield segment[['Latitude', 'Longitude']].to_numpy()
+
+
+def resample_line(x: np.ndarray, y: np.ndarray, spacing: float) -> Tuple[np.ndarray, np.ndarray]:
+    ''' points every `spacing` along a polyline, whatever its vertex density, plus its last vertex '''
+    distance = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+    stations = np.append(np.arange(0.0, distance[-1], spacing), distance[-1])
+    return np.interp(stations, distance, x), np.interp(stations, distance, y)
+
+
+def plan_coverage(
+    riverpoints: pd.DataFrame,
+    zoom_level: int = 18,
+    image_size: Tuple[int, int] = (640, 640),
+    overlap: float = DEFAULT_OVERLAP) -> pd.DataFrame:
+    '''
+    Plan the fewest images that cover a whole river, instead of one image per vertex.
+
+    Images are laid out on a fixed Web Mercator grid, the projection Google Maps
+    draws in, so an image spans exactly image_size pixels whatever the latitude
+    and the same grid is shared by every river (and so by the tile cache).
+    Each cell is image_size * (1 - overlap) pixels. The river is resampled every
+    min(image_size) * overlap pixels, at most the margin an image reaches past
+    its cell, so even a bend clipping the corner of a cell is inside the image
+    of a neighbouring cell that was sampled. Every cell with a sample becomes one image.
+
+    This relies on every image being centred on its cell, so the margin is
+    the same on all four sides. get_map_image crops the attribution evenly
+    from the top and bottom for that reason (crop_and_resize_image).
+
+    Parameters:
+        riverpoints (pd.DataFrame): Latitude and Longitude of the river's vertices,
+            as returned by read_rivers.extract_river_coordinates
+        zoom_level (int): Zoom the images will be fetched at
+        image_size (tuple): (width, height) of each image in pixels
+        overlap (float): Fraction of an image shared with each neighbour, between 0 and 1
+
+    Returns:
+        pd.DataFrame: One row per image in the order the river reaches it: Latitude and
+            Longitude of its centre, its grid Column and Row, and its footprint in metres
+    '''
+    if not 0 < overlap < 1:
+        raise ValueError("overlap must be between 0 and 1")
+    cell_width, cell_height = (size * (1 - overlap) for size in image_size)
+    spacing = min(image_size) * overlap
+
+    cells = []
+    for line in river_lines(riverpoints):
+        if len(line) == 0:
+            continue
+        x, y = to_pixels(line[:, 0], line[:, 1], zoom_level)
+        x, y = resample_line(x, y, spacing)
+        cells.append(np.column_stack((np.floor(x / cell_width), np.floor(y / cell_height))).astype(np.int64))
+    if not cells:
+        return pd.DataFrame(columns=['Latitude', 'Longitude', 'Column', 'Row', 'width_meters', 'height_meters'])
+
+    # Keep each cell once, in the order the river first enters it
+    cells = np.concatenate(cells)
+    _, first = np.unique(cells, axis=0, return_index=True)
+    cells = cells[np.sort(first)]
+
+    latitude, longitude = to_lat_lon((cells[:, 0] + 0.5) * cell_width, (cells[:, 1] + 0.5) * cell_height, zoom_level)
+    # The footprint in metres shrinks away from the equator, even though the pixels don't
+    footprint = calculate_image_metadata(latitude, longitude, zoom_level, image_size)
+    return pd.DataFrame({
+        'Latitude': latitude,
+        'Longitude': longitude,
+        'Column': cells[:, 0],
+        'Row': cells[:, 1],
+        'width_meters': footprint['width_meters'],
+        'height_meters': footprint['height_meters']
+    })
+
+
+def coverage_summary(riverpoints: pd.DataFrame, plan: pd.DataFrame) -> dict:
+    ''' how much the plan saves over fetching an image per vertex '''
+    return {
+        'vertices': len(riverpoints),
+        'images': len(plan),
+        'reduction': len(riverpoints) / len(plan) if len(plan) else 0.0,
+        'area_square_meters': float((plan['width_meters'] * plan['height_meters']).sum())
+    }
+
+
+# Example usage
+if __name__ == "__main__":
+    import read_rivers as rr
+
+    shapefile = "c:/Users/Jamie/Documents/GitHub/Back-End/river identification/WatercourseLink.shp"  # File path
+    riverpoints = rr.extract_river_coordinates(shapefile, "name1", "Burn of Sulerdale")
+    plan = plan_coverage(riverpoints, zoom_level=18)
+    print(plan)
+    print(coverage_summary(riverpoints, plan))
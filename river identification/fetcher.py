@@ -0,0 +1,273 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Requests in flight at once
+DEFAULT_WORKERS = 8
+
+# Requests per second across all workers, keeps us under the API quotas
+DEFAULT_RATE = 10.0
+
+# Attempts after the first one before a task is given up on
+DEFAULT_RETRIES = 5
+
+# Backoff doubles from BASE_DELAY up to MAX_DELAY seconds, with jitter
+BASE_DELAY = 0.5
+MAX_DELAY = 30.0
+
+# Responses worth retrying: rate limited or a temporary server problem
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def make_session(pool_size: int = DEFAULT_WORKERS) -> requests.Session:
+    ''' a requests session keeping up to pool_size connections open,
+    so every worker reuses a connection instead of opening its own '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class TokenBucket:
+    ''' thread-safe rate limiter allowing `rate` calls per second on average
+    and bursts of up to `capacity` calls '''
+    def __init__(self, rate: float = DEFAULT_RATE, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        # Block until a token is free
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+def retry_delay(attempt: int, error: Exception) -> float:
+    ''' seconds to wait before retrying: the server's Retry-After if it sent one,
+    otherwise exponential backoff with jitter so workers don't retry in lockstep '''
+    response = getattr(error, "response", None)
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return min(MAX_DELAY, float(response.headers["Retry-After"]))
+    return min(MAX_DELAY, BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if type(error).__name__ == "EEException":
+        # Earth Engine reports throttling as an exception message rather than a status
+        message = str(error).lower()
+        return "too many" in message or "rate limit" in message or "quota" in message
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.HTTPError) and response is not None and response.status_code in RETRY_STATUSES
+
+
+def call_with_backoff(func: Callable, *args, retries: int = DEFAULT_RETRIES, limiter: Optional[TokenBucket] = None, **kwargs):
+    ''' calls func, retrying temporary network and server errors with exponential backoff.
+    Every attempt, retries included, waits for the rate limiter first '''
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            time.sleep(retry_delay(attempt, e))
+
+
+class Progress:
+    ''' keys of finished tasks, appended to a file as they finish so an
+    interrupted run picks up where it stopped '''
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.done = {json.loads(line) for line in f if line.strip()}
+
+    def mark(self, key: str) -> None:
+        with self._lock:
+            self.done.add(key)
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(key) + "\n")
+
+
+def run_parallel(
+    tasks: Iterable[Tuple[str, Any]],
+    work: Callable[[Any], Any],
+    on_result: Optional[Callable[[str, Any], None]] = None,
+    workers: int = DEFAULT_WORKERS,
+    rate: float = DEFAULT_RATE,
+    retries: int = DEFAULT_RETRIES,
+    progress_path: Optional[str] = None
+) -> Dict[str, Any]:
+    '''
+    Run work(payload) for every (key, payload) task on a bounded thread pool.
+
+    Parameters:
+        tasks: (key, payload) pairs, consumed lazily. Keys must be stable between
+            runs, they are what the progress file records.
+        work: Does one task, e.g. downloads one image. Retried on temporary errors.
+        on_result: Called with (key, result) on this thread as each task finishes,
+            e.g. to save the image. The task only counts as done once it returns.
+        workers: Threads, and so tasks in flight, at once
+        rate: Most calls to work per second across all threads
+        retries: Retries of a task before it is reported as failed
+        progress_path: File recording finished keys; tasks already in it are skipped
+
+    Returns:
+        dict: done, skipped and failed counts, errors by key, seconds and tasks_per_second
+    '''
+    limiter = TokenBucket(rate)
+    progress = Progress(progress_path)
+    summary = {"done": 0, "skipped": 0, "failed": 0, "errors": {}}
+    start = time.perf_counter()
+
+    def finish(future, key):
+        try:
+            result = future.result()
+            if on_result is not None:
+                on_result(key, result)
+        except Exception as e:
+            summary["failed"] += 1
+            summary["errors"][key] = str(e)
+            return
+        progress.mark(key)
+        summary["done"] += 1
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for key, payload in tasks:
+            if key in progress.done:
+                summary["skipped"] += 1
+                continue
+            # Keep at most two tasks per worker queued, so a river with
+            # thousands of points never has thousands of futures alive
+            while len(pending) >= workers * 2:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(future, pending.pop(future))
+            future = pool.submit(call_with_backoff, work, payload, retries=retries, limiter=limiter)
+            pending[future] = key
+        for future in list(pending):
+            finish(future, pending.pop(future))
+
+    summary["seconds"] = time.perf_counter() - start
+    summary["tasks_per_second"] = summary["done"] / summary["seconds"] if summary["seconds"] else 0.0
+    return summary
+
+
+def point_key(prefix: str, latitude: float, longitude: float, zoom_level: int) -> str:
+    # Same point and zoom, same key, whatever order the points come in
+    return f"{prefix}_{latitude:.6f}_{longitude:.6f}_z{zoom_level}"
+
+
+def fetch_map_images(
+    points: Iterable[Tuple[float, float]],
+    output_dir: Optional[str] = "images",
+    zoom_level: int = 18,
+    image_size: Tuple[int, int] = (640, 640),
+    api_key: Optional[str] = None,
+    workers: int = DEFAULT_WORKERS,
+    rate: float = DEFAULT_RATE,
+    resume: bool = True,
+    on_image: Optional[Callable[[str, Any], None]] = None
+) -> Dict[str, Any]:
+    '''
+    Download the Google Maps satellite image of every (latitude, longitude) point in parallel.
+
+    Images are saved as output_dir/google_maps_<lat>_<lon>_z<zoom>.png. With
+    resume, points finished by an earlier run into the same directory are skipped.
+    With output_dir None nothing is written: images only go to on_image, as
+    BGR uint8 arrays, e.g. straight into segmentation without a PNG round-trip.
+
+    Returns:
+        dict: The run_parallel summary
+    '''
+    from google_maps_image import get_map_image, save_image
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    session = make_session(workers)
+
+    def work(point):
+        image, _ = get_map_image(point[0], point[1], zoom_level, api_key, image_size, session=session)
+        return image
+
+    def save(key, image):
+        # PNG encoding only happens here, when images are kept
+        if output_dir is not None:
+            save_image(os.path.join(output_dir, f"{key}.png"), image)
+        if on_image is not None:
+            on_image(key, image)
+
+    tasks = ((point_key("google_maps", lat, lon, zoom_level), (lat, lon)) for lat, lon in points)
+    progress_path = os.path.join(output_dir, "google_maps_progress.jsonl") if resume and output_dir is not None else None
+    try:
+        return run_parallel(tasks, work, save, workers, rate, progress_path=progress_path)
+    finally:
+        session.close()
+
+
+def fetch_sentinel_images(
+    points: Iterable[Tuple[float, float]],
+    output_dir: Optional[str] = "images",
+    zoom_level: int = 18,
+    image_size: Tuple[int, int] = (640, 640),
+    workers: int = DEFAULT_WORKERS,
+    rate: float = DEFAULT_RATE,
+    resume: bool = True,
+    on_image: Optional[Callable[[str, Any], None]] = None
+) -> Dict[str, Any]:
+    '''
+    Fetch the latest Sentinel-2 image of every point in parallel. The Earth
+    Engine getInfo() calls block, so they are overlapped on the thread pool too.
+
+    Images are saved as output_dir/sentinel2_<lat>_<lon>_z<zoom>.png, output_dir
+    and on_image work as in fetch_map_images.
+
+    Returns:
+        dict: The run_parallel summary
+    '''
+    from google_earth_sat import get_sentinel_image, initialize_earth_engine
+    from google_maps_image import save_image
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    # Initialise once here rather than racing to do it on every thread
+    initialize_earth_engine()
+
+    def work(point):
+        image, _ = get_sentinel_image(point[0], point[1], zoom_level, image_size)
+        return image
+
+    def save(key, image):
+        if output_dir is not None:
+            save_image(os.path.join(output_dir, f"{key}.png"), image)
+        if on_image is not None:
+            on_image(key, image)
+
+    tasks = ((point_key("sentinel2", lat, lon, zoom_level), (lat, lon)) for lat, lon in points)
+    progress_path = os.path.join(output_dir, "sentinel2_progress.jsonl") if resume and output_dir is not None else None
+    return run_parallel(tasks, work, save, workers, rate, progress_path=progress_path)
@@ -1,6 +1,7 @@
 import os
+import fetcher
 from google_earth_sat import get_sentinel_image, save_sentinel_image
-from google_maps_image import get_map_image
+from google_maps_image import get_map_image, save_image
 
 def save_satellite_images(latitude, longitude, n, zoom_level:int = 18):
     # saves recent satellite images and the basic google maps one for comparison
@@ -21,7 +22,7 @@ def save_satellite_images(latitude, longitude, n, zoom_level:int = 18):
         
         # Get and save Google Maps image
         print("\nGetting Google Maps image...")
-        image_data, metadata = get_map_image(
+        image, metadata = get_map_image(
             latitude=latitude,
             longitude=longitude,
             zoom_level=zoom_level,
@@ -29,8 +30,7 @@ def save_satellite_images(latitude, longitude, n, zoom_level:int = 18):
         )
         
         # Save Google Maps image
-        with open(f"images/google_maps_{n}.png", 'wb') as f:
-            f.write(image_data)
+        save_image(f"images/google_maps_{n}.png", image)
         
         print("\nImages saved in the 'images' directory:")
         print(f"- images/sentinel2_{n}.png")
@@ -49,11 +49,8 @@ if __name__ == "__main__":
              (51.3855979360861, -2.4035207801691496),
              (51.37851635187733, -2.3289445443237153)]
     
-    try:
-        i = 0
-        for c in coords:
-            save_satellite_images(c[0], c[1], i)
-            i += 1
-        
-    except Exception as e:
-        print(f"Error: {e}") 
\ No newline at end of file
+    # Download both sets in parallel, a rerun skips images already saved
+    print("\nGetting Sentinel-2 images...")
+    print(fetcher.fetch_sentinel_images(coords, "images"))
+    print("\nGetting Google Maps images...")
+    print(fetcher.fetch_map_images(coords, "images"))
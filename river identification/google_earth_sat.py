@@ -1,8 +1,5 @@
-import ee
 import datetime
 import numpy as np
-import matplotlib.pyplot as plt
-import cv2
 from typing import Tuple, Dict
 import urllib.request
 from PIL import Image
@@ -12,7 +9,8 @@ import os
 
 # Add the current directory to the Python path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from google_maps_image import get_map_image
+from google_maps_image import get_map_image, save_image
+from tile_cache import decode_array, encode_array, get_cache, tile_key
 
 def calculate_image_metadata(
     latitude: float,
@@ -43,21 +41,48 @@ def calculate_image_metadata(
         'area_square_meters': area_square_meters
     }
 
-# Initialize the Earth Engine API
-ee.Initialize(project='biodevices-without-borders')
+# Earth Engine project used for all requests
+EE_PROJECT = 'biodevices-without-borders'
+
+# Sentinel-2 collection and how its bands are turned into a true colour image
+SENTINEL_COLLECTION = "COPERNICUS/S2_SR"
+SENTINEL_VIS_PARAMS = {
+    'bands': ['B4', 'B3', 'B2'],  # Red, Green, Blue bands for true color
+    'min': 2000,    # Adjusted to better capture the dynamic range
+    'max': 4500,    # Adjusted to prevent overexposure
+    'gamma': 1.1    # Slightly reduced gamma for better mid-tone detail
+}
+_ee_initialized = False
+
+def initialize_earth_engine():
+    # Import and initialize the Earth Engine API on first use rather than at
+    # import time, which needs credentials and a network round-trip
+    global _ee_initialized
+    import ee
+    if not _ee_initialized:
+        ee.Initialize(project=EE_PROJECT)
+        _ee_initialized = True
+    return ee
 
 def get_sentinel_image( # get the most recent sentinel-2 image
     latitude: float,
     longitude: float,
     zoom_level: int,
-    image_size: Tuple[int, int] = (640, 640) ) -> Tuple[np.ndarray, Dict[str, float]]:
+    image_size: Tuple[int, int] = (640, 640),
+    use_cache: bool = True ) -> Tuple[np.ndarray, Dict[str, float]]:
+    ''' returns (image, metadata), image a BGR uint8 array like get_map_image's.
+    use_cache: reuse the raw bands of an image already downloaded for this
+    point, zoom, size and acquisition date from the on-disk tile cache '''
+
+    import cv2
+    ee = initialize_earth_engine()
 
     # Define the time range (last 7 days)
     end = ee.Date(datetime.datetime.now())
     start = end.advance(-7, 'day')
 
     # Create an image collection of Sentinel-2 images for the past week
-    s2 = ee.ImageCollection("COPERNICUS/S2_SR") \
+    s2 = ee.ImageCollection(SENTINEL_COLLECTION) \
         .filterDate(start, end) \
         .filterBounds(ee.Geometry.Point([longitude, latitude])) \
         .sort('system:time_start', False)
@@ -66,21 +91,58 @@ def get_sentinel_image( # get the most recent sentinel-2 image
     image = s2.first()
 
     # Get the image date
-    image_date = image.get('system:time_start').getInfo()
-    image_date = datetime.datetime.fromtimestamp(image_date/1000).strftime('%Y-%m-%d %H:%M:%S')
+    image_time = image.get('system:time_start').getInfo()
+    image_date = datetime.datetime.fromtimestamp(image_time/1000).strftime('%Y-%m-%d %H:%M:%S')
     print(f"\nSentinel-2 image acquisition date: {image_date}")
 
+    # Same scene as an earlier request: skip sampleRectangle, the slow and quota heavy call
+    cache = get_cache() if use_cache else None
+    key = tile_key('sentinel2', latitude, longitude, zoom_level, image_size, str(image_time))
+    cached = cache.get(key) if cache is not None else None
+
     # Define visualization parameters
-    vis_params = {
-        'bands': ['B4', 'B3', 'B2'],  # Red, Green, Blue bands for true color
-        'min': 2000,    # Adjusted to better capture the dynamic range
-        'max': 4500,    # Adjusted to prevent overexposure
-        'gamma': 1.1    # Slightly reduced gamma for better mid-tone detail
-    }
+    vis_params = SENTINEL_VIS_PARAMS
 
     # Select bands (B4, B3, B2 for true color)
     image = image.select(['B4', 'B3', 'B2'])
 
+    if cached is not None:
+        image_array = decode_array(cached[0])
+    else:
+        image_array = sample_bands(ee, image, latitude, longitude, zoom_level, image_size, bands=vis_params['bands'])
+        if cache is not None:
+            cache.put(key, encode_array(image_array), {'latitude': latitude, 'longitude': longitude, 'acquired': image_date})
+    
+    # Print value ranges for debugging
+    print("\nValue ranges before normalization:")
+    for i, band in enumerate(vis_params['bands']):
+        print(f"{band}: min={np.min(image_array[:,:,i]):.1f}, max={np.max(image_array[:,:,i]):.1f}")
+    
+    # Normalise, gamma correct and contrast enhance straight to uint8 with a lookup
+    # table, no float copy of the image, then swap to BGR and resize to target dimensions
+    image_array = visualisation_table(vis_params)[np.clip(image_array, vis_params['min'], vis_params['max']) - vis_params['min']]
+    image_array = cv2.resize(cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR), image_size)
+    
+    # Calculate metadata
+    metadata = calculate_image_metadata(latitude, longitude, zoom_level, image_size)
+    
+    return image_array, metadata
+
+def visualisation_table(vis_params) -> np.ndarray:
+    ''' uint8 display value of every raw band value from vis_params min to max '''
+    # Clip values to valid range and normalize
+    image_array = np.arange(vis_params['max'] - vis_params['min'] + 1) / (vis_params['max'] - vis_params['min'])
+    
+    # Apply gamma correction
+    image_array = np.power(image_array, 1/vis_params['gamma'])
+    
+    # Apply contrast enhancement
+    image_array = np.clip(image_array * 1.2, 0, 1)  # Increase contrast by 20%
+    return np.round(image_array * 255).astype(np.uint8)
+
+def sample_bands(ee, image, latitude, longitude, zoom_level, image_size, bands):
+    ''' downloads the raw values of the bands around a point as a (height, width, bands) array '''
+
     # Calculate buffer size based on zoom level
     meters_per_pixel = 156543.03392 * np.cos(np.radians(latitude)) / (2 ** zoom_level)
     buffer_meters = meters_per_pixel * max(image_size) / 2  # Half the image size in meters
@@ -94,7 +156,6 @@ def get_sentinel_image( # get the most recent sentinel-2 image
     image_data = image_data.getInfo()
     
     # Extract band data from properties
-    bands = ['B4', 'B3', 'B2']
     image_arrays = []
     for band in bands:
         if band in image_data['properties']:
@@ -107,31 +168,8 @@ def get_sentinel_image( # get the most recent sentinel-2 image
     if not image_arrays:
         raise ValueError("No valid band data found in the image")
     
-    # Stack bands into RGB image
-    image_array = np.stack(image_arrays, axis=-1)
-    
-    # Print value ranges for debugging
-    print("\nValue ranges before normalization:")
-    for i, band in enumerate(bands):
-        print(f"{band}: min={np.min(image_array[:,:,i]):.1f}, max={np.max(image_array[:,:,i]):.1f}")
-    
-    # Clip values to valid range and normalize
-    image_array = np.clip(image_array, vis_params['min'], vis_params['max'])
-    image_array = (image_array - vis_params['min']) / (vis_params['max'] - vis_params['min'])
-    
-    # Apply gamma correction
-    image_array = np.power(image_array, 1/vis_params['gamma'])
-    
-    # Apply contrast enhancement
-    image_array = np.clip(image_array * 1.2, 0, 1)  # Increase contrast by 20%
-    
-    # Resize to target dimensions
-    image_array = cv2.resize(image_array, image_size)
-    
-    # Calculate metadata
-    metadata = calculate_image_metadata(latitude, longitude, zoom_level, image_size)
-    
-    return image_array, metadata
+    # Stack bands into RGB image, reflectances fit in 16 bits
+    return np.stack(image_arrays, axis=-1).astype(np.uint16)
 
 def save_sentinel_image(
     latitude: float,
@@ -148,7 +186,7 @@ def save_sentinel_image(
     )
     
     # Save the image
-    plt.imsave(output_path, image_data)
+    save_image(output_path, image_data)
     
     # Print metadata
     print(f"\nImage Metadata:")
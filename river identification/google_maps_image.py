@@ -1,10 +1,23 @@
 import requests
 import os
 from typing import Tuple, Optional, Dict
-from config import GOOGLE_MAPS_API_KEY
 import cv2
 import numpy as np
 from datetime import datetime
+from tile_cache import decode_image, encode_array, get_cache, tile_key
+
+try:
+    from config import GOOGLE_MAPS_API_KEY
+except ImportError:
+    # No local config.py, the key comes from the environment instead
+    GOOGLE_MAPS_API_KEY = None
+
+# Static Maps endpoint, overridable to point at a local fake tile server
+STATIC_MAPS_URL = os.getenv('GOOGLE_MAPS_STATIC_URL', "https://maps.googleapis.com/maps/api/staticmap")
+
+# Extra rows requested to crop the Google attribution off, half from the top
+# and half from the bottom so the image stays centred on the requested point
+ATTRIBUTION_ROWS = 40
 
 def calculate_image_metadata(
     latitude: float,
@@ -40,8 +53,10 @@ def get_map_image(
     longitude: float,  # long of centre
     zoom_level: int = 21,  # default to maximum zoom
     api_key: Optional[str] = None,
-    image_size: Tuple[int, int] = (640, 640)
-) -> Tuple[bytes, Dict[str, float]]:
+    image_size: Tuple[int, int] = (640, 640),
+    session: Optional[requests.Session] = None,
+    use_cache: bool = True
+) -> Tuple[np.ndarray, Dict[str, float]]:
     """
     Get a Google Maps static image centered on a coordinate with a specified zoom level.
     
@@ -51,27 +66,37 @@ def get_map_image(
         zoom_level (int): Zoom level (0-21, default 21 for maximum detail)
         api_key (str, optional): Google Maps API key
         image_size (tuple): Size of the output image in pixels (width, height)
+        session (requests.Session, optional): Pooled session to reuse connections
+            across requests, a new connection is opened per call without one
+        use_cache (bool): Look in the on-disk tile cache before the network and
+            store what is downloaded there
     
     Returns:
-        tuple: (image_data, metadata)
+        tuple: (image, metadata), image a BGR uint8 array as cv2.imread would give,
+            write it to disk with save_image
     """
-    # Get API key from config or environment if not provided
-    if api_key is None:
-        api_key = GOOGLE_MAPS_API_KEY or os.getenv('GOOGLE_MAPS_API_KEY')
-        if not api_key:
-            raise ValueError("Google Maps API key not provided and not found in config or environment variables")
-    
     # Ensure zoom level is within valid range
     zoom_level = max(0, min(21, zoom_level))
     
     # Calculate image metadata
     metadata = calculate_image_metadata(latitude, longitude, zoom_level, image_size)
     
-    # Construct the URL for the Static Maps API
-    base_url = "https://maps.googleapis.com/maps/api/staticmap"
+    # A repeat of an earlier request is read from disk, no API key or quota needed
+    cache = get_cache() if use_cache else None
+    key = tile_key('google_maps', latitude, longitude, zoom_level, image_size)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return decode_image(cached[0]), metadata
+    
+    # Get API key from config or environment if not provided
+    if api_key is None:
+        api_key = GOOGLE_MAPS_API_KEY or os.getenv('GOOGLE_MAPS_API_KEY')
+        if not api_key:
+            raise ValueError("Google Maps API key not provided and not found in config or environment variables")
     
     # Request a taller image to account for the attribution
-    request_height = image_size[1] + 40
+    request_height = image_size[1] + ATTRIBUTION_ROWS
     
     # Parameters for the API request
     params = {
@@ -84,30 +109,44 @@ def get_map_image(
     }
     
     # Make the request
-    response = requests.get(base_url, params=params)
+    response = (session or requests).get(STATIC_MAPS_URL, params=params, timeout=30)
     response.raise_for_status()  # Raise an exception for bad status codes
     
-    # Crop the Google attribution from the bottom and resize to desired dimensions
-    return crop_and_resize_image(response.content, image_size), metadata
+    # Crop the Google attribution and resize to desired dimensions
+    image = crop_and_resize_image(response.content, image_size)
+    if cache is not None:
+        cache.put(key, encode_array(image), {'latitude': latitude, 'longitude': longitude})
+    return image, metadata
 
-def crop_and_resize_image(image_data: bytes, target_size: Tuple[int, int]) -> bytes:
+def crop_and_resize_image(image_data: bytes, target_size: Tuple[int, int]) -> np.ndarray:
     ''' gets rid of the google maps logo/copyright shit at the bottom
-    so we can piece the images together '''
+    so we can piece the images together. Decodes the PNG from Google, the
+    only decode a tile goes through, and returns the BGR array.
+    As many rows come off the top as the bottom, so the image is still
+    centred on the coordinate it was requested for '''
     
     # Convert bytes to numpy array
     nparr = np.frombuffer(image_data, np.uint8)
     img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     
-    # Crop the bottom 40 pixels (where the attribution is)
-    height = img.shape[0]
-    cropped_img = img[0:height-40, :]
-    
-    # Resize to target dimensions
-    resized_img = cv2.resize(cropped_img, target_size)
-    
-    # Convert back to bytes
-    _, buffer = cv2.imencode('.png', resized_img)
-    return buffer.tobytes()
+    # Crop down to the target's shape, evenly from top and bottom (the
+    # attribution is in the bottom rows). Works out the same whatever scale
+    # Google returned the image at
+    height, width = img.shape[:2]
+    keep = int(round(width * target_size[1] / target_size[0]))
+    top = (height - keep) // 2
+    cropped_img = img[top:top + keep, :]
+    
+    # Resize to target dimensions, the crop is a view so this is the only copy
+    if cropped_img.shape[1::-1] == tuple(target_size):
+        return cropped_img
+    return cv2.resize(cropped_img, target_size)
+
+def save_image(output_path: str, image: np.ndarray) -> None:
+    ''' encodes a BGR array in the format of output_path's extension and writes it,
+    images are only ever encoded here, when they are kept on disk '''
+    if not cv2.imwrite(output_path, image):
+        raise ValueError(f"Could not write an image to {output_path}")
 
 def save_map_image(
     latitude: float,
@@ -117,7 +156,7 @@ def save_map_image(
     api_key: Optional[str] = None,
     image_size: Tuple[int, int] = (640, 640)):
  
-    image_data, metadata = get_map_image(
+    image, metadata = get_map_image(
         latitude=latitude,
         longitude=longitude,
         zoom_level=zoom_level,
@@ -125,8 +164,7 @@ def save_map_image(
         image_size=image_size
     )
     
-    with open(output_path, 'wb') as f:
-        f.write(image_data)
+    save_image(output_path, image)
     
     # Print metadata
     print(f"\nImage Metadata:")
@@ -1,16 +1,16 @@
 # Necessary Libraries
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
+# matplotlib and scikit-learn are imported in the functions that use them, so importing this module stays fast
 
 # Approach 1: K-Means Clustering
-def kclustering(cv2_image):
-    '''Using K-Means Clustering to identify a river in a image read by OpenCV
-    Input: cv2_image - Image read by OpenCV
-    Output: Visualisation of the original image, the segmented image and the river mask
-    Possible adjustments: Number of clusters, gaussian blurring, adjustment to the inital state of the KMeans object
+def kmeans_mask(cv2_image):
+    '''The K-Means river segmentation without any plotting, so it can run unattended
+    Input: cv2_image - Image read by OpenCV (BGR)
+    Output: (segmented_image, river_mask) - the cluster of every pixel, and a uint8 mask where river is 255
     '''
+    from sklearn.cluster import KMeans
+
     # Convert to right formats
     image_rgb = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2RGB) # Ensures data is in the correct format as satellite images are often in BGR.
     # Returns object of dimension (height, width, 3) where 3 represents the RGB values of the pixel.
@@ -25,11 +25,68 @@ def kclustering(cv2_image):
 
     # Now we reshape the labels to the original image dimensions
     segmented_image = labels.reshape(image_rgb.shape[:2])
-
-    # Visualisation
-    highlighted_image = np.zeros_like(image_rgb)
     river_mask = (segmented_image == river_cluster).astype(np.uint8) * 255 # Creates mask for the image where river is white and not river is black.
+    return segmented_image, river_mask
+
+# Pixels the fast K-Means is fitted on, out of the 409,600 in a 640x640 tile
+KMEANS_SAMPLE_SIZE = 10000
+
+def fast_kmeans_mask(cv2_image, init_centroids=None, sample_size=KMEANS_SAMPLE_SIZE, random_state=0, valid=None):
+    '''K-Means river segmentation fitted on a random sample of pixels rather than all of them
+    Input: cv2_image - Image read by OpenCV (BGR)
+           init_centroids - RGB centroids to start from, e.g. those of the previous tile along the
+           river, whose water and land colours are nearly the same. None starts from k-means++
+           sample_size - Pixels to fit on, the whole image is still labelled
+           valid - Optional boolean (height, width) array, only these pixels are fitted on and
+           the rest are never river, e.g. the empty parts of a mosaic window
+    Output: (segmented_image, river_mask, centroids) - as kmeans_mask, plus the centroids to pass to the next tile
+    '''
+    from sklearn.cluster import KMeans
+
+    image_rgb = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2RGB)
+    pixels = image_rgb.reshape(-1, 3)
+
+    # A few thousand pixels pin down two colour clusters as well as every pixel does
+    rng = np.random.default_rng(random_state)
+    candidates = np.flatnonzero(valid.reshape(-1)) if valid is not None else np.arange(len(pixels))
+    if len(candidates) < 2:
+        return np.zeros(image_rgb.shape[:2], np.int64), np.zeros(image_rgb.shape[:2], np.uint8), init_centroids
+    if len(candidates) > sample_size:
+        sample = pixels[rng.choice(candidates, sample_size, replace=False)]
+    else:
+        sample = pixels[candidates]
+    if init_centroids is not None:
+        # Starting at the answer to the last tile, one run of a few iterations is enough
+        kmeans = KMeans(n_clusters=2, init=np.asarray(init_centroids, dtype=np.float64), n_init=1, random_state=random_state)
+    else:
+        kmeans = KMeans(n_clusters=2, random_state=random_state)
+    kmeans.fit(sample.astype(np.float64))
+    centroids = kmeans.cluster_centers_
+
+    # Label every pixel with its nearest centroid in one matrix product, instead of kmeans.predict.
+    # |x - c|^2 = |x|^2 - 2x.c + |c|^2 and |x|^2 is the same for every centroid, so it is left out
+    c = centroids.astype(np.float32)
+    labels = (pixels.astype(np.float32) @ (-2 * c.T) + (c ** 2).sum(axis=1)).argmin(axis=1)
+    river_cluster = np.argmin(centroids[:, 0] + centroids[:, 1])  # Choose cluster with lowest (R+G) values
 
+    segmented_image = labels.reshape(image_rgb.shape[:2])
+    river_mask = (segmented_image == river_cluster).astype(np.uint8) * 255
+    if valid is not None:
+        river_mask[~valid] = 0
+    return segmented_image, river_mask, centroids
+
+def kclustering(cv2_image):
+    '''Using K-Means Clustering to identify a river in a image read by OpenCV
+    Input: cv2_image - Image read by OpenCV
+    Output: Visualisation of the original image, the segmented image and the river mask, returns the river mask
+    Possible adjustments: Number of clusters, gaussian blurring, adjustment to the inital state of the KMeans object
+    '''
+    import matplotlib.pyplot as plt
+
+    image_rgb = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2RGB)
+    segmented_image, river_mask = kmeans_mask(cv2_image)
+
+    # Visualisation
     plt.figure(figsize=(15, 5)) # Arbitrary figure size chosen, can be adjusted as necessary.
     # Subplot 1: Original Image
     plt.subplot(131)  # Numbers mean (1 row, 3 columns, position 1)
@@ -47,13 +104,13 @@ def kclustering(cv2_image):
     plt.title('Identified River')
     plt.axis('off')
     plt.show()
+    return river_mask
 
 # Approach 2: Contours
-def contouring(cv2_image):
-    '''Using canny edge detection and contours to identify a river in a image read by OpenCV
-    Input: cv2_image - Image read by OpenCV
-    Output: Visualisation of the original image and the image with river contours
-    Adjustments: Canny edge detection thresholds, contour settings (CHAIN_APPROX_SIMPLE)
+def river_contours(cv2_image):
+    '''The canny edge and contour detection without any plotting, so it can run unattended
+    Input: cv2_image - Image read by OpenCV (BGR)
+    Output: contours - the external contours found, as returned by cv2.findContours
     '''
     #Convert the image to grayscale
     gray = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
@@ -65,6 +122,17 @@ def contouring(cv2_image):
     # Find contours
     contours, hierarchy = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE) # Retrieves only the external contours as we only
     # want the boundary of the river. Simple is just a setting to save memory
+    return contours
+
+def contouring(cv2_image):
+    '''Using canny edge detection and contours to identify a river in a image read by OpenCV
+    Input: cv2_image - Image read by OpenCV
+    Output: Visualisation of the original image and the image with river contours, returns the contours
+    Adjustments: Canny edge detection thresholds, contour settings (CHAIN_APPROX_SIMPLE)
+    '''
+    import matplotlib.pyplot as plt
+
+    contours = river_contours(cv2_image)
 
     #Draw the contours on the original image to visualize the river
     river_image = cv2_image.copy()
@@ -74,8 +142,10 @@ def contouring(cv2_image):
     plt.subplot(121), plt.imshow(cv2.cvtColor(cv2_image, cv2.COLOR_BGR2RGB)), plt.title('Original Image')
     plt.subplot(122), plt.imshow(cv2.cvtColor(river_image, cv2.COLOR_BGR2RGB)), plt.title('River Contours')
     plt.show()
-garbled = cv2.imread(r"/Users/tom/Documents/Biodevices/Repository Git/Biodevices-Back-End/river identification/UoB_sentinel.png")
-proper = cv2.imread(r"/Users/tom/Documents/Biodevices/Repository Git/Biodevices-Back-End/river identification/UoB_gmap.png")
-test = cv2.imread(r"/Users/tom/Documents/Biodevices/Repository Git/Biodevices-Back-End/river identification/images/google_maps_2.png")
-# kclustering(test)
-contouring(test)
\ No newline at end of file
+    return contours
+if __name__ == "__main__":
+    garbled = cv2.imread(r"/Users/tom/Documents/Biodevices/Repository Git/Biodevices-Back-End/river identification/UoB_sentinel.png")
+    proper = cv2.imread(r"/Users/tom/Documents/Biodevices/Repository Git/Biodevices-Back-End/river identification/UoB_gmap.png")
+    test = cv2.imread(r"/Users/tom/Documents/Biodevices/Repository Git/Biodevices-Back-End/river identification/images/google_maps_2.png")
+    # kclustering(test)
+    contouring(test)
\ No newline at end of file
@@ -0,0 +1,25 @@
+import numpy as np
+
+# Web Mercator tiles are 256 pixels wide at every zoom level
+TILE_SIZE = 256
+
+# Web Mercator is undefined at the poles, latitudes are clipped to this
+MAX_LATITUDE = 85.05112878
+
+
+def to_pixels(latitude, longitude, zoom_level: int):
+    ''' world pixel coordinates (x east, y south) of lat/lon at a zoom level,
+    the grid Google Maps images are drawn on. Works on scalars or arrays '''
+    world = TILE_SIZE * 2.0 ** zoom_level
+    sin_lat = np.sin(np.radians(np.clip(latitude, -MAX_LATITUDE, MAX_LATITUDE)))
+    x = (np.asarray(longitude) + 180.0) / 360.0 * world
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * world
+    return x, y
+
+
+def to_lat_lon(x, y, zoom_level: int):
+    ''' inverse of to_pixels '''
+    world = TILE_SIZE * 2.0 ** zoom_level
+    longitude = np.asarray(x) / world * 360.0 - 180.0
+    latitude = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y) / world))))
+    return latitude, longitude
@@ -0,0 +1,214 @@
+import json
+import os
+from collections import OrderedDict
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from google_maps_image import calculate_image_metadata
+from mercator import to_lat_lon, to_pixels
+
+# Side of the square chunks a raster is stored in, in pixels
+CHUNK_SIZE = 1024
+
+# Chunks kept open at once; memory use is at most this many chunks however long the river
+MAX_OPEN_CHUNKS = 16
+
+# Extra pixels read around each segmentation window, so rivers crossing a window
+# edge are segmented with their surroundings and windows join up without seams
+DEFAULT_HALO = 64
+
+
+class ChunkedRaster:
+    '''
+    A raster on the Web Mercator pixel grid of one zoom level, stored as
+    CHUNK_SIZE square .npy chunks that are memory mapped when touched.
+
+    Only chunks something was written to exist on disk, so a long diagonal river
+    costs its corridor rather than its whole bounding box. Coordinates are world
+    pixels (x east, y south) as mercator.to_pixels returns; the last channel of
+    an image raster is an alpha channel, 255 wherever a tile was written.
+    '''
+    def __init__(self, directory: str, zoom_level: Optional[int] = None, channels: Optional[int] = None,
+                 chunk_size: int = CHUNK_SIZE, max_open: int = MAX_OPEN_CHUNKS):
+        self.directory = directory
+        self.max_open = max_open
+        self._open = OrderedDict()
+        meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            if zoom_level is None or channels is None:
+                raise ValueError(f"No raster in {directory}, give a zoom_level and channels to create one")
+            os.makedirs(os.path.join(directory, 'chunks'), exist_ok=True)
+            self.meta = {'zoom_level': zoom_level, 'channels': channels, 'chunk_size': chunk_size}
+            with open(meta_path, 'w') as f:
+                json.dump(self.meta, f)
+        self.zoom_level = self.meta['zoom_level']
+        self.channels = self.meta['channels']
+        self.chunk_size = self.meta['chunk_size']
+
+    def _chunk_path(self, cx: int, cy: int) -> str:
+        return os.path.join(self.directory, 'chunks', f"{cx}_{cy}.npy")
+
+    def _chunk(self, cx: int, cy: int, create: bool) -> Optional[np.ndarray]:
+        # Memory map of a chunk, least recently used ones are flushed and closed
+        key = (cx, cy)
+        if key in self._open:
+            self._open.move_to_end(key)
+            return self._open[key]
+        path = self._chunk_path(cx, cy)
+        if os.path.exists(path):
+            chunk = np.load(path, mmap_mode='r+')
+        elif create:
+            shape = (self.chunk_size, self.chunk_size, self.channels)
+            chunk = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+        else:
+            return None
+        self._open[key] = chunk
+        while len(self._open) > self.max_open:
+            _, old = self._open.popitem(last=False)
+            old.flush()
+        return chunk
+
+    def _spans(self, x: int, y: int, width: int, height: int) -> Iterator[Tuple[int, int, slice, slice, slice, slice]]:
+        # The part of each chunk a window covers: chunk, slices into the chunk, slices into the window
+        size = self.chunk_size
+        for cy in range(y // size, (y + height - 1) // size + 1):
+            for cx in range(x // size, (x + width - 1) // size + 1):
+                x0, x1 = max(x, cx * size), min(x + width, (cx + 1) * size)
+                y0, y1 = max(y, cy * size), min(y + height, (cy + 1) * size)
+                yield (cx, cy,
+                       slice(y0 - cy * size, y1 - cy * size), slice(x0 - cx * size, x1 - cx * size),
+                       slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+
+    def write(self, x: int, y: int, array: np.ndarray) -> None:
+        ''' write a (height, width, channels) array with its top left corner at world pixel (x, y) '''
+        array = array.reshape(array.shape[0], array.shape[1], -1)
+        for cx, cy, chunk_rows, chunk_cols, rows, cols in self._spans(x, y, array.shape[1], array.shape[0]):
+            self._chunk(cx, cy, create=True)[chunk_rows, chunk_cols] = array[rows, cols]
+
+    def read(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        ''' the (height, width, channels) window at world pixel (x, y), zeros where nothing was written '''
+        window = np.zeros((height, width, self.channels), np.uint8)
+        for cx, cy, chunk_rows, chunk_cols, rows, cols in self._spans(x, y, width, height):
+            chunk = self._chunk(cx, cy, create=False)
+            if chunk is not None:
+                window[rows, cols] = chunk[chunk_rows, chunk_cols]
+        return window
+
+    def chunks(self) -> List[Tuple[int, int]]:
+        ''' (cx, cy) of every chunk on disk, in row order '''
+        found = []
+        for name in os.listdir(os.path.join(self.directory, 'chunks')):
+            cx, cy = os.path.splitext(name)[0].split('_')
+            found.append((int(cx), int(cy)))
+        return sorted(found, key=lambda c: (c[1], c[0]))
+
+    def chunk_bounds(self, cx: int, cy: int) -> Tuple[float, float, float, float]:
+        ''' (min_lon, min_lat, max_lon, max_lat) a chunk covers '''
+        size = self.chunk_size
+        max_lat, min_lon = to_lat_lon(cx * size, cy * size, self.zoom_level)
+        min_lat, max_lon = to_lat_lon((cx + 1) * size, (cy + 1) * size, self.zoom_level)
+        return float(min_lon), float(min_lat), float(max_lon), float(max_lat)
+
+    def flush(self) -> None:
+        for chunk in self._open.values():
+            chunk.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._open.clear()
+
+
+def mosaic_tiles(
+    tiles: Iterable[Tuple[float, float, np.ndarray]],
+    directory: str,
+    zoom_level: int,
+    max_open: int = MAX_OPEN_CHUNKS) -> ChunkedRaster:
+    '''
+    Place images fetched along a river onto one raster.
+
+    Each image is drawn at its true position on the zoom level's Web Mercator
+    grid, centred on the (latitude, longitude) it was requested for, so
+    overlapping frames line up pixel for pixel and later ones simply overwrite
+    the overlap. Tiles can come from a generator, only the open chunks and the
+    current tile are ever in memory.
+
+    Parameters:
+        tiles: (latitude, longitude, image) with image a BGR uint8 array already
+            cropped of the Google attribution (crop_and_resize_image)
+        directory: Where the raster is stored, an existing one is added to
+        zoom_level: Zoom the images were fetched at
+        max_open: Chunks held in memory at once
+
+    Returns:
+        ChunkedRaster: 4 channels, BGR plus alpha
+    '''
+    raster = ChunkedRaster(directory, zoom_level, channels=4, max_open=max_open)
+    if raster.zoom_level != zoom_level:
+        raise ValueError(f"{directory} holds zoom {raster.zoom_level} images, not zoom {zoom_level}")
+    latitudes = []
+    for latitude, longitude, image in tiles:
+        height, width = image.shape[:2]
+        x, y = to_pixels(latitude, longitude, zoom_level)
+        tile = np.empty((height, width, 4), np.uint8)
+        tile[..., :3] = image
+        tile[..., 3] = 255
+        raster.write(int(round(float(x) - width / 2)), int(round(float(y) - height / 2)), tile)
+        latitudes.append(latitude)
+    raster.flush()
+
+    if latitudes:
+        # Ground resolution for whoever reads the raster later; it varies with latitude, so the middle of the river's
+        resolution = calculate_image_metadata(float(np.median(latitudes)), 0.0, zoom_level, (1, 1))
+        raster.meta['meters_per_pixel'] = float(resolution['meters_per_pixel'])
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump(raster.meta, f)
+    return raster
+
+
+def mosaic_files(plan, image_dir: str, directory: str, zoom_level: int, max_open: int = MAX_OPEN_CHUNKS) -> ChunkedRaster:
+    ''' mosaic the images fetcher.fetch_map_images saved for a coverage plan, read one at a time '''
+    import cv2
+    from fetcher import point_key
+
+    def tiles():
+        for latitude, longitude in zip(plan['Latitude'], plan['Longitude']):
+            path = os.path.join(image_dir, f"{point_key('google_maps', latitude, longitude, zoom_level)}.png")
+            image = cv2.imread(path, cv2.IMREAD_COLOR)
+            if image is not None:
+                yield latitude, longitude, image
+
+    return mosaic_tiles(tiles(), directory, zoom_level, max_open)
+
+
+def segment_mosaic(
+    raster: ChunkedRaster,
+    directory: str,
+    halo: int = DEFAULT_HALO,
+    max_open: int = MAX_OPEN_CHUNKS) -> ChunkedRaster:
+    '''
+    Segment a whole mosaic one chunk-sized window at a time.
+
+    Each window is read with a halo of surrounding pixels so the river is
+    segmented across tile and window edges, then only its centre is kept. The
+    K-Means centroids carry over from window to window. Empty parts of the
+    mosaic are never river.
+
+    Returns:
+        ChunkedRaster: 1 channel, 255 where there is river
+    '''
+    from identification import fast_kmeans_mask
+
+    masks = ChunkedRaster(directory, raster.zoom_level, channels=1, chunk_size=raster.chunk_size, max_open=max_open)
+    size = raster.chunk_size
+    centroids = None
+    for cx, cy in raster.chunks():
+        window = raster.read(cx * size - halo, cy * size - halo, size + 2 * halo, size + 2 * halo)
+        valid = window[..., 3] > 0
+        _, mask, centroids = fast_kmeans_mask(window[..., :3], centroids, valid=valid)
+        masks.write(cx * size, cy * size, mask[halo:halo + size, halo:halo + size])
+    masks.flush()
+    return masks
@@ -1,9 +1,8 @@
-import geopandas as gpd
-import pandas as pd
-
 def extract_river_coordinates(shapefile, river_name_column, river_name):
     """
     Extract longitude and latitude of points from a river LineString geometry in a Shapefile.
+    The first call builds the shapefile's catalogue (see catalogue.py), which takes as
+    long as reading the whole shapefile; every later call, in any process, reuses it.
 
     Parameters:
         shapefile (str): Path to the Shapefile (.shp).
@@ -11,36 +10,23 @@ def extract_river_coordinates(shapefile, river_name_column, river_name):
         river_name (str): The river name to filter by.
 
     Returns:
-        pd.DataFrame: A DataFrame containing latitude and longitude points along the river.
+        pd.DataFrame: A DataFrame containing latitude and longitude points along the river,
+            and the Segment (LineString) each point belongs to.
     """
-    # Load dataset
-    gdf = gpd.read_file(shapefile)
-
-    # Filter dataset for the specified river
-    river_gdf = gdf[gdf[river_name_column] == river_name]
-
-    # Ensure the geometry is in WGS84 (EPSG:4326)
-    river_gdf = river_gdf.to_crs(epsg=4326)
-
-    # Extract coordinates from LineString geometries
-    coords = []
-    for geom in river_gdf.geometry:
-        if geom.geom_type == "LineString":  # If the river is stored as a LineString
-            for point in geom.coords:
-                coords.append({"Latitude": point[1], "Longitude": point[0]})
-        elif geom.geom_type == "MultiLineString":  # If the river has multiple segments
-            for line in geom.geoms:
-                for point in line.coords:
-                    coords.append({"Latitude": point[1], "Longitude": point[0]})
+    from catalogue import open_catalogue
 
-    return pd.DataFrame(coords)
+    # The shapefile is parsed and reprojected once, into a catalogue next to it,
+    # after that a river is a name index lookup and a slice of memory mapped arrays
+    catalogue = open_catalogue(shapefile, river_name_column)
+    return catalogue.coordinates(catalogue.by_name(river_name))
 
 
 
 # Example usage
-shapefile = "c:/Users/Jamie/Documents/GitHub/Back-End/river identification/WatercourseLink.shp"  # File path
-river_name_column = "name1"  # Select the column containing the river names
-river_name = "Burn of Sulerdale"  # Specific river
-    
-coordinates_gdf = extract_river_coordinates(shapefile, river_name_column, river_name)
-print(coordinates_gdf)
\ No newline at end of file
+if __name__ == "__main__":
+    shapefile = "c:/Users/Jamie/Documents/GitHub/Back-End/river identification/WatercourseLink.shp"  # File path
+    river_name_column = "name1"  # Select the column containing the river names
+    river_name = "Burn of Sulerdale"  # Specific river
+        
+    coordinates_gdf = extract_river_coordinates(shapefile, river_name_column, river_name)
+    print(coordinates_gdf)
\ No newline at end of file
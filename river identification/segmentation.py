@@ -0,0 +1,299 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+import identification
+
+# Segmentation methods the pipeline runs on every tile, each taking a BGR image and returning
+# a uint8 river mask (river = 255). kmeans_fast fits on a sample of pixels and starts from the
+# previous tile's centroids
+METHODS = ('kmeans_fast', 'contours')
+
+# Full KMeans over every pixel, still accepted by river_mask and segment_batch as the
+# reference kmeans_fast is benchmarked against, but too slow to run on every tile
+REFERENCE_METHODS = ('kmeans',)
+
+# Consecutive images handed to a worker process at a time. They are segmented in
+# order, so kmeans_fast warm-starts from its neighbour along the river within a chunk
+DEFAULT_CHUNKSIZE = 8
+
+ImageSource = Union[str, np.ndarray]
+
+
+def load_image(source: ImageSource) -> np.ndarray:
+    ''' the BGR array of a path, or the array itself '''
+    if isinstance(source, np.ndarray):
+        return source
+    image = cv2.imread(source, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not read an image from {source}")
+    return image
+
+
+def river_mask(image: np.ndarray, method: str = 'kmeans_fast', centroids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    ''' (mask, centroids), centroids are those kmeans_fast settled on, for the next tile '''
+    if method == 'kmeans':
+        return identification.kmeans_mask(image)[1], None
+    if method == 'kmeans_fast':
+        _, mask, centroids = identification.fast_kmeans_mask(image, centroids)
+        return mask, centroids
+    if method == 'contours':
+        # Fill the outlines found by the edge detector to get an area
+        mask = np.zeros(image.shape[:2], np.uint8)
+        cv2.drawContours(mask, identification.river_contours(image), -1, 255, cv2.FILLED)
+        return mask, None
+    raise ValueError(f"Unknown segmentation method {method}, expected one of {METHODS + REFERENCE_METHODS}")
+
+
+def mask_features(mask: np.ndarray) -> Dict[str, Any]:
+    ''' water-pixel fraction and the areas (in pixels) of the separate river regions of a mask '''
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return {
+        'water_fraction': float(np.count_nonzero(mask)) / mask.size,
+        'contour_areas': np.array([cv2.contourArea(c) for c in contours], dtype=np.float64)
+    }
+
+
+def segment_image(source: ImageSource, method: str = 'kmeans_fast', centroids: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    ''' mask, features and (for kmeans_fast) centroids of one image, nothing is displayed '''
+    mask, centroids = river_mask(load_image(source), method, centroids)
+    return {'mask': mask, 'centroids': centroids, **mask_features(mask)}
+
+
+def source_name(index: int, source: ImageSource) -> str:
+    # File name for paths, position in the batch for arrays
+    if isinstance(source, str):
+        return os.path.splitext(os.path.basename(source))[0]
+    return f"tile_{index}"
+
+
+def _segment_one(
+    index: int,
+    source: ImageSource,
+    name: str,
+    methods: Tuple[str, ...],
+    output_dirs: Dict[str, str],
+    keep_mask: bool,
+    centroids: Dict[str, Optional[np.ndarray]]
+) -> List[Tuple[str, int, Optional[Dict[str, Any]], Optional[str]]]:
+    # Every method on one image, read once. centroids is updated for the next image;
+    # errors are returned rather than raised so one unreadable tile doesn't stop the batch
+    try:
+        image = load_image(source)
+    except Exception as e:
+        return [(method, index, None, str(e)) for method in methods]
+    results = []
+    for method in methods:
+        try:
+            result = segment_image(image, method, centroids.get(method))
+            centroids[method] = result['centroids']
+            if method in output_dirs:
+                cv2.imwrite(os.path.join(output_dirs[method], f"{name}_mask.png"), result['mask'])
+            if not keep_mask:
+                # Not sent back from the worker at all
+                del result['mask']
+            results.append((method, index, result, None))
+        except Exception as e:
+            results.append((method, index, None, str(e)))
+    return results
+
+
+def _segment_task(task: Tuple[List[Tuple[int, ImageSource, str]], Tuple[str, ...], Dict[str, str], bool]) -> List[Tuple[str, int, Optional[Dict[str, Any]], Optional[str]]]:
+    # Runs in a worker process over a chunk of consecutive images
+    chunk, methods, output_dirs, keep_mask = task
+    centroids = {}
+    return [result for index, source, name in chunk
+            for result in _segment_one(index, source, name, methods, output_dirs, keep_mask, centroids)]
+
+
+def _init_worker():
+    # One thread per process: the pool already uses every core, and letting each
+    # KMeans fit start a thread per core as well only makes them fight over it
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(1)
+
+
+class BatchSegmenter:
+    '''
+    Segment images as they arrive, e.g. from fetcher's on_image, across every core.
+
+    Images are sent to the worker processes chunksize at a time, and add() waits
+    once two chunks per worker are in flight, so only those images are held
+    however long the river is. Each image is segmented with every method in one
+    go, so an array is copied to a worker once.
+
+    Parameters:
+        methods: Any of METHODS and REFERENCE_METHODS
+        output_dirs: Directory per method to write <name>_mask.png and features.csv to
+        workers: Processes to use, all cores by default. 1 segments each image in
+            this process as it is added, nothing is sent anywhere
+        keep_masks: Return the masks as well as the features. Turn off for long
+            batches written to output_dirs, the masks are the bulk of the memory
+        chunksize: Consecutive images sent to a worker at a time
+    '''
+    def __init__(
+        self,
+        methods: Tuple[str, ...] = METHODS,
+        output_dirs: Optional[Dict[str, str]] = None,
+        workers: Optional[int] = None,
+        keep_masks: bool = True,
+        chunksize: int = DEFAULT_CHUNKSIZE
+    ):
+        for method in methods:
+            if method not in METHODS + REFERENCE_METHODS:
+                raise ValueError(f"Unknown segmentation method {method}, expected one of {METHODS + REFERENCE_METHODS}")
+        self.methods = tuple(methods)
+        self.output_dirs = dict(output_dirs or {})
+        for directory in self.output_dirs.values():
+            os.makedirs(directory, exist_ok=True)
+        self.workers = workers or os.cpu_count() or 1
+        self.keep_masks = keep_masks
+        self.chunksize = chunksize
+        self.names = []
+        self._results = []
+        self._chunk = []
+        self._pending = set()
+        self._centroids = {}
+        self._pool = None
+        self._start = None
+
+    def add(self, source: ImageSource, name: Optional[str] = None) -> None:
+        ''' queue one image path or BGR array, name defaults as in source_name '''
+        if self._start is None:
+            self._start = time.perf_counter()
+        index = len(self.names)
+        name = name if name is not None else source_name(index, source)
+        self.names.append(name)
+        if self.workers == 1:
+            # Every tile warm-starts from the one before
+            self._results.extend(_segment_one(index, source, name, self.methods, self.output_dirs, self.keep_masks, self._centroids))
+            return
+        self._chunk.append((index, source, name))
+        if len(self._chunk) >= self.chunksize:
+            self._submit()
+
+    def _submit(self) -> None:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        while len(self._pending) >= self.workers * 2:
+            finished, self._pending = wait(self._pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                self._results.extend(future.result())
+        self._pending.add(self._pool.submit(_segment_task, (self._chunk, self.methods, self.output_dirs, self.keep_masks)))
+        self._chunk = []
+
+    def close(self) -> Dict[str, Dict[str, Any]]:
+        '''
+        Wait for every image and shut the pool down.
+
+        Returns:
+            dict: By method, names, water_fraction (array), contour_count (array),
+                contour_areas (list of arrays), masks (list, if keep_masks),
+                errors by name, seconds and tiles_per_second
+        '''
+        try:
+            if self._chunk:
+                self._submit()
+            for future in self._pending:
+                self._results.extend(future.result())
+        finally:
+            self._pending = set()
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+        seconds = time.perf_counter() - self._start if self._start is not None else 0.0
+        return {method: self._summary(method, seconds) for method in self.methods}
+
+    def _summary(self, method: str, seconds: float) -> Dict[str, Any]:
+        names = self.names
+        water_fraction = np.full(len(names), np.nan)
+        contour_count = np.zeros(len(names), dtype=np.int64)
+        contour_areas = [np.empty(0)] * len(names)
+        masks = [None] * len(names)
+        errors = {}
+        for result_method, index, result, error in self._results:
+            if result_method != method:
+                continue
+            if error is not None:
+                errors[names[index]] = error
+                continue
+            water_fraction[index] = result['water_fraction']
+            contour_count[index] = len(result['contour_areas'])
+            contour_areas[index] = result['contour_areas']
+            if self.keep_masks:
+                masks[index] = result['mask']
+
+        if method in self.output_dirs:
+            import pandas as pd
+            pd.DataFrame({
+                'name': names,
+                'water_fraction': water_fraction,
+                'contour_count': contour_count,
+                'largest_contour_area': [areas.max() if len(areas) else 0.0 for areas in contour_areas]
+            }).to_csv(os.path.join(self.output_dirs[method], 'features.csv'), index=False)
+
+        done = len(names) - len(errors)
+        summary = {
+            'names': names,
+            'water_fraction': water_fraction,
+            'contour_count': contour_count,
+            'contour_areas': contour_areas,
+            'errors': errors,
+            'seconds': seconds,
+            'tiles_per_second': done / seconds if seconds else 0.0
+        }
+        if self.keep_masks:
+            summary['masks'] = masks
+        return summary
+
+
+def segment_batch(
+    sources: Iterable[ImageSource],
+    method: str = 'kmeans_fast',
+    output_dir: Optional[str] = None,
+    workers: Optional[int] = None,
+    keep_masks: bool = True,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    names: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    '''
+    Segment many images unattended, across every core.
+
+    Parameters:
+        sources: Image paths or BGR arrays. Paths are cheaper, arrays have to be
+            copied to the worker processes.
+        method: 'kmeans_fast', 'contours' or 'kmeans' (the slow reference)
+        output_dir: If given, each mask is written there as <name>_mask.png and
+            the features as features.csv
+        workers: Processes to use, all cores by default, 1 runs in this process
+        keep_masks: Return the masks as well as the features. Turn off for long
+            batches written to output_dir, the masks are the bulk of the memory
+        chunksize: Consecutive images sent to a worker at a time
+        names: Name of each image, for its mask file and errors. Defaults to
+            the file name of paths and tile_<position> for arrays
+
+    Returns:
+        dict: names, water_fraction (array), contour_count (array), contour_areas
+            (list of arrays), masks (list, if keep_masks), errors by name,
+            seconds and tiles_per_second
+    '''
+    output_dirs = {method: output_dir} if output_dir is not None else None
+    segmenter = BatchSegmenter((method,), output_dirs, workers, keep_masks, chunksize)
+    for i, source in enumerate(sources):
+        segmenter.add(source, names[i] if names is not None else None)
+    return segmenter.close()[method]
+
+
+# Example usage
+if __name__ == "__main__":
+    import glob
+    import sys
+
+    directory = sys.argv[1] if len(sys.argv) > 1 else "images"
+    paths = sorted(glob.glob(os.path.join(directory, "*.png")))
+    summary = segment_batch(paths, output_dir=os.path.join(directory, "masks"), keep_masks=False)
+    print(f"{len(paths)} tiles in {summary['seconds']:.1f} s, {summary['tiles_per_second']:.2f} tiles/s, {len(summary['errors'])} failed")
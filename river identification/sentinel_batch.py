@@ -0,0 +1,212 @@
+import datetime
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+import fetcher
+from google_earth_sat import SENTINEL_COLLECTION, SENTINEL_VIS_PARAMS, visualisation_table
+from mercator import TILE_SIZE, to_pixels
+
+# Images whose corners fall in the same square of this many pixels are fetched in
+# one computePixels call. A block is then at most (1024 + 640) pixels a side, at
+# 14 bytes a pixel (three uint16 bands and a float64 time) under the 48 MB
+# Earth Engine allows per request
+MAX_BLOCK_SIZE = 1024
+
+# Band holding when each pixel's image was taken, added to the mosaic
+TIME_BAND = 'time'
+
+# Radius of the earth Web Mercator (EPSG:3857) is defined on, in metres
+EARTH_RADIUS = 6378137.0
+
+
+class EarthEngineClient:
+    '''
+    The two Earth Engine calls the batch fetch makes. Pass a stand-in with the
+    same methods to fetch_sentinel_batch to run without Earth Engine, e.g.
+    test code/fake_earth_engine.py.
+    '''
+    def latest_image(self, bbox: Tuple[float, float, float, float], start: datetime.datetime, end: datetime.datetime, bands: List[str]):
+        '''
+        The most recent Sentinel-2 pixel at every point of a bounding box, as one
+        image with the bands plus TIME_BAND (milliseconds since the epoch).
+
+        The collection is filtered to the river's bounding box once and every
+        block is computed from this one image, instead of building a collection
+        per point.
+        '''
+        from google_earth_sat import initialize_earth_engine
+        ee = initialize_earth_engine()
+
+        def add_time(image):
+            return image.addBands(ee.Image.constant(image.get('system:time_start')).toDouble().rename(TIME_BAND))
+
+        # Sorted oldest first, so mosaic() leaves the newest image on top
+        return (ee.ImageCollection(SENTINEL_COLLECTION)
+                .filterDate(ee.Date(start), ee.Date(end))
+                .filterBounds(ee.Geometry.Rectangle(list(bbox)))
+                .map(add_time)
+                .sort('system:time_start')
+                .mosaic()
+                .select(bands + [TIME_BAND]))
+
+    def compute_pixels(self, image, x: int, y: int, width: int, height: int, zoom_level: int, bands: List[str]) -> np.ndarray:
+        '''
+        The (height, width, bands + time) window of image whose top left is world
+        pixel (x, y) at zoom_level, on the Web Mercator grid Google Maps images are
+        drawn on. One request, answered as a binary NumPy array rather than JSON.
+        '''
+        from google_earth_sat import initialize_earth_engine
+        ee = initialize_earth_engine()
+
+        scale = 2 * np.pi * EARTH_RADIUS / (TILE_SIZE * 2 ** zoom_level)  # EPSG:3857 metres per pixel
+        pixels = ee.data.computePixels({
+            'expression': image,
+            'fileFormat': 'NUMPY_NDARRAY',
+            'grid': {
+                'dimensions': {'width': width, 'height': height},
+                'affineTransform': {
+                    'scaleX': scale, 'shearX': 0, 'translateX': x * scale - np.pi * EARTH_RADIUS,
+                    'shearY': 0, 'scaleY': -scale, 'translateY': np.pi * EARTH_RADIUS - y * scale
+                },
+                'crsCode': 'EPSG:3857'
+            }
+        })
+        # A structured array with a field per band
+        return np.stack([pixels[band] for band in bands + [TIME_BAND]], axis=-1)
+
+
+def plan_blocks(windows: List[Tuple[int, int]], image_size: Tuple[int, int], max_block: int = MAX_BLOCK_SIZE) -> List[Tuple[int, int, int, int, List[int]]]:
+    '''
+    Group image windows into blocks fetched in one call each.
+
+    Windows are grouped by the max_block square their top left corner falls in,
+    and each block is the union of its windows, so at most
+    (max_block + image size) pixels a side.
+
+    Parameters:
+        windows: Top left world pixel (x, y) of each image
+        image_size: (width, height) of every image
+
+    Returns:
+        list: (x, y, width, height, indices of the windows in it)
+    '''
+    groups: Dict[Tuple[int, int], List[int]] = {}
+    for i, (x, y) in enumerate(windows):
+        groups.setdefault((x // max_block, y // max_block), []).append(i)
+    blocks = []
+    for members in groups.values():
+        x0 = min(windows[i][0] for i in members)
+        y0 = min(windows[i][1] for i in members)
+        x1 = max(windows[i][0] for i in members) + image_size[0]
+        y1 = max(windows[i][1] for i in members) + image_size[1]
+        blocks.append((x0, y0, x1 - x0, y1 - y0, members))
+    return blocks
+
+
+def to_display(raw: np.ndarray, vis_params: Dict = SENTINEL_VIS_PARAMS) -> np.ndarray:
+    ''' BGR uint8 image of raw RGB band values, as get_sentinel_image makes them '''
+    table = visualisation_table(vis_params)
+    rgb = table[np.clip(raw, vis_params['min'], vis_params['max']).astype(np.int64) - vis_params['min']]
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+
+def fetch_sentinel_batch(
+    points: Iterable[Tuple[float, float]],
+    output_dir: Optional[str] = "images",
+    zoom_level: int = 18,
+    image_size: Tuple[int, int] = (640, 640),
+    days: int = 7,
+    client: Optional[EarthEngineClient] = None,
+    workers: int = fetcher.DEFAULT_WORKERS,
+    rate: float = fetcher.DEFAULT_RATE,
+    on_image: Optional[Callable[[str, Any], None]] = None
+) -> Dict[str, Any]:
+    '''
+    Fetch the latest Sentinel-2 image of every point along a river in a few
+    batched requests, instead of two getInfo() round-trips per point.
+
+    One mosaic of the newest pixels in the last `days` is built for the bounding
+    box of all the points, then neighbouring images are fetched together as
+    blocks with computePixels, in parallel with fetcher's retries and rate
+    limit, and cut apart locally. Each image is exactly image_size pixels of
+    the zoom level's Web Mercator grid centred on its point, the same area
+    get_map_image covers (crop_and_resize_image takes its attribution evenly
+    off the top and bottom, so it stays centred too). The bands are resampled
+    onto that grid, so the pixels are not those of get_sentinel_image, which
+    samples the bands at their own resolution and resizes.
+
+    Images are saved as output_dir/sentinel2_<lat>_<lon>_z<zoom>.png and/or given
+    to on_image(key, image) as BGR uint8 arrays, as fetch_sentinel_images does.
+
+    Returns:
+        dict: done and failed images, errors by image key, calls (computePixels
+            requests made), seconds and tasks_per_second (images per second)
+    '''
+    from google_maps_image import save_image
+
+    client = client or EarthEngineClient()
+    points = list(points)
+    bands = list(SENTINEL_VIS_PARAMS['bands'])
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+
+    centres = [to_pixels(lat, lon, zoom_level) for lat, lon in points]
+    windows = [(int(round(float(x) - image_size[0] / 2)), int(round(float(y) - image_size[1] / 2))) for x, y in centres]
+    keys = [fetcher.point_key('sentinel2', lat, lon, zoom_level) for lat, lon in points]
+    summary = {'done': 0, 'skipped': 0, 'failed': 0, 'errors': {}, 'calls': 0}
+    if not points:
+        summary['seconds'], summary['tasks_per_second'] = 0.0, 0.0
+        return summary
+
+    # An image of margin, so every window is inside the collection's bounds
+    margin = max(image_size) * 156543.03392 / 2 ** zoom_level / 111320.0
+    latitudes, longitudes = zip(*points)
+    bbox = (min(longitudes) - margin, min(latitudes) - margin, max(longitudes) + margin, max(latitudes) + margin)
+    end = datetime.datetime.now()
+    image = client.latest_image(bbox, end - datetime.timedelta(days=days), end, bands)
+
+    blocks = plan_blocks(windows, image_size)
+    summary['calls'] = len(blocks)
+    # Images already counted done or failed, so a block that fails part way is only failed for the rest
+    finished = set()
+
+    def work(block):
+        x, y, width, height, _ = block
+        return client.compute_pixels(image, x, y, width, height, zoom_level, bands)
+
+    def cut(key, pixels):
+        x0, y0, _, _, members = blocks[int(key)]
+        for i in members:
+            x, y = windows[i]
+            window = pixels[y - y0:y - y0 + image_size[1], x - x0:x - x0 + image_size[0]]
+            acquired = window[image_size[1] // 2, image_size[0] // 2, -1]
+            if not acquired > 0:
+                # Masked pixel, no image of this point in the date range
+                summary['failed'] += 1
+                summary['errors'][keys[i]] = f"No Sentinel-2 image in the last {days} days"
+                finished.add(i)
+                continue
+            image_array = to_display(window[..., :-1])
+            if output_dir is not None:
+                save_image(os.path.join(output_dir, f"{keys[i]}.png"), image_array)
+            if on_image is not None:
+                on_image(keys[i], image_array)
+            summary['done'] += 1
+            finished.add(i)
+
+    blocks_summary = fetcher.run_parallel(((str(i), block) for i, block in enumerate(blocks)), work, cut, workers, rate)
+    # A block that failed after its retries, or while being cut, fails every image in it not yet finished
+    for block, error in blocks_summary['errors'].items():
+        for i in blocks[int(block)][4]:
+            if i in finished:
+                continue
+            summary['errors'][keys[i]] = error
+            summary['failed'] += 1
+    summary['seconds'] = time.perf_counter() - start
+    summary['tasks_per_second'] = summary['done'] / summary['seconds'] if summary['seconds'] else 0.0
+    return summary
@@ -0,0 +1,293 @@
+import atexit
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from mercator import to_pixels
+
+# Where cached imagery is kept, shared by every run and every river
+TILE_CACHE_DIR = os.getenv('TILE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tile_cache'))
+
+# Least recently used images are evicted once the cache grows past this
+MAX_CACHE_BYTES = int(os.getenv('TILE_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# TILE_CACHE=0 turns the cache off and always goes to the network
+CACHE_ENABLED = os.getenv('TILE_CACHE', '1') != '0'
+
+INDEX_FILE = 'index.sqlite'
+
+# Index of caches from before INDEX_FILE, imported into it on first use
+LEGACY_INDEX_FILE = 'index.json'
+
+# Seconds a process waits for another to finish writing the index
+LOCK_TIMEOUT = 30.0
+
+# Access times from hits are written to the index at most this often, in seconds
+ACCESS_FLUSH_INTERVAL = 5.0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY, blob TEXT NOT NULL, created REAL, accessed REAL, metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS blobs (blob TEXT PRIMARY KEY, bytes INTEGER NOT NULL, refs INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), total_bytes INTEGER NOT NULL);
+'''
+
+
+def snap_to_grid(latitude: float, longitude: float, zoom_level: int) -> Tuple[int, int]:
+    ''' the Web Mercator pixel a coordinate falls in at a zoom level. Coordinates
+    less than a pixel apart give the same image, so they share a cache entry '''
+    x, y = to_pixels(latitude, longitude, zoom_level)
+    return int(x), int(y)
+
+
+def tile_key(
+    provider: str,
+    latitude: float,
+    longitude: float,
+    zoom_level: int,
+    image_size: Tuple[int, int],
+    acquisition_date: Optional[str] = None) -> str:
+    ''' cache key of one image request: which imagery, where on the grid,
+    at what zoom and size, and for dated imagery when it was taken '''
+    x, y = snap_to_grid(latitude, longitude, zoom_level)
+    return f"{provider}/z{zoom_level}/{x}/{y}/{image_size[0]}x{image_size[1]}/{acquisition_date or 'latest'}"
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    ''' write to a temporary file next to path then rename it over path, so a
+    crash or a second process never leaves a half written file behind '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def encode_array(array: np.ndarray) -> bytes:
+    # .npy keeps the exact values and dtype, a PNG would round Sentinel-2 floats
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_array(data: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    ''' BGR array of a cached image, stored as .npy or, by older versions, as PNG '''
+    if data.startswith(b'\x93NUMPY'):
+        return decode_array(data)
+    import cv2
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
+class TileCache:
+    '''
+    On-disk imagery cache, safe to share between threads and processes.
+
+    Image files are content addressed: each is stored once under the SHA-256 of
+    its bytes in blobs/, however many keys point at it. Blobs are written and
+    read outside any lock, two writers of the same blob write the same bytes.
+    An SQLite index maps every key to its blob, size, access time and metadata,
+    and the least recently used keys are evicted once the blobs exceed
+    max_bytes. Each put is one small transaction, which SQLite serialises
+    across processes, and access times from hits are written in batches.
+    '''
+    def __init__(self, directory: str = TILE_CACHE_DIR, max_bytes: int = MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()  # guards _accessed only
+        self._accessed: Dict[str, float] = {}
+        self._last_flush = time.monotonic()
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        self._db().executescript(SCHEMA)
+        self._db().execute("INSERT OR IGNORE INTO stats (id, total_bytes) VALUES (0, 0)")
+        self._import_json_index()
+        atexit.register(self.flush)
+
+    def _db(self) -> sqlite3.Connection:
+        # One connection per thread, sqlite3 connections can't be shared between them
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.directory, INDEX_FILE), timeout=LOCK_TIMEOUT, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent writers
+        # in any process queue instead of failing half way through
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _import_json_index(self) -> None:
+        # Keep what a cache from before the SQLite index holds
+        path = os.path.join(self.directory, LEGACY_INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except ValueError:
+            entries = {}
+        removed = []
+        with self._transaction() as db:
+            for key, entry in sorted(entries.items(), key=lambda item: item[1]['accessed']):
+                removed += self._insert(db, key, entry['blob'], entry['bytes'], entry['created'], entry['accessed'], entry['metadata'])
+            removed += self._evict(db)
+        os.remove(path)
+        self._remove_blobs(removed)
+
+    def _blob_path(self, blob: str) -> str:
+        return os.path.join(self.directory, 'blobs', blob[:2], blob)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._db().execute("SELECT total_bytes FROM stats WHERE id = 0").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get(self, key: str) -> Optional[Tuple[bytes, Dict]]:
+        ''' (data, metadata) stored under key, or None on a miss '''
+        row = self._db().execute("SELECT blob, metadata FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            with open(self._blob_path(row[0]), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            # Blob deleted from under us, forget the key
+            with self._transaction() as db:
+                removed = self._drop(db, key)
+            self._remove_blobs(removed)
+            return None
+        with self._lock:
+            self._accessed[key] = time.time()
+            due = time.monotonic() - self._last_flush > ACCESS_FLUSH_INTERVAL
+        if due:
+            self.flush()
+        return data, json.loads(row[1])
+
+    def put(self, key: str, data: bytes, metadata: Optional[Dict] = None) -> None:
+        ''' store data under key, evicting least recently used keys if over the size limit '''
+        blob = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(blob)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, data)
+        now = time.time()
+        with self._transaction() as db:
+            removed = self._insert(db, key, blob, len(data), now, now, metadata or {})
+            removed += self._evict(db)
+        self._remove_blobs(removed)
+
+    def _insert(self, db, key: str, blob: str, size: int, created: float, accessed: float, metadata: Dict) -> List[str]:
+        # Point key at blob, returns blobs no key points at any more
+        removed = self._drop(db, key)
+        db.execute("INSERT INTO entries (key, blob, created, accessed, metadata) VALUES (?, ?, ?, ?, ?)",
+                   (key, blob, created, accessed, json.dumps(metadata)))
+        if db.execute("UPDATE blobs SET refs = refs + 1 WHERE blob = ?", (blob,)).rowcount == 0:
+            # A blob's bytes only count once however many keys share it
+            db.execute("INSERT INTO blobs (blob, bytes, refs) VALUES (?, ?, 1)", (blob, size))
+            db.execute("UPDATE stats SET total_bytes = total_bytes + ? WHERE id = 0", (size,))
+        return [b for b in removed if b != blob]
+
+    def _drop(self, db, key: str) -> List[str]:
+        # Remove a key, returns its blob if no other key points at it
+        row = db.execute("SELECT blob FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return []
+        blob = row[0]
+        db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        db.execute("UPDATE blobs SET refs = refs - 1 WHERE blob = ?", (blob,))
+        refs, size = db.execute("SELECT refs, bytes FROM blobs WHERE blob = ?", (blob,)).fetchone()
+        if refs:
+            return []
+        db.execute("DELETE FROM blobs WHERE blob = ?", (blob,))
+        db.execute("UPDATE stats SET total_bytes = total_bytes - ? WHERE id = 0", (size,))
+        return [blob]
+
+    def _evict(self, db) -> List[str]:
+        removed = []
+        total = db.execute("SELECT total_bytes FROM stats WHERE id = 0").fetchone()[0]
+        while total > self.max_bytes:
+            oldest = db.execute("SELECT key FROM entries ORDER BY accessed LIMIT 1").fetchone()
+            if oldest is None:
+                break
+            removed += self._drop(db, oldest[0])
+            total = db.execute("SELECT total_bytes FROM stats WHERE id = 0").fetchone()[0]
+        return removed
+
+    def _remove_blobs(self, blobs: List[str]) -> None:
+        # After the commit, so no key the index still holds loses its file
+        for blob in blobs:
+            try:
+                os.remove(self._blob_path(blob))
+            except FileNotFoundError:
+                pass
+
+    def flush(self) -> None:
+        ''' write access times from hits to the index '''
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+            self._last_flush = time.monotonic()
+        if accessed:
+            with self._transaction() as db:
+                db.executemany("UPDATE entries SET accessed = MAX(accessed, ?) WHERE key = ?",
+                               [(when, key) for key, when in accessed.items()])
+
+    def clear(self) -> None:
+        with self._transaction() as db:
+            blobs = [row[0] for row in db.execute("SELECT blob FROM blobs")]
+            db.execute("DELETE FROM entries")
+            db.execute("DELETE FROM blobs")
+            db.execute("UPDATE stats SET total_bytes = 0 WHERE id = 0")
+        self._remove_blobs(blobs)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[TileCache]:
+    ''' the shared cache, created on first use, or None if TILE_CACHE=0 '''
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = TileCache()
+        return _cache
+
+
+if __name__ == "__main__":
+    cache = get_cache()
+    if cache is None:
+        print("Tile cache disabled (TILE_CACHE=0)")
+    else:
+        print(f"{cache.directory}: {len(cache)} images, {cache.total_bytes / 1024 ** 2:.1f} of {cache.max_bytes / 1024 ** 2:.0f} MB")
@@ -0,0 +1,77 @@
+###----------------------------------------------------------------###
+### River lookup: reading the whole shapefile every time vs the    ###
+### catalogue, on a synthetic WatercourseLink-like shapefile       ###
+###----------------------------------------------------------------###
+import os
+import sys
+import tempfile
+import time
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import LineString
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "river identification"))
+
+import catalogue as river_catalogue
+from catalogue import open_catalogue
+
+N_FEATURES = 50_000
+N_RIVERS = 2_000
+LOOKUPS = 100
+
+
+def make_shapefile(path, n_features=N_FEATURES, n_rivers=N_RIVERS, seed=0):
+    '''Short links in British National Grid metres, like WatercourseLink, named after n_rivers rivers'''
+    rng = np.random.default_rng(seed)
+    starts = rng.uniform((150_000, 50_000), (650_000, 950_000), (n_features, 2))
+    lines = [LineString(start + np.cumsum(rng.normal(0, 20, (20, 2)), axis=0)) for start in starts]
+    names = [f"River {i % n_rivers}" for i in range(n_features)]
+    gpd.GeoDataFrame({"name1": names}, geometry=lines, crs="EPSG:27700").to_file(path)
+
+
+def read_every_time(shapefile, river_name):
+    '''What extract_river_coordinates used to do'''
+    gdf = gpd.read_file(shapefile)
+    return gdf[gdf["name1"] == river_name].to_crs(epsg=4326)
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        shapefile = os.path.join(directory, "WatercourseLink.shp")
+        make_shapefile(shapefile)
+
+        start = time.perf_counter()
+        read_every_time(shapefile, "River 7")
+        print(f"read shapefile:  {(time.perf_counter() - start) * 1000:.0f} ms per river")
+
+        start = time.perf_counter()
+        catalogue = open_catalogue(shapefile, "name1")
+        print(f"build catalogue: {(time.perf_counter() - start) * 1000:.0f} ms, once")
+
+        start = time.perf_counter()
+        for i in range(LOOKUPS):
+            catalogue.coordinates(catalogue.by_name(f"River {i}"))
+        print(f"by name:         {(time.perf_counter() - start) * 1000 / LOOKUPS:.2f} ms per river")
+
+        start = time.perf_counter()
+        for i in range(LOOKUPS):
+            catalogue.in_bbox(-2.4 + i * 0.01, 51.3, -2.3 + i * 0.01, 51.4)
+        print(f"by bbox:         {(time.perf_counter() - start) * 1000 / LOOKUPS:.2f} ms per query")
+
+        start = time.perf_counter()
+        for i in range(LOOKUPS):
+            catalogue.nearest(51.38 + i * 0.01, -2.36)
+        print(f"nearest:         {(time.perf_counter() - start) * 1000 / LOOKUPS:.2f} ms per query")
+
+        # A new process only maps the files, nothing is parsed again
+        river_catalogue._catalogues.clear()
+        start = time.perf_counter()
+        catalogue = open_catalogue(shapefile, "name1")
+        catalogue.coordinates(catalogue.by_name("River 7"))
+        print(f"reopen + lookup: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        # Same rows as the old path
+        expected = read_every_time(shapefile, "River 7").geometry.get_coordinates().to_numpy()
+        found = catalogue.coordinates(catalogue.by_name("River 7"))[["Longitude", "Latitude"]].to_numpy()
+        assert np.allclose(expected, found), "catalogue coordinates differ from the shapefile"
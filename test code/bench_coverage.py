@@ -0,0 +1,63 @@
+###----------------------------------------------------------------###
+### Images needed for a river: one per vertex vs the coverage plan, ###
+### checking the plan still covers every metre of the river        ###
+###----------------------------------------------------------------###
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "river identification"))
+
+from coverage import coverage_summary, plan_coverage
+from mercator import to_pixels
+
+ZOOM_LEVEL = 18
+IMAGE_SIZE = (640, 640)
+
+# Vertex spacing of the synthetic river, WatercourseLink is typically a few tens of metres
+VERTEX_SPACING_METERS = 20
+RIVER_LENGTH_METERS = 50_000
+
+
+def meandering_river(length=RIVER_LENGTH_METERS, spacing=VERTEX_SPACING_METERS, seed=0):
+    '''A random walk with a slowly drifting heading, near Bath, split into two segments'''
+    rng = np.random.default_rng(seed)
+    n = length // spacing
+    heading = np.cumsum(rng.normal(0, 0.15, n))
+    north = np.cumsum(np.cos(heading)) * spacing
+    east = np.cumsum(np.sin(heading)) * spacing
+    latitude = 51.38 + north / 111_320
+    longitude = -2.36 + east / (111_320 * np.cos(np.radians(51.38)))
+    segment = (np.arange(n) >= n // 2).astype(int)
+    return pd.DataFrame({"Latitude": latitude, "Longitude": longitude, "Segment": segment})
+
+
+def uncovered_points(riverpoints, plan):
+    '''Points every pixel along the river that fall outside every planned image'''
+    centres_x, centres_y = to_pixels(plan["Latitude"].to_numpy(), plan["Longitude"].to_numpy(), ZOOM_LEVEL)
+    missed = 0
+    for _, segment in riverpoints.groupby("Segment"):
+        x, y = to_pixels(segment["Latitude"].to_numpy(), segment["Longitude"].to_numpy(), ZOOM_LEVEL)
+        steps = np.maximum(1, np.ceil(np.hypot(np.diff(x), np.diff(y))).astype(int))
+        px = np.concatenate([np.linspace(x[i], x[i + 1], s, endpoint=False) for i, s in enumerate(steps)])
+        py = np.concatenate([np.linspace(y[i], y[i + 1], s, endpoint=False) for i, s in enumerate(steps)])
+        for chunk in np.array_split(np.arange(len(px)), max(1, len(px) // 2000)):
+            inside = (np.abs(px[chunk, None] - centres_x) <= IMAGE_SIZE[0] / 2) & (np.abs(py[chunk, None] - centres_y) <= IMAGE_SIZE[1] / 2)
+            missed += int((~inside.any(axis=1)).sum())
+    return missed
+
+
+if __name__ == "__main__":
+    riverpoints = meandering_river()
+
+    start = time.perf_counter()
+    plan = plan_coverage(riverpoints, ZOOM_LEVEL, IMAGE_SIZE)
+    seconds = time.perf_counter() - start
+
+    summary = coverage_summary(riverpoints, plan)
+    print(f"per vertex: {summary['vertices']} images")
+    print(f"planned:    {summary['images']} images ({summary['reduction']:.1f}x fewer), planned in {seconds * 1000:.1f} ms")
+    print(f"uncovered river points: {uncovered_points(riverpoints, plan)}")
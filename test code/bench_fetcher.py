@@ -0,0 +1,60 @@
+###----------------------------------------------------------------###
+### Benchmark map image downloads against the local fake tile      ###
+### server: one request at a time vs the parallel fetcher          ###
+###----------------------------------------------------------------###
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from fake_tile_server import FakeTileServer
+
+server = FakeTileServer(latency=0.05, failure_rate=0.02).start()
+# Must be set before google_maps_image is imported
+os.environ["GOOGLE_MAPS_STATIC_URL"] = server.url
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "fake-key")
+# Every request must reach the server, or the runs after the first are only disk reads
+os.environ["TILE_CACHE"] = "0"
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "river identification"))
+
+import fetcher
+from google_maps_image import get_map_image
+
+N_POINTS = 200
+
+
+def river_points(n):
+    '''Points along a made-up river'''
+    return [(51.38 + i * 1e-4, -2.36 + i * 1e-4) for i in range(n)]
+
+
+def sequential(points):
+    '''The original loop: one request at a time, a new connection each, no retries'''
+    failed = 0
+    for lat, lon in points:
+        try:
+            get_map_image(lat, lon, 18)
+        except Exception:
+            failed += 1
+    return failed
+
+
+if __name__ == "__main__":
+    points = river_points(N_POINTS)
+
+    start = time.perf_counter()
+    failed = sequential(points)
+    seconds = time.perf_counter() - start
+    print(f"sequential: {N_POINTS / seconds:.1f} images/s, {failed} failed")
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        summary = fetcher.fetch_map_images(points, output_dir, workers=16, rate=1000)
+        print(f"parallel:   {summary['tasks_per_second']:.1f} images/s, {summary['failed']} failed")
+
+        # A second run over the same directory resumes, nothing is downloaded again
+        summary = fetcher.fetch_map_images(points, output_dir, workers=16, rate=1000)
+        print(f"resumed:    {summary['skipped']} skipped, {summary['done']} downloaded")
+
+    print(f"server saw {server.requests} requests, {server.failures} answered 503")
+    server.stop()
@@ -0,0 +1,72 @@
+###----------------------------------------------------------------###
+### Benchmark /getreading: Python-side averaging vs aggregation    ###
+### pipeline, run against the in-process mongomock stand-in        ###
+###----------------------------------------------------------------###
+import os
+import sys
+import time
+import random
+
+# Use the in-process stand-in rather than the cluster
+os.environ.setdefault("MONGODB_URI", "mongomock://")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from environment import config
+from environment.queries import MEASUREMENT_NAMES, get_measurement_points
+
+
+def make_readings(n, values_per_measurement=5):
+    '''Generates n readings in the same shape the app uploads'''
+    return [
+        {
+            "id": f"reading_{i}",
+            "uid": f"device_{i % 50}",
+            "datetime": 1700000000000 + i * 1000,
+            "hasSynced": True,
+            "isSafe": True,
+            "location": {
+                "latitude": random.uniform(-90, 90),
+                "longitude": random.uniform(-180, 180),
+            },
+            "measurements": [
+                {"name": name, "values": [random.uniform(0, 100) for _ in range(values_per_measurement)]}
+                for name in MEASUREMENT_NAMES
+            ],
+            "timeIntervals": list(range(values_per_measurement)),
+        }
+        for i in range(n)
+    ]
+
+
+def python_loop(collection, name="chloride"):
+    '''The original recieve_reading implementation'''
+    results = []
+    for reading in list(collection.find()):
+        latitude = reading['location']['latitude']
+        longitude = reading['location']['longitude']
+        measurement = next((m for m in reading['measurements'] if m['name'] == name), None)
+        if measurement:
+            avg = sum(measurement['values']) / len(measurement['values'])
+        else:
+            avg = None
+        results.append((latitude, longitude, avg))
+    return results
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    for n in (1000, 10000):
+        collection = config.get_db()[f"bench_readings_{n}"]
+        collection.drop()
+        collection.insert_many(make_readings(n))
+
+        loop_rows, loop_time = timed(python_loop, collection)
+        pipeline_rows, pipeline_time = timed(get_measurement_points, "chloride", collection)
+        assert len(loop_rows) == len(pipeline_rows)
+
+        print(f"{n} readings: python loop {loop_time:.3f}s, pipeline {pipeline_time:.3f}s")
@@ -0,0 +1,57 @@
+###----------------------------------------------------------------###
+### Track import time of each entry point with python -X importtime ###
+###----------------------------------------------------------------###
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RIVER_DIR = os.path.join(ROOT, "river identification")
+
+# (module, directory it is imported from)
+ENTRY_POINTS = [
+    ("environment.config", ROOT),
+    ("environment.main", ROOT),
+    ("environment.Heatmap", ROOT),
+    ("google_earth_sat", RIVER_DIR),
+    ("google_maps_image", RIVER_DIR),
+    ("identification", RIVER_DIR),
+    ("read_rivers", RIVER_DIR),
+]
+
+
+def import_time(module, cwd):
+    '''Returns (total microseconds, slowest imports) for a fresh interpreter importing module,
+    or the error if the import fails'''
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, PYTHONPATH=cwd),
+    )
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+
+    # Lines look like "import time:   self [us] | cumulative | imported package"
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        timings.append((int(cumulative), name.rstrip()))
+
+    total = next(us for us, name in timings if name.strip() == module)
+    # Each nesting level adds two spaces, modules imported directly by the entry point are at depth 1
+    direct = [(us, name.strip()) for us, name in timings if (len(name) - len(name.lstrip()) - 1) // 2 == 1]
+    return total, sorted(direct, reverse=True)[:5]
+
+
+if __name__ == "__main__":
+    for module, cwd in ENTRY_POINTS:
+        total, detail = import_time(module, cwd)
+        if total is None:
+            print(f"{module}: failed ({detail})")
+            continue
+        slowest = ", ".join(f"{name} {us / 1000:.0f}ms" for us, name in detail)
+        print(f"{module}: {total / 1000:.0f}ms  [{slowest}]")
@@ -0,0 +1,102 @@
+###----------------------------------------------------------------###
+### Mosaic and segment synthetic rivers of growing length, peak    ###
+### memory should stay flat while the tile count grows. First       ###
+### checks tiles cropped like Static Maps responses land in place   ###
+###----------------------------------------------------------------###
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "river identification"))
+
+from bench_coverage import meandering_river
+from bench_segmentation import synthetic_tile
+from coverage import plan_coverage
+from google_maps_image import ATTRIBUTION_ROWS, crop_and_resize_image
+from mercator import to_pixels
+from mosaic import mosaic_tiles, segment_mosaic
+
+ZOOM_LEVEL = 18
+RIVER_LENGTHS_METERS = [5_000, 20_000, 60_000]
+IMAGE_SIZE = (640, 640)
+PLACEMENT_RIVER_METERS = 2_000
+
+
+def world(x, y, width, height):
+    '''The made-up satellite view of a window of world pixels, different at every pixel so any offset shows'''
+    columns = np.arange(x, x + width)[None, :, None]
+    rows = np.arange(y, y + height)[:, None, None]
+    return ((columns * 7919 + rows * 104729 + np.arange(3) * 61) % 251).astype(np.uint8)
+
+
+def static_map_response(lat, lon, size=IMAGE_SIZE):
+    '''PNG the way get_map_image asks for it: ATTRIBUTION_ROWS taller, centred on the point,
+    with the attribution drawn over the bottom rows'''
+    width, height = size[0], size[1] + ATTRIBUTION_ROWS
+    x, y = to_pixels(lat, lon, ZOOM_LEVEL)
+    image = world(int(round(float(x) - width / 2)), int(round(float(y) - height / 2)), width, height)
+    image[-ATTRIBUTION_ROWS // 2:] = 255
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+def check_placement():
+    '''Tiles through crop_and_resize_image, then mosaicked, must match the world they were cut from'''
+    plan = plan_coverage(meandering_river(PLACEMENT_RIVER_METERS), ZOOM_LEVEL, IMAGE_SIZE)
+    points = list(zip(plan["Latitude"], plan["Longitude"]))
+    tiles = ((lat, lon, crop_and_resize_image(static_map_response(lat, lon), IMAGE_SIZE)) for lat, lon in points)
+    with tempfile.TemporaryDirectory() as directory:
+        raster = mosaic_tiles(tiles, os.path.join(directory, "mosaic"), ZOOM_LEVEL)
+        size = raster.chunk_size
+        for cx, cy in raster.chunks():
+            window = raster.read(cx * size, cy * size, size, size)
+            written = window[..., 3] > 0
+            expected = world(cx * size, cy * size, size, size)
+            assert np.array_equal(window[..., :3][written], expected[written]), f"chunk {cx}, {cy} misplaced"
+    print(f"placement: {len(points)} tiles cropped from Static Maps responses land pixel for pixel")
+
+
+def run(length):
+    '''Mosaic and segment one river, in this process, and report its peak memory'''
+    plan = plan_coverage(meandering_river(length), ZOOM_LEVEL)
+    # Generated one at a time, as fetched images would be read one at a time
+    tiles = ((lat, lon, synthetic_tile(i)[0]) for i, (lat, lon) in enumerate(zip(plan["Latitude"], plan["Longitude"])))
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        raster = mosaic_tiles(tiles, os.path.join(directory, "mosaic"), ZOOM_LEVEL)
+        mosaic_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        masks = segment_mosaic(raster, os.path.join(directory, "river"))
+        segment_seconds = time.perf_counter() - start
+        chunks = len(raster.chunks())
+
+        # The synthetic tiles all have a river, and nothing is river where no tile was drawn
+        size = raster.chunk_size
+        covered = river = 0
+        for cx, cy in raster.chunks():
+            written = raster.read(cx * size, cy * size, size, size)[..., 3] > 0
+            mask = masks.read(cx * size, cy * size, size, size)[..., 0] > 0
+            assert not (mask & ~written).any(), f"river outside the tiles in chunk {cx}, {cy}"
+            covered += int(written.sum())
+            river += int(mask.sum())
+        assert river > 0, "no river found"
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{length / 1000:>4.0f} km: {len(plan):>4} tiles, {chunks:>4} chunks, "
+          f"mosaic {mosaic_seconds:.1f} s, segment {segment_seconds:.1f} s, {river / covered:.0%} river, "
+          f"peak memory {peak_mb:.0f} MB")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]))
+    else:
+        check_placement()
+        # A fresh process per river, so each peak is its own
+        for length in RIVER_LENGTHS_METERS:
+            subprocess.run([sys.executable, __file__, str(length)], check=True)
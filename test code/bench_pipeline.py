@@ -0,0 +1,52 @@
+###----------------------------------------------------------------###
+### Cost per tile between download and segmentation: the old PNG   ###
+### re-encode, write and cv2.imread vs handing the array straight on ###
+###----------------------------------------------------------------###
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "river identification"))
+
+from bench_segmentation import synthetic_tile
+from google_maps_image import crop_and_resize_image
+
+N_TILES = 50
+IMAGE_SIZE = (640, 640)
+
+
+def google_response(seed):
+    '''PNG bytes as the Static Maps API sends them: the tile plus 40 rows of attribution'''
+    tile = synthetic_tile(seed, (IMAGE_SIZE[0], IMAGE_SIZE[1] + 40))[0]
+    return cv2.imencode(".png", tile)[1].tobytes()
+
+
+def png_round_trip(response, path):
+    '''What every tile used to go through: decode, crop, resize, encode, write, read back'''
+    image = cv2.imdecode(np.frombuffer(response, np.uint8), cv2.IMREAD_COLOR)
+    image = cv2.resize(image[20:-20], IMAGE_SIZE)
+    with open(path, "wb") as f:
+        f.write(cv2.imencode(".png", image)[1].tobytes())
+    return cv2.imread(path)
+
+
+if __name__ == "__main__":
+    responses = [google_response(i) for i in range(N_TILES)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        old = [png_round_trip(response, os.path.join(directory, f"{i}.png")) for i, response in enumerate(responses)]
+        old_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = [crop_and_resize_image(response, IMAGE_SIZE) for response in responses]
+    new_seconds = time.perf_counter() - start
+
+    assert all(np.array_equal(a, b) for a, b in zip(old, new)), "the arrays handed to segmentation differ"
+    print(f"PNG round-trip: {old_seconds / N_TILES * 1000:.1f} ms per tile")
+    print(f"array:          {new_seconds / N_TILES * 1000:.1f} ms per tile, {old_seconds / new_seconds:.1f}x faster, identical pixels")
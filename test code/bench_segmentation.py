@@ -0,0 +1,51 @@
+###----------------------------------------------------------------###
+### Batch river segmentation throughput on synthetic tiles: one    ###
+### process vs a process per core                                  ###
+###----------------------------------------------------------------###
+import os
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "river identification"))
+
+from segmentation import segment_batch
+
+N_TILES = 32
+TILE_SIZE = (640, 640)
+
+
+def synthetic_tile(seed, size=TILE_SIZE, land=None):
+    '''Noisy green and brown fields crossed by a dark meandering river, and the true river mask.
+    land fixes the BGR land colour, otherwise it is picked by the seed'''
+    rng = np.random.default_rng(seed)
+    width, height = size
+    image = np.empty((height, width, 3), np.float64)
+    image[:] = land if land is not None else rng.choice([(60, 120, 80), (70, 110, 130), (50, 140, 90)])  # BGR land colours
+    image += rng.normal(0, 18, image.shape)
+
+    rows = np.arange(height)
+    centre = width / 2 + rng.uniform(80, 160) * np.sin(rows / rng.uniform(60, 140) + rng.uniform(0, 6))
+    half_width = rng.uniform(15, 45)
+    mask = (np.abs(np.arange(width)[None, :] - centre[:, None]) < half_width)
+    image[mask] = np.array((90, 70, 40)) + rng.normal(0, 10, (mask.sum(), 3))  # dark blue-brown water
+    return np.clip(image, 0, 255).astype(np.uint8), mask.astype(np.uint8) * 255
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(N_TILES):
+            path = os.path.join(directory, f"tile_{i}.png")
+            cv2.imwrite(path, synthetic_tile(i)[0])
+            paths.append(path)
+
+        for workers in sorted({1, os.cpu_count() or 1}):
+            summary = segment_batch(paths, workers=workers, keep_masks=False)
+            print(f"kmeans_fast, {workers} process(es): {summary['tiles_per_second']:.2f} tiles/s, {len(summary['errors'])} failed")
+
+        summary = segment_batch(paths, 'contours', output_dir=os.path.join(directory, "masks"), keep_masks=False)
+        print(f"contours, {os.cpu_count()} process(es): {summary['tiles_per_second']:.2f} tiles/s, "
+              f"{len(os.listdir(os.path.join(directory, 'masks')))} files written")
@@ -0,0 +1,86 @@
+###----------------------------------------------------------------###
+### Sentinel-2 images along a river against the fake Earth Engine: ###
+### two round-trips per point vs the batched fetch                 ###
+###----------------------------------------------------------------###
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "river identification"))
+
+from bench_coverage import meandering_river
+from coverage import plan_coverage
+import cv2
+from fake_earth_engine import FakeEarthEngineClient
+from fetcher import point_key
+from google_earth_sat import SENTINEL_VIS_PARAMS, visualisation_table
+from mercator import to_pixels
+from sentinel_batch import fetch_sentinel_batch, plan_blocks
+
+ZOOM_LEVEL = 16
+IMAGE_SIZE = (640, 640)
+LATENCY = 0.3  # seconds per Earth Engine request
+
+
+def display(raw, vis_params=SENTINEL_VIS_PARAMS):
+    '''get_sentinel_image's own display step, written out here rather than reusing sentinel_batch.to_display'''
+    rgb = visualisation_table(vis_params)[np.clip(raw, vis_params['min'], vis_params['max']).astype(np.int64) - vis_params['min']]
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+
+def window(lat, lon):
+    '''Top left world pixel of the image centred on a point'''
+    x, y = to_pixels(lat, lon, ZOOM_LEVEL)
+    return int(round(float(x) - IMAGE_SIZE[0] / 2)), int(round(float(y) - IMAGE_SIZE[1] / 2))
+
+
+def per_point(client, points):
+    '''The request pattern of get_sentinel_image: an acquisition date request then a pixel request, point by
+    point, each asking for exactly its own window'''
+    images = {}
+    for lat, lon in points:
+        time.sleep(client.latency)  # image.get('system:time_start').getInfo()
+        x, y = window(lat, lon)
+        pixels = client.compute_pixels(None, x, y, IMAGE_SIZE[0], IMAGE_SIZE[1], ZOOM_LEVEL, ["B4", "B3", "B2"])
+        images[(lat, lon)] = display(pixels[..., :-1])
+    return images
+
+
+if __name__ == "__main__":
+    plan = plan_coverage(meandering_river(20_000), ZOOM_LEVEL, IMAGE_SIZE)
+    points = list(zip(plan["Latitude"], plan["Longitude"]))
+
+    client = FakeEarthEngineClient(LATENCY)
+    start = time.perf_counter()
+    expected = per_point(client, points)
+    seconds = time.perf_counter() - start
+    print(f"per point: {len(points)} images, {2 * len(points)} requests, {seconds:.1f} s")
+
+    client = FakeEarthEngineClient(LATENCY)
+    images = {}
+    summary = fetch_sentinel_batch(points, None, ZOOM_LEVEL, IMAGE_SIZE, client=client, on_image=images.__setitem__)
+    print(f"batched:   {summary['done']} images, {client.requests} requests, {summary['seconds']:.1f} s, {summary['failed']} failed")
+
+    # Every image cut from a block matches its window requested on its own, through get_sentinel_image's
+    # display step. This checks the block planning and cutting only: get_sentinel_image itself samples the
+    # bands at their own resolution with sampleRectangle and resizes, which needs Earth Engine to compare
+    assert all(np.array_equal(images[point_key("sentinel2", lat, lon, ZOOM_LEVEL)], expected[(lat, lon)]) for lat, lon in points)
+    print("batched images identical to their windows fetched one by one")
+
+    # A save failing part way through a block fails the rest of that block, and counts every image once
+    windows = [window(lat, lon) for lat, lon in points]
+    members = max((block[4] for block in plan_blocks(windows, IMAGE_SIZE)), key=len)
+    failing = point_key("sentinel2", *points[members[-1]], ZOOM_LEVEL)
+
+    def fail_last_member(key, image):
+        if key == failing:
+            raise OSError("disk full")
+        images[key] = image
+
+    images = {}
+    summary = fetch_sentinel_batch(points, None, ZOOM_LEVEL, IMAGE_SIZE, client=FakeEarthEngineClient(0), on_image=fail_last_member)
+    assert summary['done'] == len(images) == len(points) - 1 and summary['failed'] == 1, summary
+    print(f"save failing part way: {summary['done']} done, {summary['failed']} failed, {len(points)} images")
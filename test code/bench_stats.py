@@ -0,0 +1,63 @@
+###----------------------------------------------------------------###
+### Benchmark reading statistics: per-document Python loop vs the  ###
+### vectorised NumPy pass in environment/stats.py                  ###
+### usage: python "test code/bench_stats.py" [sizes...]            ###
+###----------------------------------------------------------------###
+import os
+import sys
+import statistics
+from collections import defaultdict
+
+# Use the in-process stand-in rather than the cluster
+os.environ.setdefault("MONGODB_URI", "mongomock://")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from environment.stats import DEFAULT_PERCENTILES, reading_stats
+from bench_getreading import make_readings, timed
+
+SIZES = (10000, 100000, 1000000)
+
+
+def python_loop(readings):
+    '''Per-document loop in the style of the original recieve_reading, grouped by uid'''
+    grouped = defaultdict(lambda: defaultdict(list))
+    for reading in readings:
+        for measurement in reading['measurements']:
+            grouped[reading['uid']][measurement['name']].extend(measurement['values'])
+
+    results = {}
+    for uid, measurements in grouped.items():
+        results[uid] = {}
+        for name, values in measurements.items():
+            ordered = sorted(values)
+            cuts = statistics.quantiles(ordered, n=100, method='inclusive')
+            results[uid][name] = {
+                'count': len(values),
+                'mean': sum(values) / len(values),
+                'std': statistics.pstdev(values),
+                'min': ordered[0],
+                'max': ordered[-1],
+                'median': statistics.median(ordered),
+                **{f'p{p}': cuts[p - 1] for p in DEFAULT_PERCENTILES},
+            }
+    return results
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or SIZES
+    for n in sizes:
+        readings = make_readings(n)
+        loop_result, loop_time = timed(python_loop, readings)
+        numpy_result, numpy_time = timed(reading_stats, readings, "uid")
+
+        # Both paths must agree before their timings mean anything
+        for group in numpy_result:
+            expected = loop_result[group["key"]]["chloride"]
+            actual = group["measurements"]["chloride"]
+            assert actual["count"] == expected["count"]
+            for stat in ("mean", "std", "median", "p5", "p95"):
+                assert abs(actual[stat] - expected[stat]) < 1e-6, stat
+
+        print(f"{n} readings: python loop {loop_time:.3f}s, numpy {numpy_time:.3f}s ({loop_time / numpy_time:.1f}x)")
+        del readings
@@ -0,0 +1,135 @@
+###----------------------------------------------------------------###
+### Explain every query the API issues and fail on collection scans ###
+### Needs a real MongoDB (mongomock has no query planner), e.g.      ###
+### MONGODB_URI=mongodb://localhost:27017 python check_query_plans.py ###
+###----------------------------------------------------------------###
+import os
+import sys
+import time
+from pymongo import monitoring
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from environment import config
+
+# Seed and query a scratch database, never the real one
+config.DATABASE_NAME = os.getenv("QUERY_PLAN_DATABASE", "query_plan_check")
+
+from fastapi.testclient import TestClient
+from environment.main import app
+from environment.sync import SETTLE_TIME
+from bench_getreading import make_readings
+
+# Commands whose plan is checked; writes only touch documents by _id
+READ_COMMANDS = ("find", "aggregate", "count", "distinct")
+
+# (path, query parameters, reason it may scan the whole collection or None)
+REQUESTS = [
+    ("/getreading", {}, "returns every reading"),
+    ("/getreading", {"bbox": "-10,-10,10,10"}, None),
+    ("/getreading", {"tile": "3/4/3", "stream": True}, None),
+    ("/tiles/3/4/3", {}, None),
+    ("/stats", {}, "summarises every reading"),
+    ("/stats", {"group_by": "day", "bbox": "-10,-10,10,10"}, None),
+    ("/rollups", {"scope": "uid", "period": "day", "key": "device_1"}, None),
+    ("/rollups", {"scope": "cell", "period": "hour"}, None),
+    ("/readings", {"limit": 50}, None),
+    ("/readings/uid/device_1", {}, None),
+    ("/readings/sync", {"limit": 5}, None),
+]
+
+
+class CommandRecorder(monitoring.CommandListener):
+    '''Keeps every read command sent to the scratch database'''
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        if event.command_name in READ_COMMANDS and event.database_name == config.DATABASE_NAME:
+            # Drop the session and cluster fields the driver adds, explain takes the bare command
+            command = {key: value for key, value in event.command.items() if not key.startswith("$") and key != "lsid"}
+            self.commands.append(command)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def scan_stages(plan):
+    '''Yields every COLLSCAN stage in an explain output'''
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            yield plan
+        for value in plan.values():
+            yield from scan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from scan_stages(value)
+
+
+def winning_plans(explain):
+    '''The winning plans of an explain output, wherever the server version puts them'''
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "winningPlan":
+                yield value
+            else:
+                yield from winning_plans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            yield from winning_plans(value)
+
+
+def check(client, db, recorder, path, params, allowed):
+    '''Calls one endpoint and returns a line per query it issued that scans the collection'''
+    recorder.commands.clear()
+    response = client.get(path, params=params)
+    assert response.status_code == 200, f"{path} {params}: {response.status_code} {response.text}"
+
+    problems = []
+    for command in list(recorder.commands):
+        explain = db.command("explain", command, verbosity="queryPlanner")
+        scans = [stage for plan in winning_plans(explain) for stage in scan_stages(plan)]
+        if not scans:
+            continue
+        line = f"{path} {params}: COLLSCAN on {command[next(iter(command))]} for {command}"
+        if allowed:
+            print(f"allowed  {line} ({allowed})")
+        else:
+            problems.append(line)
+    return problems
+
+
+if __name__ == "__main__":
+    if config.MONGODB_URI.startswith("mongomock://"):
+        sys.exit("Query plans need a real MongoDB, set MONGODB_URI")
+
+    recorder = CommandRecorder()
+    monitoring.register(recorder)
+    db = config.get_db()
+    config.get_client().drop_database(config.DATABASE_NAME)
+
+    problems = []
+    with TestClient(app) as client:
+        response = client.post("/readings/bulk", json=make_readings(2000))
+        assert response.status_code == 200, response.text
+        # Let the sync endpoint see the new readings
+        time.sleep(SETTLE_TIME.total_seconds())
+
+        for path, params, allowed in REQUESTS:
+            problems += check(client, db, recorder, path, params, allowed)
+
+        # A follow-up sync call runs the watermark query
+        watermark = client.get("/readings/sync", params={"limit": 5}).json()["watermark"]
+        if watermark:
+            problems += check(client, db, recorder, "/readings/sync", {"limit": 5, "watermark": watermark}, None)
+
+    config.get_client().drop_database(config.DATABASE_NAME)
+    for problem in problems:
+        print(f"FAIL     {problem}")
+    if problems:
+        sys.exit(1)
+    print(f"No unexpected collection scans in {len(REQUESTS) + 1} requests")
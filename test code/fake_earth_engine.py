@@ -0,0 +1,38 @@
+###----------------------------------------------------------------###
+### Offline stand-in for sentinel_batch.EarthEngineClient: made-up  ###
+### but repeatable band values, a set delay per request and a       ###
+### count of requests                                               ###
+###----------------------------------------------------------------###
+import threading
+import time
+
+import numpy as np
+
+
+class FakeEarthEngineClient:
+    '''Same methods as sentinel_batch.EarthEngineClient.
+
+    latency: seconds each request takes, like an Earth Engine round-trip
+    acquired: milliseconds timestamp every pixel reports as its image date, 0 for none
+    '''
+    def __init__(self, latency=0.3, acquired=1_700_000_000_000):
+        self.latency = latency
+        self.acquired = acquired
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def latest_image(self, bbox, start, end, bands):
+        # Earth Engine builds this lazily, nothing is sent until pixels are asked for
+        return {"bbox": bbox, "start": start, "end": end, "bands": bands}
+
+    def compute_pixels(self, image, x, y, width, height, zoom_level, bands):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        # A smooth pattern fixed to world pixels, so overlapping requests agree
+        columns = np.arange(x, x + width)[None, :, None]
+        rows = np.arange(y, y + height)[:, None, None]
+        offsets = np.arange(len(bands))[None, None, :] * 700
+        raw = 2000 + (columns * 3 + rows * 5 + offsets) % 2600
+        acquired = np.full((height, width, 1), self.acquired, dtype=np.float64)
+        return np.concatenate([raw.astype(np.float64), acquired], axis=-1)
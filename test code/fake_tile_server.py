@@ -0,0 +1,94 @@
+###----------------------------------------------------------------###
+### Local stand-in for the Google Static Maps API, serving random   ###
+### PNG tiles with configurable latency and failures, so the image ###
+### fetcher can be run and benchmarked offline                     ###
+###----------------------------------------------------------------###
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+
+class FakeTileServer:
+    '''Serves GET /staticmap?size=WxH... with a PNG of that size.
+
+    latency: seconds each response is delayed, like a real round-trip
+    failure_rate: fraction of requests answered 503, to exercise retries
+    '''
+    def __init__(self, latency=0.05, failure_rate=0.0, port=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.failures = 0
+        self._tiles = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/staticmap"
+
+    def tile(self, width, height):
+        # Encoded once per size, so the server's own cost stays out of the measurements
+        with self._lock:
+            if (width, height) not in self._tiles:
+                pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+                self._tiles[(width, height)] = cv2.imencode(".png", pixels)[1].tobytes()
+            return self._tiles[(width, height)]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, so pooled connections are reused
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                time.sleep(server.latency)
+                if random.random() < server.failure_rate:
+                    with server._lock:
+                        server.failures += 1
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                query = parse_qs(urlparse(self.path).query)
+                width, height = (int(n) for n in query.get("size", ["640x640"])[0].split("x"))
+                body = server.tile(width, height)
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == "__main__":
+    server = FakeTileServer().start()
+    print(f"Serving fake tiles at {server.url}, set GOOGLE_MAPS_STATIC_URL to this. Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()